@@ -0,0 +1,95 @@
+from datetime import timedelta
+
+import numpy as np
+
+# Helpers for crunching the sales numbers shown on the admin analytics page.
+# The rows comes from the small rollup tables (SalesDays and SalesDaily) and
+# everything is summed up with numpy arrays, instead of looping over the rows in
+# python. Quick intro to numpy: https://numpy.org/doc/stable/user/absolute_beginners.html
+
+
+# Converts a list of db rows (dicts) into a numpy array for a single column.
+def column(rows, name, dtype=np.int64):
+    return np.fromiter((row[name] for row in rows), dtype=dtype, count=len(rows))
+
+
+# Turns the date column into day numbers, relative to the start date.
+def day_numbers(rows, start):
+    days = np.array([row["day"] for row in rows], dtype="datetime64[D]")
+    return (days - np.datetime64(start, "D")).astype(np.int64)
+
+
+# Sums up the values per day, between start and end (both included).
+# Days without any sales are filled in with zeros.
+# Returns a list of (date, value) tuples.
+def per_day(rows, name, start, end):
+    count = (end - start).days + 1
+    idx = day_numbers(rows, start)
+    # bincount() sums all the weights that share the same day number
+    # Source: https://numpy.org/doc/stable/reference/generated/numpy.bincount.html
+    totals = np.bincount(idx, weights=column(rows, name), minlength=count)[:count]
+    return [(start + timedelta(days=i), int(v)) for i, v in enumerate(totals)]
+
+
+# Same as above, but sums up the values per week (starting on mondays).
+def per_week(rows, names, start, end):
+    monday = start - timedelta(days=start.weekday())
+    count = (end - monday).days // 7 + 1
+    idx = day_numbers(rows, monday) // 7
+    weeks = [monday + timedelta(weeks=i) for i in range(count)]
+    totals = {}
+    for name in names:
+        totals[name] = np.bincount(idx, weights=column(rows, name), minlength=count)[:count]
+    return [dict({"week": w}, **{n: int(totals[n][i]) for n in names}) for i, w in enumerate(weeks)]
+
+
+# Returns the average amount of units per order.
+def basket_size(rows):
+    orders = column(rows, "orders").sum()
+    if orders < 1:
+        return 0.0
+    return float(column(rows, "units").sum() / orders)
+
+
+# Returns the top products (by units sold) as a list of (idproduct, units, revenue).
+def top_products(rows, limit=10):
+    if len(rows) < 1:
+        return []
+    # unique() gives each product ID a small index number, which can be used
+    # with bincount() to sum up the rows for each product.
+    ids, idx = np.unique(column(rows, "idproduct"), return_inverse=True)
+    units = np.bincount(idx, weights=column(rows, "units"))
+    revenue = np.bincount(idx, weights=column(rows, "revenue"))
+    # Sort by units first and then by revenue, highest first
+    order = np.lexsort((-revenue, -units))[:limit]
+    return [(int(ids[i]), int(units[i]), int(revenue[i])) for i in order]
+
+
+# Sums the units sold for each connector type. A cable with two different types
+# of connectors counts for both types, but a cable with the same type in both
+# ends is only counted once.
+# "products" is a list of product rows with the connector types JOIN'ed in.
+# Returns a list of (type, units) tuples, sorted by units.
+def units_per_connector(rows, products):
+    if len(rows) < 1 or len(products) < 1:
+        return []
+    types = sorted(set(p["c1type"] for p in products) | set(p["c2type"] for p in products))
+    type_idx = {t: i for i, t in enumerate(types)}
+
+    # Build a (products x types) matrix with a 1 for each type a product has
+    prod_ids = column(products, "idproduct")
+    has_type = np.zeros((len(products), len(types)), dtype=np.int64)
+    for i, p in enumerate(products):
+        has_type[i, type_idx[p["c1type"]]] = 1
+        has_type[i, type_idx[p["c2type"]]] = 1
+
+    # Find the product index for each sales row, skipping removed products
+    sort = np.argsort(prod_ids)
+    ids = column(rows, "idproduct")
+    pos = np.searchsorted(prod_ids, ids, sorter=sort).clip(max=len(prod_ids) - 1)
+    found = prod_ids[sort[pos]] == ids
+    units = np.bincount(sort[pos[found]], weights=column(rows, "units")[found], minlength=len(products))
+
+    # Then it's just a matrix multiplication to get the total per type
+    totals = units @ has_type
+    return sorted(((t, int(totals[i])) for t, i in type_idx.items()), key=lambda x: -x[1])
@@ -0,0 +1,277 @@
+import os, asyncio
+from datetime import datetime
+from collections import defaultdict
+
+from quart import Quart, render_template, session, redirect, url_for, flash, jsonify
+import aiomysql
+
+import images
+import recommend
+import repository
+import build_assets
+
+from dotenv import load_dotenv
+
+# An asyncio version of the read-only pages from backend.py, for serving lots of
+# visitors. It's run side by side with the normal flask app, nginx sends the
+# pages below to this app and everything else to flask (see nginx.conf).
+#
+# Quart is an asyncio reimplementation of flask, with the same API (but with
+# lots of awaits) and the same templates: https://quart.palletsprojects.com/
+# The db is used through aiomysql's connection pool, so a page can run several
+# queries at the same time and waiting for the db doesn't block any threads.
+# Source: https://aiomysql.readthedocs.io/en/stable/pool.html
+#
+# The apps share the session cookies, so SECRET_KEY must be set to the same
+# value for both of them.
+#
+# Run it with: hypercorn async_backend:app --bind 0.0.0.0:5001
+
+load_dotenv()
+
+app = Quart(__name__)
+app.secret_key = os.getenv("SECRET_KEY")
+if not app.secret_key:
+    print("SECRET_KEY is not set, the logins from the flask app won't work here")
+    app.secret_key = os.urandom(32)
+
+app.jinja_env.globals["image_url"] = images.image_url
+app.jinja_env.globals["image_srcset"] = images.image_srcset
+
+asset_manifest = build_assets.load_manifest() or {}
+
+
+# Same as in backend.py
+def asset_url(name):
+    return url_for("static", filename=asset_manifest.get(name, name))
+
+
+app.jinja_env.globals["asset_url"] = asset_url
+
+# Same as in backend.py
+GENDERS = {0: "male", 1: "female"}
+
+# Max amount of open db connections. Far fewer than the amount of visitors, since
+# a connection is only borrowed while a query runs.
+DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", default=20))
+
+# Seconds between adding the new orders to the "frequently bought together"
+# table. The orders are placed through the flask app, so this app can't update
+# the table as they come in.
+RECOMMEND_REFRESH = int(os.getenv("RECOMMEND_REFRESH", default=60))
+# An order's timestamp is taken when the checkout starts, so it can be committed
+# a little later than that. Each refresh looks this many seconds further back
+# and skips the orders it has seen already.
+RECOMMEND_LAG = 300
+
+db_pool = None
+recommender = recommend.Recommender(k=5)
+
+
+@app.before_serving
+async def open_db_pool():
+    global db_pool
+    db_pool = await aiomysql.create_pool(
+        host=os.getenv("DB_HOST"),
+        port=int(os.getenv("DB_PORT", default=3306)),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        db=os.getenv("DB_DATABASE"),
+        maxsize=DB_POOL_SIZE,
+        # Without autocommit, a pooled connection would keep reading from the
+        # same old snapshot of the db (mysql's default REPEATABLE READ).
+        autocommit=True,
+    )
+    app.add_background_task(refresh_recommendations)
+
+
+@app.after_serving
+async def close_db_pool():
+    db_pool.close()
+    await db_pool.wait_closed()
+
+
+# Runs a query on a connection from the pool and returns all rows, as dicts.
+async def query(sql, params=None):
+    async with db_pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute(sql, params)
+            return await cur.fetchall()
+
+
+################################################################################
+# QUERIES (the SQL comes from repository.py, same as for the flask app)
+
+
+async def get_products(limit=10):
+    sql = repository.PRODUCT_QUERY.format(products="SELECT * FROM Products LIMIT %(limit)s")
+    return await query(sql + " ORDER BY p.idproduct ASC;", {"limit": limit})
+
+
+async def get_product(id):
+    sql = repository.PRODUCT_QUERY.format(products="SELECT * FROM Products WHERE idproduct = %(idproduct)s LIMIT 1")
+    rows = await query(sql + ";", {"idproduct": id})
+    if not rows:
+        raise Exception("missing product")
+    return rows[0]
+
+
+# Returns the products with the given IDs (in the same order). Missing products are skipped.
+async def get_products_by_ids(ids):
+    if len(ids) < 1:
+        return []
+    marks = ", ".join(["%s"] * len(ids))
+    sql = repository.PRODUCT_QUERY.format(products="SELECT * FROM Products WHERE idproduct IN (" + marks + ")")
+    rows = await query(sql + ";", list(ids))
+    found = {row["idproduct"]: row for row in rows}
+    return [found[id] for id in ids if id in found]
+
+
+async def get_reviews(id):
+    return await query(repository.REVIEWS_QUERY, {"idproduct": id})
+
+
+# A customer's orders from both the current and archived orders, newest first
+async def get_customer_orders(user):
+    return await query(
+        """
+        SELECT iduser, idproduct, amount, price, timestamp FROM Orders WHERE iduser = %(user)s
+        UNION ALL
+        SELECT iduser, idproduct, amount, price, timestamp FROM OrdersArchive WHERE iduser = %(user)s
+        ORDER BY timestamp DESC;
+    """,
+        {"user": user},
+    )
+
+
+# Same as group_orders() in backend.py
+async def group_orders(items):
+    products = await get_products_by_ids(list({row["idproduct"] for row in items}))
+    products = {p["idproduct"]: p for p in products}
+    orders = defaultdict(list)
+    for row in items:
+        if row["idproduct"] not in products:
+            continue
+        product = dict(products[row["idproduct"]])
+        product["iduser"] = row["iduser"]
+        product["price"] = row["price"]
+        product["amount"] = row["amount"]
+        orders[datetime.fromtimestamp(row["timestamp"])].append(product)
+    return orders
+
+
+# Reads orders as order numbers and product IDs (see build_recommendations() in
+# backend.py). The rows are streamed in batches with an unbuffered cursor, so a
+# huge result is never held twice and other requests gets to run in between.
+async def load_orders(sql, params=None):
+    orders, products = [], []
+    async with db_pool.acquire() as conn:
+        async with conn.cursor(aiomysql.SSCursor) as cur:
+            await cur.execute(sql, params)
+            while True:
+                rows = await cur.fetchmany(10000)
+                if not rows:
+                    break
+                orders.extend((user << 32) | stamp for user, stamp, _ in rows)
+                products.extend(product for _, _, product in rows)
+    return orders, products
+
+
+# Returns the newest timestamp among the orders, and the orders from the last
+# "lag" seconds before it (order number -> timestamp)
+def recent_orders(orders, lag):
+    newest = max((order & 0xFFFFFFFF for order in orders), default=0)
+    return newest, {order: order & 0xFFFFFFFF for order in orders if (order & 0xFFFFFFFF) > newest - lag}
+
+
+# Builds the "frequently bought together" table once, and then adds the new
+# orders to it now and then, see recommend.py. Only the first build reads all
+# orders, after that it's a small range read on the Orders timestamp index.
+async def refresh_recommendations():
+    newest, seen = None, {}
+    while True:
+        try:
+            if newest is None:
+                sql = "SELECT iduser, timestamp, idproduct FROM " + repository.ALL_ORDERS
+                orders, products = await load_orders(sql)
+                # Building the table is cpu heavy, keep it away from the event loop
+                await asyncio.to_thread(recommender.build, orders, products)
+                newest, seen = await asyncio.to_thread(recent_orders, orders, RECOMMEND_LAG)
+                del orders, products
+            else:
+                param = {"since": newest - RECOMMEND_LAG}
+                sql = "SELECT iduser, timestamp, idproduct FROM Orders WHERE timestamp > %(since)s"
+                orders, products = await load_orders(sql, param)
+                baskets = defaultdict(list)
+                for order, product in zip(orders, products):
+                    if order not in seen:
+                        baskets[order].append(product)
+                for order, items in baskets.items():
+                    recommender.add_order(items, order)
+                    seen[order] = order & 0xFFFFFFFF
+                newest = max([newest] + list(seen.values()))
+                seen = {order: stamp for order, stamp in seen.items() if stamp > newest - RECOMMEND_LAG}
+        except Exception as err:
+            print("Error updating recommendations: ", err)
+        await asyncio.sleep(RECOMMEND_REFRESH)
+
+
+################################################################################
+# PAGES
+
+
+@app.route("/products")
+async def page_products():
+    rows = await get_products(limit=200)
+    return await render_template("products.html", products=rows, genders=GENDERS)
+
+
+@app.route("/product/<id>")
+async def page_product(id):
+    try:
+        # The product and its reviews doesn't depend on each other, so fetch
+        # them both at the same time
+        prod, reviews = await asyncio.gather(get_product(id), get_reviews(id))
+    except Exception as err:
+        await flash("Invalid product ID.")
+        return redirect(url_for("page_products"))
+
+    related = []
+    if recommender.built:
+        try:
+            related = await get_products_by_ids(recommender.related(prod["idproduct"]))
+        except aiomysql.Error as err:
+            print("Error getting related products: ", err)
+    return await render_template(
+        "product.html", product=prod, genders=GENDERS, reviews=reviews, related=related, iduser=session.get("id")
+    )
+
+
+@app.route("/orders")
+async def page_customer_orders():
+    user = session.get("id")
+    if user is None:
+        await flash("Please log in before viewing order history")
+        return redirect("/")
+
+    try:
+        orders = await group_orders(await get_customer_orders(user))
+    except Exception as err:
+        print("Error getting orders/products: " + str(err))
+        await flash("Error occured while getting order history")
+        return redirect("/")
+    return await render_template("customerorders.html", orders=orders, genders=GENDERS)
+
+
+################################################################################
+# API
+
+
+@app.route("/api/product/<int:id>")
+async def api_product(id):
+    try:
+        prod, reviews = await asyncio.gather(get_product(id), get_reviews(id))
+    except Exception:
+        return jsonify({"error": "Invalid product ID"}), 404
+    prod["reviews"] = reviews
+    return jsonify(prod)
@@ -1,10 +1,28 @@
-import os, sys, secrets, time
-from datetime import datetime
+import os, sys, math, secrets, time, threading, functools
+import io, csv, json
+import urllib.request
+from datetime import datetime, timedelta, timezone
 from collections import defaultdict
 
-from flask import Flask, request, render_template, session, redirect, url_for, flash
+from flask import Flask, request, render_template, session, redirect, url_for, flash, jsonify
 from flask import g as request_globals
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.middleware.proxy_fix import ProxyFix
 import mysql.connector
+import click
+
+import analytics
+import recommend
+import compat
+import images
+import compress
+import jobs
+import ratelimit
+import repository
+import build_assets
+import credentials
+import stock
+import singleflight
 
 # Loads ENVIRONMENT variables from a local file called ".env".
 # This file SHOULD NOT be committed, as it contains secrets!
@@ -16,15 +34,153 @@ load_dotenv()
 # Create the new flask app to be published
 app = Flask(__name__)
 
+# Helpers for showing the product images in the templates
+app.jinja_env.globals["image_url"] = images.image_url
+app.jinja_env.globals["image_srcset"] = images.image_srcset
+
+
+# Loads the list of static files with hashed names, made by build_assets.py
+def load_asset_manifest():
+    manifest = build_assets.load_manifest()
+    if manifest is None:
+        print("No static asset manifest found, run build_assets.py to create it")
+        return {}
+    return manifest
+
+
+asset_manifest = load_asset_manifest()
+
+
+# Returns the URL for a static file, ie. asset_url("style.css").
+# Uses the hashed file name if the assets has been built, so the file can be
+# cached forever, or else the original file.
+def asset_url(name):
+    return url_for("static", filename=asset_manifest.get(name, name))
+
+
+app.jinja_env.globals["asset_url"] = asset_url
+
+
+# Keep the compiled templates on disk, so new workers (after a deploy or restart)
+# can skip parsing and compiling all the templates again. Set TEMPLATE_CACHE_DIR
+# to an empty string to turn it off.
+# Source: https://jinja.palletsprojects.com/en/stable/api/#bytecode-cache
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", default=os.path.join(os.path.dirname(__file__), ".jinja_cache"))
+if TEMPLATE_CACHE_DIR:
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
+
+# Loads (and compiles, if they're not in the bytecode cache) all templates, so the
+# first visitors of each page doesn't have to wait for it.
+# Returns the amount of loaded templates.
+def load_templates():
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+# Files with hashed names never change, so tell browsers to keep them forever.
+# nginx normally serves these files directly, this is only used if it doesn't.
+@app.after_request
+def add_cache_headers(response):
+    if request.path.startswith(("/static/dist/", "/static/products/")) and response.status_code == 200:
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+# Compress and minify the responses (see compress.py). Set COMPRESSION=nginx to
+# leave the compression to nginx (and only minify), or COMPRESSION=off to do neither.
+compression = os.getenv("COMPRESSION", default="app")
+if compression != "off":
+    app.wsgi_app = compress.CompressionMiddleware(
+        app.wsgi_app,
+        compress=(compression == "app"),
+        min_size=int(os.getenv("COMPRESSION_MIN_SIZE", default=1024)),
+        level=int(os.getenv("COMPRESSION_LEVEL", default=6)),
+        minify=(os.getenv("MINIFY_HTML", default="1") == "1"),
+    )
+
+# nginx passes on the client's real IP in the X-Forwarded-For header, which is
+# needed for the rate limits. Only turn this on when running behind nginx, or
+# anyone could fake their IP!
+# Source: https://flask.palletsprojects.com/en/stable/deploying/proxy_fix/
+if os.getenv("TRUST_PROXY", default="0") == "1":
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+
+# Limit how many requests are handled at the same time, and turn away the rest
+# with a 503 before the db runs out of connections (see ratelimit.py).
+# Set MAX_CONCURRENT_REQUESTS=0 to turn it off.
+max_requests = int(os.getenv("MAX_CONCURRENT_REQUESTS", default=64))
+if max_requests > 0:
+    app.wsgi_app = ratelimit.ConcurrencyLimiter(app.wsgi_app, max_requests)
+
 # This secret is used for the built-in flask sessions, how they work:
 # https://flask.palletsprojects.com/en/stable/quickstart/#sessions
-# Here we're randomizing the app.secret_key every time the server is restarted
-app.secret_key = secrets.token_bytes()
+# Here we're randomizing the app.secret_key every time the server is restarted,
+# unless it's set with SECRET_KEY. It must be set when running the async app too
+# (see async_backend.py), so both apps can read the same session cookies.
+app.secret_key = os.getenv("SECRET_KEY") or secrets.token_bytes()
 
 ################################################################################
 # GLOBAL HELPER FUNCTIONS (these should be at the top of the file)
 
 
+# Rate limits for the write pages, as (tokens per second, max burst).
+# Ie. (0.2, 10) allows 10 requests right away and then one every 5 seconds.
+RATE_LIMITS = {
+    "register": (0.05, 5),
+    "login": (0.2, 10),
+    "review": (0.1, 5),
+    "buy": (1, 20),
+    "checkout": (0.2, 5),
+}
+
+# Rate limiting can be turned off with RATE_LIMITING=0, ie. when running the load
+# tests (see benchmarks/loadtest.py), which sends everything from a single IP.
+RATE_LIMITING = os.getenv("RATE_LIMITING", default="1") == "1"
+
+# The rate limit buckets are kept in memory, unless a shared redis is configured
+if os.getenv("RATE_LIMIT_REDIS_URL"):
+    rate_limit_store = ratelimit.RedisStore(os.getenv("RATE_LIMIT_REDIS_URL"))
+else:
+    rate_limit_store = ratelimit.MemoryStore()
+
+
+# Decorator for adding a rate limit to a page. Logged in users are limited by
+# their user ID and everyone else by their IP.
+# More on decorators: https://flask.palletsprojects.com/en/stable/patterns/viewdecorators/
+def rate_limited(name):
+    rate, burst = RATE_LIMITS[name]
+
+    def decorator(view):
+        if not RATE_LIMITING:
+            return view
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            user = session.get("id")
+            client = "user:" + str(user) if user is not None else "ip:" + str(request.remote_addr)
+            allowed, wait = rate_limit_store.take(name + ":" + client, rate, burst)
+            if not allowed:
+                return "Too many requests, please try again later", 429, {"Retry-After": ratelimit.retry_after(wait)}
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Hashes the passwords in a few background processes, see credentials.py.
+# PASSWORD_COST sets the scrypt cost (log2 N), or else it's calibrated to take
+# about 0.1 s per hash on this server.
+password_hasher = credentials.Hasher(
+    workers=int(os.getenv("PASSWORD_WORKERS", default=2)),
+    cost=int(os.getenv("PASSWORD_COST")) if os.getenv("PASSWORD_COST") else None,
+)
+
+
 # Simple translation tables for showing prettier values as strings
 ROLES = {0: "Customer", 1: "Administrator"}
 GENDERS = {0: "male", 1: "female"}
@@ -84,16 +240,22 @@ def get_float_form(name, default=""):
 # https://flask.palletsprojects.com/en/stable/tutorial/database/
 
 
+# Opens a new connection to the external db. Raises a mysql.connector.Error if
+# it fails, used by the background jobs.
+def connect_db():
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        database=os.getenv("DB_DATABASE"),
+    )
+
+
 # Helper for opening a new connection to the external db. Returns a db object.
 def open_db():
     try:
-        db = mysql.connector.connect(
-            host=os.getenv("DB_HOST"),
-            port=os.getenv("DB_PORT"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD"),
-            database=os.getenv("DB_DATABASE"),
-        )
+        db = connect_db()
         return db
     except mysql.connector.Error as err:
         print("Error connecting to database:", err)
@@ -117,6 +279,9 @@ def init_db():
                 for _ in cur.fetchsets():
                     pass
 
+            # Fill in the sales rollups for the example orders
+            rebuild_sales_rollups(db)
+
         except mysql.connector.Error as err:
             print("Error initialising database:", err)
             sys.exit(1)
@@ -135,6 +300,11 @@ def get_db():
     return request_globals.db
 
 
+# Returns the repository with the queries for the core tables, see repository.py
+def repo(db):
+    return repository.MySQLRepository(db)
+
+
 # Close the db connection whenever the web request is being closed.
 @app.teardown_request
 def close_db(exception=None):
@@ -151,171 +321,656 @@ def close_db(exception=None):
 # Tries to insert a new user.
 # Raises an IntegrityError if the email already exists (thanks to email UNIQUE constraint).
 def register_user(db, email, pwd):
-    # Use a dictionary, to be able to use it in the query
-    params = {"email": email, "password": pwd}
-    with db.cursor(dictionary=True) as cur:
-        cur.execute("INSERT INTO Users(role, email, password) VALUES(0, %(email)s, %(password)s);", params)
+    repo(db).register_user(email, pwd)
 
 
 def get_user(db, email):
-    param = {"email": email}
-    with db.cursor(dictionary=True) as cur:
-        cur.execute("SELECT * FROM Users WHERE email=%(email)s LIMIT 1;", param)
-        row = cur.fetchone()
-    if row is None:
-        raise Exception("bad user")
-    return row
+    return repo(db).get_user(email)
+
+
+def get_user_auth(db, email):
+    return repo(db).get_user_auth(email)
+
+
+def set_user_password(db, id, password):
+    repo(db).set_password(id, password)
 
 
 def update_user(db, param):
-    with db.cursor(dictionary=True) as cur:
-        cur.execute(
-            """
-            UPDATE Users
-            SET email=%(email)s, password=%(password)s, first_name=%(first_name)s, last_name=%(last_name)s
-            WHERE email=%(oldEmail)s;
-        """,
-            param,
-        )
+    repo(db).update_user(param)
+
+
+# The hot reads below (products, reviews and connectors) goes through this. Identical
+# queries running at the same time are merged into one, and the results are kept
+# for READ_CACHE_TTL seconds (plus READ_CACHE_STALE seconds while refreshing them
+# in the background), see singleflight.py. Set both to 0 to only merge the queries.
+read_cache = singleflight.SingleFlight(
+    connect_db,
+    ttl=float(os.getenv("READ_CACHE_TTL", default=2)),
+    stale=float(os.getenv("READ_CACHE_STALE", default=10)),
+)
 
 
 # Returns a list of products, with connector entries JOIN'ed in.
 # limit sets the maximum amount of products returned, if possible.
-def get_products(db, limit=10):
-    params = {"limit": limit}
-    with db.cursor(dictionary=True) as cur:
-        # The two joins basically adds extra values, from the connector table,
-        # to the product tuples. No need to send extra SQL queries to check a
-        # connector's type or gender.
-        # This was stolen from: https://dba.stackexchange.com/a/208083
-        #
-        # Any subqueries (queries inside a parenthesis) must also have an alias!
-        # Source: https://stackoverflow.com/a/1888845
+# Use cached=False when the result must be up to date, ie. for the admin pages.
+def get_products(db, limit=10, cached=True):
+    if not cached:
+        return repo(db).get_products(limit)
+    return read_cache.get(("products", limit), lambda conn: repo(conn).get_products(limit), db)
+
+
+# get a single product
+def get_product(db, id, cached=True):
+    if not cached:
+        return repo(db).get_product(id)
+    return read_cache.get(("product", str(id)), lambda conn: repo(conn).get_product(id), db)
+
+
+# Returns the products with the given IDs (in the same order), with connectors
+# JOIN'ed in like above. Missing products are skipped.
+def get_products_by_ids(db, ids):
+    return repo(db).get_products_by_ids(ids)
+
+
+def get_connectors(db):
+    return read_cache.get(("connectors",), lambda conn: repo(conn).get_connectors(), db)
+
+
+def get_reviews(db, id):
+    return read_cache.get(("reviews", str(id)), lambda conn: repo(conn).get_reviews(id), db)
+
+
+def add_product_to_cart(db, params):
+    repo(db).add_product_to_cart(params)
+
+
+def add_review(db, params):
+    repo(db).add_review(params)
+
+
+def add_new_product(db, param):
+    return repo(db).add_new_product(param)
+
+
+def update_product(db, param):
+    repo(db).update_product(param)
+
+
+# Sets the product's image, the key comes from images.ingest_image()
+def set_product_image(db, id, key):
+    repo(db).set_product_image(id, key)
+
+
+def remove_products(db, products):
+    # There's no need to start a transaction by hand, since the pkg does it
+    # automagically for you (hence you need to call db.commit())
+    # Source: https://stackoverflow.com/a/52723551
+    repo(db).remove_products(products)
+
+
+# Max amount of stock shards per product, see stock.py. More shards than there
+# are checkouts running at the same time won't help anyway.
+MAX_STOCK_SHARDS = 64
+
+
+# Checks the values of a product and returns an error message for the first bad
+# value, or None if everything looks ok.
+# Only the values present in param are checked, which allows the bulk updates
+# to reuse the same rules for partial products (ie. only a new price).
+def validate_product(param):
+    # NaN and inf passes all the range checks below, since every comparison
+    # with NaN is False
+    for name, value in param.items():
+        if isinstance(value, float) and not math.isfinite(value):
+            return "Product " + name + " must be a finite number."
+    if "price" in param and ((param["price"] < 1) or (param["price"] > 9999)):
+        return "Product price is out of range."
+    if "in_stock" in param and param["in_stock"] < 1:
+        return "Product stock can't be less than one."
+    if "stock_shards" in param and ((param["stock_shards"] < 0) or (param["stock_shards"] > MAX_STOCK_SHARDS)):
+        return "Product stock shards is out of range."
+    if "standard" in param and param["standard"] < 1:
+        return "Product standard can't be less than one."
+    if "length" in param and ((param["length"] < 0.1) or (param["length"] > 999)):
+        return "Product length is out of range."
+    if "color" in param and len(param["color"]) < 1:
+        return "Product color is missing."
+    if "color" in param and len(param["color"]) > 10:
+        return "Product color is too long."
+    if "idcon1" in param and param["idcon1"] < 1:
+        return "Product connector1 is missing."
+    if "idcon2" in param and param["idcon2"] < 1:
+        return "Product connector2 is missing."
+    return None
+
+
+# Max amount of rows sent per statement (and committed per transaction) during
+# the bulk imports/updates. Big enough to load thousands of rows per second, small
+# enough to not hold the table locks for too long or hit max_allowed_packet.
+BULK_CHUNK_SIZE = 1000
+
+# Columns allowed in a bulk import and their types. Same as the "new product" form.
+BULK_IMPORT_COLUMNS = {
+    "price": int,
+    "in_stock": int,
+    "standard": float,
+    "length": float,
+    "color": str,
+    "idcon1": int,
+    "idcon2": int,
+}
+
+# Columns allowed in a bulk update. Only idproduct is required, the rest can be
+# left out (or empty) to keep the product's current value.
+BULK_UPDATE_COLUMNS = {
+    "price": int,
+    "in_stock": int,
+    "color": str,
+}
+
+
+# Converts a single value from a CSV or JSON file to "kind" (int, float or str).
+# Stricter than calling kind(value): JSON numbers like 1.5 aren't cut down to an
+# int, true/false aren't numbers and NaN/inf aren't allowed.
+# Raises a ValueError (or TypeError, ie. for lists) if the value is bad.
+def parse_value(value, kind):
+    if kind is not str and isinstance(value, (bool, list, dict)):
+        raise TypeError("Not a number")
+    if kind is int and isinstance(value, float) and not value.is_integer():
+        raise ValueError("Not an integer")
+    value = kind(value)
+    if kind is float and not math.isfinite(value):
+        raise ValueError("Not a finite number")
+    return value
+
+
+# Converts a raw row (from a CSV or JSON file) into a product dict, using the
+# types from the columns above. Raises a ValueError if a value is bad.
+def parse_product_row(row, columns, required):
+    param = {}
+    for name, kind in columns.items():
+        value = row.get(name)
+        if value is None or str(value).strip() == "":
+            if required:
+                raise ValueError("Missing value for " + name)
+            continue
+        try:
+            param[name] = parse_value(value, kind)
+        except (TypeError, ValueError):
+            raise ValueError("Bad value for " + name + ": " + str(value))
+    if "color" in param:
+        param["color"] = param["color"].strip().lower()
+    return param
+
+
+# Reads all rows from an uploaded CSV or JSON file.
+# JSON files must contain a list of objects, CSV files must have a header row.
+def read_product_file(file):
+    if file.filename.lower().endswith(".json"):
+        rows = json.load(file.stream)
+        if not isinstance(rows, list):
+            raise ValueError("JSON file must contain a list of products")
+        return rows
+    # The uploaded file is opened in binary mode, so it has to be wrapped for
+    # the csv reader. Source: https://stackoverflow.com/a/16780733
+    text = io.TextIOWrapper(file.stream, encoding="utf-8-sig")
+    return list(csv.DictReader(text))
+
+
+# Splits a list into smaller lists of max size n.
+def chunks(items, n):
+    for i in range(0, len(items), n):
+        yield items[i : i + n]
+
+
+# Inserts many new products, using a single multi-row INSERT per chunk.
+# Each chunk is committed by itself so a bad chunk won't undo the earlier ones.
+# If a chunk fails, its rows are inserted again one by one, so only the bad rows
+# are reported (and the good ones in the same chunk are still added).
+# "rows" is a list of (row number, product) tuples. Returns the amount of inserted
+# products and a list of (row number, error) tuples.
+def bulk_add_products(db, rows):
+    added = 0
+    errors = []
+    for chunk in chunks(rows, BULK_CHUNK_SIZE):
+        try:
+            insert_products(db, [p for _, p in chunk])
+            db.commit()
+            added += len(chunk)
+            continue
+        except mysql.connector.Error:
+            db.rollback()
+        for num, p in chunk:
+            try:
+                insert_products(db, [p])
+                db.commit()
+                added += 1
+            except mysql.connector.Error as err:
+                db.rollback()
+                errors.append((num, "Database error: " + str(err)))
+    return added, errors
+
+
+# A single INSERT for all the products, without committing
+def insert_products(db, products):
+    values = []
+    for p in products:
+        values.extend([p["price"], p["in_stock"], p["standard"], p["length"], p["color"], p["idcon1"], p["idcon2"]])
+    marks = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(products))
+    with db.cursor() as cur:
+        cur.execute(
+            "INSERT INTO Products(price, in_stock, standard, length, color, idconnector1, idconnector2) "
+            "VALUES " + marks + ";",
+            values,
+        )
+
+
+# Updates price/stock/color for many products, using a single UPDATE per chunk.
+# The UPDATE picks each product's new value with a CASE, which is the classic way
+# of updating many rows with different values in one go.
+# Source: https://stackoverflow.com/a/3466
+def bulk_update_products(db, rows):
+    updated = 0
+    errors = []
+    for chunk in chunks(rows, BULK_CHUNK_SIZE):
+        ids = [p["idproduct"] for _, p in chunk]
+        marks = ", ".join(["%s"] * len(ids))
+        try:
+            with db.cursor() as cur:
+                # Find which products exist first, so missing ones can be reported
+                cur.execute("SELECT idproduct FROM Products WHERE idproduct IN (" + marks + ");", ids)
+                existing = set(row[0] for row in cur.fetchall())
+                found = [p for _, p in chunk if p["idproduct"] in existing]
+                if len(found) > 0:
+                    sets = []
+                    values = []
+                    for name in BULK_UPDATE_COLUMNS:
+                        cases = [p for p in found if name in p]
+                        if len(cases) < 1:
+                            continue
+                        whens = " WHEN %s THEN %s" * len(cases)
+                        sets.append(name + " = CASE idproduct" + whens + " ELSE " + name + " END")
+                        for p in cases:
+                            values.extend([p["idproduct"], p[name]])
+                    values.extend(p["idproduct"] for p in found)
+                    marks = ", ".join(["%s"] * len(found))
+                    cur.execute(
+                        "UPDATE Products SET " + ", ".join(sets) + " WHERE idproduct IN (" + marks + ");",
+                        values,
+                    )
+                    # The sharded products keeps their stock in other rows, see stock.py
+                    stock.reset_shards(db, [p["idproduct"] for p in found if "in_stock" in p])
+            db.commit()
+        except mysql.connector.Error as err:
+            db.rollback()
+            errors.extend((num, "Database error: " + str(err)) for num, _ in chunk)
+            continue
+        updated += len(found)
+        for num, p in chunk:
+            if p["idproduct"] not in existing:
+                errors.append((num, "Unknown product ID " + str(p["idproduct"])))
+    return updated, errors
+
+
+# Returns the (UTC) date for an order timestamp, used as the key for the rollups.
+def sales_day(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).date()
+
+
+# Adds a newly placed order to the sales rollup tables (see SalesDaily and
+# SalesDays in the schema). "products" are the order's items, with amount and price.
+def add_sales_rollups(db, products, timestamp):
+    if len(products) < 1:
+        return
+    day = sales_day(timestamp)
+    units = defaultdict(int)
+    revenue = defaultdict(int)
+    for p in products:
+        units[p["idproduct"]] += p["amount"]
+        revenue[p["idproduct"]] += p["amount"] * p["price"]
+
+    values = []
+    for id in units:
+        values.extend([day, id, units[id], revenue[id]])
+    marks = ", ".join(["(%s, %s, %s, %s)"] * len(units))
+    params = {"day": day, "units": sum(units.values()), "revenue": sum(revenue.values())}
+    with db.cursor() as cur:
+        # The "AS new" alias allows the UPDATE part to reference the inserted values.
+        # Source: https://dev.mysql.com/doc/refman/8.0/en/insert-on-duplicate.html
+        cur.execute(
+            "INSERT INTO SalesDaily (day, idproduct, units, revenue) VALUES "
+            + marks
+            + " AS new ON DUPLICATE KEY UPDATE units = SalesDaily.units + new.units,"
+            + " revenue = SalesDaily.revenue + new.revenue;",
+            values,
+        )
         cur.execute(
             """
-            SELECT
-                p.*,
-                c1.gender as "c1gender", c1.type as "c1type",
-                c2.gender as "c2gender", c2.type as "c2type"
-            FROM
-                (SELECT * FROM Products LIMIT %(limit)s) AS p
-                JOIN Connectors c1 ON p.idconnector1 = c1.idconnector
-                JOIN Connectors c2 ON p.idconnector2 = c2.idconnector
-            ORDER BY p.idproduct ASC;
+            INSERT INTO SalesDays (day, orders, units, revenue)
+            VALUES (%(day)s, 1, %(units)s, %(revenue)s)
+            ON DUPLICATE KEY UPDATE orders = orders + 1, units = units + %(units)s, revenue = revenue + %(revenue)s;
         """,
             params,
         )
-        rows = cur.fetchall()
-    return rows
 
 
-# get a single product
-def get_product(db, id):
-    param = {"idproduct": id}
-    with db.cursor(dictionary=True) as cur:
-        # Query stolen from above.
+# Recreates the sales rollups from scratch, using all orders (current and archived).
+# This is a heavy query so it should only be run at startup or off-hours,
+# by running: flask --app backend rollups
+def rebuild_sales_rollups(db):
+    with db.cursor() as cur:
+        # Make FROM_UNIXTIME() return UTC dates, same as sales_day()
+        cur.execute("SET time_zone = '+00:00';")
+        cur.execute("DELETE FROM SalesDaily;")
+        cur.execute("DELETE FROM SalesDays;")
         cur.execute(
             """
-            SELECT
-                p.*,
-                c1.gender as "c1gender", c1.type as "c1type",
-                c2.gender as "c2gender", c2.type as "c2type"
-            FROM
-                (SELECT * FROM Products WHERE idproduct = %(idproduct)s LIMIT 1) AS p
-                JOIN Connectors c1 ON p.idconnector1 = c1.idconnector
-                JOIN Connectors c2 ON p.idconnector2 = c2.idconnector;
-            """,
-            param,
+            INSERT INTO SalesDaily (day, idproduct, units, revenue)
+            SELECT DATE(FROM_UNIXTIME(timestamp)), idproduct, SUM(amount), SUM(amount * price)
+            FROM """
+            + repository.ALL_ORDERS
+            + """
+            GROUP BY DATE(FROM_UNIXTIME(timestamp)), idproduct;
+        """
+        )
+        # Items from the same order share the same user and timestamp
+        cur.execute(
+            """
+            INSERT INTO SalesDays (day, orders, units, revenue)
+            SELECT DATE(FROM_UNIXTIME(timestamp)), COUNT(DISTINCT iduser, timestamp), SUM(amount), SUM(amount * price)
+            FROM """
+            + repository.ALL_ORDERS
+            + """
+            GROUP BY DATE(FROM_UNIXTIME(timestamp));
+        """
         )
-        row = cur.fetchone()
-    if row is None:
-        raise Exception("missing product")
-    return row
 
 
-def get_connectors(db):
+# Returns the per day totals from the rollups, between two dates (both included).
+def get_sales_days(db, start, end):
+    param = {"start": start, "end": end}
     with db.cursor(dictionary=True) as cur:
-        cur.execute("SELECT * FROM Connectors")
+        cur.execute("SELECT * FROM SalesDays WHERE day BETWEEN %(start)s AND %(end)s;", param)
         rows = cur.fetchall()
-    if rows is None:
-        raise Exception("Connector table empty")
     return rows
 
 
-def get_reviews(db, id):
-    param = {"idproduct": id}
+# Returns the per product and day totals from the rollups, between two dates.
+def get_sales_products(db, start, end):
+    param = {"start": start, "end": end}
     with db.cursor(dictionary=True) as cur:
-        cur.execute(
-            """
-            SELECT review.*, user.first_name as first_name, user.last_name as last_name
-            FROM
-                (SELECT * FROM Reviews WHERE idproduct = %(idproduct)s) as review
-                JOIN Users user on review.iduser = user.iduser;
-        """,
-            param,
-        )
+        cur.execute("SELECT * FROM SalesDaily WHERE day BETWEEN %(start)s AND %(end)s;", param)
         rows = cur.fetchall()
     return rows
 
 
-def add_product_to_cart(db, params):
-    # Adds the product to the cart using an UPSERT query.
-    # Found example of "ON DUPLICATE KEY" constraint here:
-    # https://stackoverflow.com/a/6108484
+# Returns the connector types of all products (the product table is small).
+def get_product_connectors(db):
     with db.cursor(dictionary=True) as cur:
         cur.execute(
             """
-            INSERT INTO ShoppingCarts (iduser, idproduct, amount)
-            VALUES (%(user)s, %(product)s, %(amount)s)
-            ON DUPLICATE KEY UPDATE amount = amount + %(amount)s;
-        """,
-            params,
+            SELECT p.idproduct, c1.type as "c1type", c2.type as "c2type"
+            FROM Products p
+                JOIN Connectors c1 ON p.idconnector1 = c1.idconnector
+                JOIN Connectors c2 ON p.idconnector2 = c2.idconnector;
+        """
         )
+        rows = cur.fetchall()
+    return rows
 
 
-def add_review(db, params):
-    with db.cursor(dictionary=True) as cur:
-        cur.execute(
-            """
-            INSERT INTO Reviews (iduser, idproduct, rating, comment)
-            VALUES (%(user)s, %(product)s, %(rating)s, %(comment)s)
-            ON DUPLICATE KEY UPDATE rating = %(rating)s, comment = %(comment)s;
-        """,
-            params,
-        )
+################################################################################
+# BACKGROUND JOBS
 
+# The job queue for this process, see jobs.py
+job_queue = jobs.JobQueue(connect_db, workers=int(os.getenv("JOB_WORKERS", default=4)))
 
-def add_new_product(db, param):
-    with db.cursor(dictionary=True) as cur:
-        cur.execute(
-            """
-            INSERT INTO Products(price, in_stock, standard, length, color, idconnector1, idconnector2)
-            VALUES( %(price)s, %(in_stock)s, %(standard)s, %(length)s, %(color)s, %(idcon1)s, %(idcon2)s );
-        """,
-            param,
-        )
 
+@job_queue.handler("sales_rollups")
+def job_sales_rollups(db, products, timestamp):
+    add_sales_rollups(db, products, timestamp)
 
-def update_product(db, param):
+
+@job_queue.handler("refresh_cache", db=False)
+def job_refresh_cache(paths):
+    send_cache_refreshes(paths)
+
+
+# Removes old finished jobs, so the Jobs table doesn't grow forever.
+# Failed jobs are kept so they can be looked into.
+@job_queue.handler("cleanup_jobs")
+def job_cleanup_jobs(db, days):
+    param = {"before": int(time.time()) - days * 24 * 3600}
+    with db.cursor() as cur:
+        cur.execute("DELETE FROM Jobs WHERE status = 2 AND run_after < %(before)s;", param)
+
+
+job_queue.every(3600, "cleanup_jobs", days=7)
+
+
+# Removes old checkout tokens. A retry of a checkout comes within seconds or
+# minutes, so there's no need to keep them around for long.
+@job_queue.handler("cleanup_checkouts")
+def job_cleanup_checkouts(db, days):
+    param = {"before": int(time.time()) - days * 24 * 3600}
+    with db.cursor() as cur:
+        cur.execute("DELETE FROM CheckoutTokens WHERE created < %(before)s;", param)
+
+
+job_queue.every(3600, "cleanup_checkouts", days=1)
+
+
+# Orders older than this many days are moved to the OrdersArchive table, see
+# archive_orders() and the schema.
+ORDERS_HOT_DAYS = int(os.getenv("ORDERS_HOT_DAYS", default=365))
+# How many order items are moved per transaction, to keep the locks short
+ARCHIVE_BATCH_SIZE = 5000
+
+
+# Moves old orders to the archive table, see archive_orders()
+@job_queue.handler("archive_orders")
+def job_archive_orders(db, days):
+    archive_orders(db, int(time.time()) - days * 24 * 3600)
+
+
+# The schedule is kept in the db (see jobs.py), so the archiving happens even if
+# no process stays up for long. Runs every hour, so each run only has an hour's
+# worth of orders to move.
+job_queue.every(3600, "archive_orders", days=ORDERS_HOT_DAYS)
+
+
+# Seconds between updating the shown stock of the sharded products, see stock.py
+STOCK_SYNC_SECONDS = int(os.getenv("STOCK_SYNC_SECONDS", default=30))
+
+
+# Copies the sums of the stock shards to Products.in_stock, and evens out the
+# shards that have drifted too far apart.
+@job_queue.handler("sync_stock")
+def job_sync_stock(db):
+    changed, skewed, sold_out = stock.sync(db)
+    db.commit()
+    for id in skewed:
+        # One product per transaction, to keep the locks short
+        stock.rebalance(db, id)
+        db.commit()
+    if changed:
+        stock_changed(db, changed, sold_out)
+
+
+# Evens out the shards of products that ran dry during a checkout
+@job_queue.handler("rebalance_stock")
+def job_rebalance_stock(db, ids):
+    for id in ids:
+        stock.rebalance(db, id)
+        db.commit()
+
+
+job_queue.every(STOCK_SYNC_SECONDS, "sync_stock")
+
+
+# The "frequently bought together" table, shared by all requests in this process.
+# It's built in the background when the process starts and then kept up to date
+# as new orders are placed, see recommend.py
+recommender = recommend.Recommender(k=5)
+recommender_lock = threading.Lock()
+recommender_started = False
+
+
+# Start the job workers together with the first request, so they don't start
+# when the module is only imported by the flask CLI etc.
+@app.before_request
+def start_jobs():
+    global recommender_started
+    job_queue.start()
+    # Each process keeps its own table, so the build is deferred to this
+    # process' workers instead of going through the Jobs table.
+    with recommender_lock:
+        if recommender_started:
+            return
+        recommender_started = True
+    job_queue.defer("build_recommendations")
+
+
+# Loads all orders and rebuilds the recommendations. It reads the whole Orders
+# table, so it's done once in the background rather than per request.
+def build_recommendations(db):
+    recommender.start_build()
+    users, stamps, products = [], [], []
+    with db.cursor() as cur:
+        cur.execute("SELECT iduser, timestamp, idproduct FROM " + repository.ALL_ORDERS + ";")
+        # Fetch in batches, to not keep two copies of a huge result in memory
+        while True:
+            rows = cur.fetchmany(10000)
+            if not rows:
+                break
+            for user, stamp, product in rows:
+                users.append(user)
+                stamps.append(stamp)
+                products.append(product)
+    # Items in the same order shares the same user and timestamp, so pack them
+    # together into a single order number.
+    orders = [(u << 32) | t for u, t in zip(users, stamps)]
+    recommender.build(orders, products)
+
+
+@job_queue.handler("build_recommendations")
+def job_build_recommendations(db):
+    build_recommendations(db)
+
+
+# Returns the IDs of products often bought together with the product.
+# Empty until the table has been built, the product pages just don't show any
+# related products for the first few seconds.
+def get_related_products(db, id):
+    if not recommender.built:
+        return []
+    return recommender.related(id)
+
+
+# Index of which connectors the products goes between, shared by all requests
+# in this process. Used for finding cables and chains of adapters, see compat.py
+connector_index = compat.ConnectorIndex()
+connector_index_lock = threading.Lock()
+
+
+# Returns the ends of all products, in the format used by the connector index.
+def get_product_ends(db):
     with db.cursor(dictionary=True) as cur:
         cur.execute(
             """
-            UPDATE Products SET price=%(price)s, in_stock=%(in_stock)s, standard=%(standard)s,
-            length=%(length)s, color=%(color)s, idconnector1=%(idcon1)s, idconnector2=%(idcon2)s
-            WHERE idproduct=%(idproduct)s;
-        """,
-            param,
+            SELECT p.idproduct, p.in_stock, c1.type as "c1type", c1.gender as "c1gender",
+                c2.type as "c2type", c2.gender as "c2gender"
+            FROM Products p
+                JOIN Connectors c1 ON p.idconnector1 = c1.idconnector
+                JOIN Connectors c2 ON p.idconnector2 = c2.idconnector;
+        """
         )
-
-
-def remove_products(db, products):
-    if len(products) < 1:
-        raise Exception("No products selected")
-    with db.cursor() as cur:
-        # There's no need to start a transaction by hand, since the pkg does it
-        # automagically for you (hence you need to call db.commit())
-        # Source: https://stackoverflow.com/a/52723551
-        cur.executemany("DELETE FROM Products WHERE idproduct = %s;", products)
+        rows = cur.fetchall()
+    return [product_ends(row) for row in rows]
+
+
+# Converts a product row (with connectors JOIN'ed in) to the index format.
+def product_ends(row):
+    end1 = (row["c1type"], row["c1gender"])
+    end2 = (row["c2type"], row["c2gender"])
+    return row["idproduct"], end1, end2, row["in_stock"]
+
+
+# Returns the connector index, building it first if needed.
+def get_connector_index(db):
+    if not connector_index.built:
+        with connector_index_lock:
+            if not connector_index.built:
+                connector_index.build(get_product_ends(db))
+    return connector_index
+
+
+# Base URL for the nginx cache (ie. http://nginx), used for refreshing the cached
+# pages when a product changes. Leave it unset if there's no cache in front of flask.
+CACHE_PURGE_URL = os.getenv("CACHE_PURGE_URL")
+# Sent in the X-Cache-Refresh header, nginx ignores refreshes without it.
+# Must be the same as in nginx's environment, see nginx.conf
+CACHE_REFRESH_SECRET = os.getenv("CACHE_REFRESH_SECRET")
+
+# nginx keeps one copy of a page per encoding, these must be the same as the
+# values of the $cache_encoding map in nginx.conf. Set CACHE_ENCODINGS (comma
+# separated, an empty item is the uncompressed copy) if the map is changed.
+CACHE_ENCODINGS = os.getenv("CACHE_ENCODINGS", default=",gzip,br,zstd").split(",")
+
+
+# Asks nginx to refresh its cached copies of the pages (ie. "/product/1").
+# The requests are sent by a background job, so the user doesn't have to wait
+# for them. The cache expires soon anyway, so the job isn't saved in the db.
+def refresh_cached_pages(paths):
+    if not CACHE_PURGE_URL or not CACHE_REFRESH_SECRET:
+        return
+    job_queue.defer("refresh_cache", paths=paths)
+
+
+def send_cache_refreshes(paths):
+    for path in paths:
+        for encoding in CACHE_ENCODINGS:
+            headers = {"X-Cache-Refresh": CACHE_REFRESH_SECRET, "Accept-Encoding": encoding}
+            req = urllib.request.Request(CACHE_PURGE_URL + path, headers=headers)
+            with urllib.request.urlopen(req, timeout=5) as resp:
+                resp.read()
+
+
+# Should be called after products has been added, updated or removed (and the
+# changes committed), to keep the in-memory indexes and the nginx cache up to date.
+# Use refresh=False to leave the cached pages alone, see stock_changed().
+def products_changed(db, ids, refresh=True):
+    read_cache.invalidate([("product", str(id)) for id in ids])
+    read_cache.invalidate_kind("products")
+    if refresh:
+        refresh_cached_pages(["/products"] + ["/product/" + str(id) for id in ids])
+    if not connector_index.built:
+        return
+    try:
+        rows = get_products_by_ids(db, ids)
+    except mysql.connector.Error as err:
+        print("Error updating product indexes: ", err)
+        connector_index.invalidate()
+        return
+    found = set()
+    for row in rows:
+        connector_index.set_product(*product_ends(row))
+        found.add(row["idproduct"])
+    for id in ids:
+        if id not in found:
+            connector_index.remove_product(id)
+
+
+# Same as above, for when only the stock has changed (orders, the stock sync).
+# During a sale that's all the time, and refreshing the cached pages for every
+# order would have flask render them for every order too. A few seconds old stock
+# is fine (the checkout checks it anyway), so those pages just expire on their
+# own. Only the products that just sold out ("sold_out") are refreshed right away.
+def stock_changed(db, ids, sold_out):
+    products_changed(db, ids, refresh=False)
+    if sold_out:
+        refresh_cached_pages(["/products"] + ["/product/" + str(id) for id in sold_out])
 
 
 ################################################################################
@@ -342,10 +997,15 @@ def page_register():
 
 
 @app.route("/register", methods=["POST"])
+@rate_limited("register")
 def page_register_post():
     # Get email and password from the submitted request form
     email = get_str_form("email").lower()
     pwd = get_str_form("pwd")
+    try:
+        pwd = password_hasher.hash(pwd)
+    except credentials.Busy:
+        return "Server is busy, please try again later", 503, {"Retry-After": "1"}
     db = get_db()
 
     try:
@@ -374,6 +1034,7 @@ def page_login():
 
 
 @app.route("/login", methods=["POST"])
+@rate_limited("login")
 def page_login_post():
     # Get email and password from request form
     email = get_str_form("email").lower()
@@ -381,18 +1042,32 @@ def page_login_post():
     db = get_db()
 
     try:
-        user = get_user(db, email)
-        db.close()
+        user = get_user_auth(db, email)
     except mysql.connector.Error as err:
         db.close()
         print("Error while logging in: ", err)
         return "Bad login"
-    except Exception as err:
+    try:
+        # A missing user is checked too, so it takes as long as a wrong password
+        ok = password_hasher.verify(pwd, user["password"] if user else None)
+    except credentials.Busy:
+        db.close()
+        return "Server is busy, please try again later", 503, {"Retry-After": "1"}
+    if not ok:
         db.close()
-        print("Bad login: ", err)
-        return "Incorrect email/password"
-    if user["password"] != pwd:
         return "Incorrect email/password"
+    try:
+        # Update old plaintext passwords (or hashes with a lower cost than now)
+        if password_hasher.needs_rehash(user["password"]):
+            set_user_password(db, user["iduser"], password_hasher.hash(pwd))
+            db.commit()
+    except credentials.Busy:
+        # Still a good login, the password will be hashed the next time
+        print("Too busy for updating password hash")
+    except mysql.connector.Error as err:
+        # Same as above
+        print("Error updating password hash: ", err)
+    db.close()
 
     # All ok!
     session["email"] = email
@@ -464,6 +1139,12 @@ def page_profile_update_post():
         "first_name": get_str_form("fName"),
         "last_name": get_str_form("lName"),
     }
+    # An empty password keeps the old one
+    try:
+        param["password"] = password_hasher.hash(param["password"]) if param["password"] else None
+    except credentials.Busy:
+        flash("Server is busy, please try again")
+        return redirect(url_for("page_profile"))
     # Connect to database, make sure no fields are empty and send the query
     db = get_db()
     try:
@@ -501,15 +1182,25 @@ def page_product(id):
     try:
         prod = get_product(db, id)
         reviews = get_reviews(db, id)
-        db.close()
     except Exception as err:
         db.close()
         flash("Invalid product ID.")
         return redirect(url_for("page_products"))
-    return render_template("product.html", product=prod, genders=GENDERS, reviews=reviews, iduser=session.get("id"))
+
+    # The recommendations are optional, so don't fail the page if they are missing
+    try:
+        related = get_products_by_ids(db, get_related_products(db, prod["idproduct"]))
+    except mysql.connector.Error as err:
+        print("Error getting related products: ", err)
+        related = []
+    db.close()
+    return render_template(
+        "product.html", product=prod, genders=GENDERS, reviews=reviews, related=related, iduser=session.get("id")
+    )
 
 
 @app.route("/product/<id>/review", methods=["POST"])
+@rate_limited("review")
 def page_product_review(id):
     # Validate user
     user = session.get("id")
@@ -539,6 +1230,8 @@ def page_product_review(id):
         add_review(db, params)
         db.commit()
         db.close()
+        read_cache.invalidate([("reviews", str(id))])
+        refresh_cached_pages(["/product/" + str(id)])
     except Exception as err:
         db.close()
         print("Error adding review to product: " + str(err))
@@ -550,6 +1243,7 @@ def page_product_review(id):
 
 
 @app.route("/product/<id>/buy", methods=["POST"])
+@rate_limited("buy")
 def page_product_buy(id):
     # Validate user
     user = session.get("id")
@@ -606,7 +1300,7 @@ def page_product_update(id):
 
     db = get_db()
     try:
-        prod = get_product(db, id)
+        prod = get_product(db, id, cached=False)
         conn = get_connectors(db)
         db.close()
     except Exception as err:
@@ -656,38 +1350,46 @@ def page_products_new_post():
         "color": get_str_form("color").lower(),
         "idcon1": get_int_form("idcon1"),
         "idcon2": get_int_form("idcon2"),
+        "stock_shards": get_int_form("stock_shards"),
     }
     # Perform basic validation on the values
-    if (param["price"] < 1) or (param["price"] > 9999):
-        flash("Product price is out of range.")
-        return redirect(url_for("page_products_new"))
-    if param["in_stock"] < 1:
-        flash("Product stock can't be less than one.")
-        return redirect(url_for("page_products_new"))
-    if param["standard"] < 1:
-        flash("Product standard can't be less than one.")
-        return redirect(url_for("page_products_new"))
-    if (param["length"] < 0.1) or (param["length"] > 999):
-        flash("Product length is out of range.")
-        return redirect(url_for("page_products_new"))
-    if len(param["color"]) < 1:
-        flash("Product color is missing.")
-        return redirect(url_for("page_products_new"))
-    if param["idcon1"] < 1:
-        flash("Product connector1 is missing.")
-        return redirect(url_for("page_products_new"))
-    if param["idcon2"] < 1:
-        flash("Product connector2 is missing.")
+    err = validate_product(param)
+    if err is not None:
+        flash(err)
         return redirect(url_for("page_products_new"))
+    # The stock shown in the form may be a few seconds old already (and for the
+    # sharded products up to STOCK_SYNC_SECONDS), and the items sold since then
+    # mustn't come back. So the stock is only set if it was changed in the form.
+    if param["idproduct"] > 0 and param["in_stock"] == get_int_form("old_in_stock", None):
+        param["in_stock"] = None
+
+    # Resize and save the optional product image, before touching the db
+    image = None
+    file = request.files.get("image")
+    if file is not None and file.filename != "":
+        try:
+            image = images.ingest_image(file.read())
+        except ValueError as err:
+            print("Error saving product image: ", err)
+            flash("Bad product image.")
+            return redirect(url_for("page_products_new"))
 
     db = get_db()
     try:
         if param["idproduct"] < 1:
-            add_new_product(db, param)
+            id = add_new_product(db, param)
         else:
+            id = param["idproduct"]
             update_product(db, param)
+            # Moves the new stock to the shards too, if the product is (or was)
+            # sharded. Without a new stock the shards are kept as they are,
+            # unless the amount of shards changed.
+            stock.set_shards(db, id, param["stock_shards"], param["in_stock"])
+        if image is not None:
+            set_product_image(db, id, image)
         # DONT FORGET TO COMMIT THE UPDATE/INSERT
         db.commit()
+        products_changed(db, [id])
         db.close()
     except mysql.connector.Error as err:
         db.close()
@@ -713,7 +1415,7 @@ def page_products_handle():
 
     db = get_db()
     try:
-        prods = get_products(db, limit=200)
+        prods = get_products(db, limit=200, cached=False)
         db.close()
     except mysql.connector.Error as err:
         db.close()
@@ -729,15 +1431,13 @@ def page_products_handle_post():
         flash("Insufficient permissions")
         return redirect(url_for("page_home"))
 
-    # Grabs the list of product IDs and convert each item to a tuple.
-    # the cur.executemany() in remove_products() wants a list of tuples!
-    # For an example of the list of tuples, see:
-    # https://dev.mysql.com/doc/connector-python/en/connector-python-api-mysqlcursor-executemany.html
-    products = [(id,) for id in request.form.getlist("removeproducts", type=int)]
+    # Grabs the list of product IDs, remove_products() deletes them all at once.
+    products = request.form.getlist("removeproducts", type=int)
     db = get_db()
     try:
         remove_products(db, products)
         db.commit()
+        products_changed(db, products)
         db.close()
     except Exception as err:
         db.close()
@@ -749,6 +1449,108 @@ def page_products_handle_post():
     return redirect(url_for("page_products_handle"))
 
 
+@app.route("/products/import")
+def page_products_import():
+    if session.get("role") != 1:
+        flash("Insufficient permissions")
+        return redirect(url_for("page_home"))
+    return render_template("importproducts.html")
+
+
+# Bulk import of new products, or bulk update of existing products.
+# Accepts either an uploaded CSV/JSON file (from the form) or a JSON body
+# like {"mode": "update", "products": [...]} for scripted supplier feeds.
+@app.route("/products/import", methods=["POST"])
+def page_products_import_post():
+    if session.get("role") != 1:
+        if request.is_json:
+            return jsonify(error="Insufficient permissions"), 403
+        flash("Insufficient permissions")
+        return redirect(url_for("page_home"))
+
+    try:
+        if request.is_json:
+            body = request.get_json()
+            mode = body.get("mode", "import")
+            raw = body.get("products", [])
+        else:
+            mode = get_str_form("mode", "import")
+            file = request.files.get("file")
+            if file is None or file.filename == "":
+                flash("Please select a file to upload.")
+                return redirect(url_for("page_products_import"))
+            raw = read_product_file(file)
+    except (ValueError, UnicodeDecodeError, csv.Error, AttributeError) as err:
+        if request.is_json:
+            return jsonify(error="Bad product file: " + str(err)), 400
+        flash("Bad product file: " + str(err))
+        return redirect(url_for("page_products_import"))
+
+    if mode == "update":
+        columns, required = BULK_UPDATE_COLUMNS, False
+    else:
+        columns, required = BULK_IMPORT_COLUMNS, True
+
+    db = get_db()
+    try:
+        connectors = set(c["idconnector"] for c in get_connectors(db))
+    except mysql.connector.Error as err:
+        db.close()
+        print("Error: {}".format(err))
+        if request.is_json:
+            return jsonify(error="Error while getting connectors"), 500
+        flash("Error while getting connectors")
+        return redirect(url_for("page_products_import"))
+
+    # Validate all rows before touching the db, bad rows are reported back
+    # instead of failing the whole import.
+    rows = []
+    errors = []
+    for num, row in enumerate(raw, start=1):
+        try:
+            if not isinstance(row, dict):
+                raise ValueError("Row is not an object")
+            param = parse_product_row(row, columns, required)
+            if mode == "update":
+                try:
+                    param["idproduct"] = parse_value(row.get("idproduct") or 0, int)
+                except (TypeError, ValueError):
+                    raise ValueError("Bad product ID: " + str(row.get("idproduct")))
+                if param["idproduct"] < 1:
+                    raise ValueError("Product ID is missing.")
+                if len(param) < 2:
+                    raise ValueError("Nothing to update.")
+        except ValueError as err:
+            errors.append((num, str(err)))
+            continue
+        err = validate_product(param)
+        if err is None and mode != "update":
+            if param["idcon1"] not in connectors or param["idcon2"] not in connectors:
+                err = "Unknown connector."
+        if err is not None:
+            errors.append((num, err))
+            continue
+        rows.append((num, param))
+
+    if mode == "update":
+        done, db_errors = bulk_update_products(db, rows)
+    else:
+        done, db_errors = bulk_add_products(db, rows)
+    db.close()
+    # Too many changes to update one by one, rebuild the indexes instead.
+    # The product pages will expire from the cache on their own soon enough.
+    connector_index.invalidate()
+    read_cache.invalidate_kind("product")
+    read_cache.invalidate_kind("products")
+    refresh_cached_pages(["/products"])
+    errors = sorted(errors + db_errors)
+
+    if request.is_json:
+        return jsonify(mode=mode, total=len(raw), done=done, errors=[{"row": n, "error": e} for n, e in errors])
+    flash("Successfully saved " + str(done) + " of " + str(len(raw)) + " products")
+    return render_template("importproducts.html", mode=mode, total=len(raw), done=done, errors=errors)
+
+
 ################################################################################
 # SHOPPING CART PAGES
 
@@ -798,101 +1600,145 @@ def page_cart_remove(id):
     return redirect(url_for("page_cart"))
 
 
-# Help function to get all items in shoppingcart, total price and which items exceed stock amount
-def get_shoppingcart(db):
+# Help function to get all items in shoppingcart, total price and which items exceed stock amount.
+# Use cached=False for placing the order, so it's using the current prices.
+def get_shoppingcart(db, cached=True):
     products = []
     stockProblem = []
     price = 0
     amountError = 0
-    param = {"email": session.get("email"), "id": session.get("id")}
-    with db.cursor(dictionary=True) as cur:
-        try:
-            cur.execute(
-                "SELECT idproduct, amount FROM ShoppingCarts WHERE iduser=%(id)s ;",
-                param,
-            )
-            rows = cur.fetchall()
-            for row in rows:
-                product = get_product(db, row["idproduct"])
+    try:
+        rows = repo(db).get_cart(session.get("id"))
+        for row in rows:
+            product = get_product(db, row["idproduct"], cached)
+            product["amount"] = row["amount"]
+            price += row["amount"] * product["price"]
+            products.append(product)
+            if row["amount"] > product["in_stock"]:
                 product["amount"] = row["amount"]
-                price += row["amount"] * product["price"]
-                products.append(product)
-                if row["amount"] > product["in_stock"]:
-                    product["amount"] = row["amount"]
-                    stockProblem.append(product)
-        except mysql.connector.Error as err:
-            db.close()
-            print("Error: {}".format(err))
-            raise Exception("Error while getting shoppingcart")
+                stockProblem.append(product)
+    except mysql.connector.Error as err:
+        db.close()
+        print("Error: {}".format(err))
+        raise Exception("Error while getting shoppingcart")
     return products, price, stockProblem
 
 
 # Help function to empty the shoppingcart, will happen once everything has been moved to the order table
 def empty_shoppingcart(db):
-    param = {"email": session.get("email"), "id": session.get("id")}
-    with db.cursor(dictionary=True) as cur:
-        try:
-            cur.execute("DELETE FROM ShoppingCarts WHERE iduser=%(id)s;", param)
-        except mysql.connector.Error as err:
-            db.close()
-            print("Error: {}".format(err))
-            raise Exception("Error while emptying shoppingcart")
+    try:
+        repo(db).empty_cart(session.get("id"))
+    except mysql.connector.Error as err:
+        db.close()
+        print("Error: {}".format(err))
+        raise Exception("Error while emptying shoppingcart")
     return
 
 
 def remove_one_shoppingcart(db, product, user):
-    param = {"product": product, "user": user}
-    with db.cursor(dictionary=True) as cur:
-        try:
-            cur.execute("SELECT amount FROM ShoppingCarts WHERE (iduser=%(user)s AND idproduct=%(product)s);", param)
-            row = cur.fetchone()
-            amount = row["amount"]
-            if amount > 1:
-                param["new_amount"] = amount - 1
-                cur.execute(
-                    "UPDATE ShoppingCarts SET amount=%(new_amount)s WHERE (idProduct=%(product)s AND iduser=%(user)s);",
-                    param,
-                )
-            else:
-                cur.execute(
-                    "DELETE FROM ShoppingCarts WHERE (iduser=%(user)s AND idproduct=%(product)s) LIMIT 1;", param
-                )
-        except mysql.connector.Error as err:
-            db.close()
-            print("Error: {}".format(err))
-            raise Exception("Error while emptying shoppingcart")
+    try:
+        repo(db).remove_one_from_cart(product, user)
+    except mysql.connector.Error as err:
+        db.close()
+        print("Error: {}".format(err))
+        raise Exception("Error while emptying shoppingcart")
     return
 
 
-# Help function to reduce in_stock, should happen once for every item in shopping cart
-def reduce_stock(db, id, amount):
+# Help function to reduce the stock, should happen once for every item in shopping cart.
+# "prod" is the product row from the cart. Returns True if the product's stock
+# shards should be rebalanced, see stock.py
+def reduce_stock(db, prod, amount):
+    try:
+        return stock.take(db, prod["idproduct"], amount, prod["stock_shards"])
+    except Exception as err:
+        db.close()
+        # flash("Error: {}".format(err))
+        raise Exception("Error occured while reducing stock.")
+
+
+# Checkout tokens makes placing an order idempotent. Every checkout page gets a
+# new random token in its form, and the token is saved together with the order.
+# If the same form is sent again (double clicks, the browser retrying after a
+# timeout etc.) the saved order is shown again, instead of placing a new one.
+def new_checkout_token():
+    return secrets.token_urlsafe(32)
+
+
+# Returns the order placed with a token as (products, price, stockProblem), the
+# same as place_order(), or None if the token hasn't been used by the user.
+def get_checkout(db, token, user):
+    param = {"token": token, "user": user}
     with db.cursor(dictionary=True) as cur:
+        cur.execute(
+            "SELECT timestamp, price FROM CheckoutTokens WHERE token = %(token)s AND iduser = %(user)s;",
+            param,
+        )
+        checkout = cur.fetchone()
+        if checkout is None:
+            return None
+        param["timestamp"] = checkout["timestamp"]
+        cur.execute(
+            """
+            SELECT idproduct, amount, price FROM Orders
+            WHERE iduser = %(user)s AND timestamp = %(timestamp)s;
+        """,
+            param,
+        )
+        items = cur.fetchall()
+    products = get_products_by_ids(db, [item["idproduct"] for item in items])
+    found = {item["idproduct"]: item for item in items}
+    for product in products:
+        product["amount"] = found[product["idproduct"]]["amount"]
+        product["price"] = found[product["idproduct"]]["price"]
+    return products, checkout["price"], []
+
+
+# Saves a token for a new order, without committing. Returns False if the token
+# has been used already.
+# If another request is placing an order with the same token right now, the
+# insert waits for that transaction to finish (the primary key is locked) and
+# then fails, so the order can't be placed twice.
+def add_checkout(db, token, user, timestamp, price):
+    param = {"token": token, "user": user, "timestamp": timestamp, "price": price, "created": int(time.time())}
+    with db.cursor() as cur:
         try:
-            # Get the specific product
-            prod = get_product(db, id)
-            # Check if in_stock - amount < 0
-            new_stock = prod["in_stock"] - amount
-            if new_stock < 0:
-                raise Exception("Too few items in stock.")
-            param = {"idProduct": id, "new_stock": new_stock}
-            cur.execute("UPDATE Products SET in_stock=%(new_stock)s WHERE idProduct=%(idProduct)s ;", param)
-        except Exception as err:
-            db.close()
-            # flash("Error: {}".format(err))
-            raise Exception("Error occured while reducing stock.")
-    return
+            cur.execute(
+                """
+                INSERT INTO CheckoutTokens (token, iduser, timestamp, price, created)
+                VALUES (%(token)s, %(user)s, %(timestamp)s, %(price)s, %(created)s);
+            """,
+                param,
+            )
+        except mysql.connector.IntegrityError as err:
+            if err.errno == mysql.connector.errorcode.ER_DUP_ENTRY:
+                return False
+            raise
+    return True
 
 
 # Help function to place order (move from shoppingcart to orders)
-def place_order(db):
+def place_order(db, token):
     products = []
     # Using a standardized time to simplify grouping of an order's items
     epoch_time = int(time.time())
     param = {"email": session.get("email"), "id": session.get("id")}
+    # The order has been placed already, send back the same result again
+    checkout = get_checkout(db, token, param["id"])
+    if checkout is not None:
+        return checkout
+    rebalance = []
     with db.cursor(dictionary=True) as cur:
         try:
             # Get products in cart, the total price and any items exceeding stock amount.
-            products, price, stockProblem = get_shoppingcart(db)
+            products, price, stockProblem = get_shoppingcart(db, cached=False)
+            if not add_checkout(db, token, param["id"], epoch_time, price):
+                # Lost the race against another request with the same token
+                db.rollback()
+                checkout = get_checkout(db, token, param["id"])
+                if checkout is None:
+                    raise Exception("Checkout token belongs to another user")
+                return checkout
             for prod in products:
                 # Add parameters like timestamp and iduser which wasnt present in "product"
                 prod["timestamp"] = epoch_time
@@ -906,14 +1752,31 @@ def place_order(db):
                     prod,
                 )
                 # Reduce stock of said product
-                reduce_stock(db, prod["idproduct"], prod["amount"])
+                if reduce_stock(db, prod, prod["amount"]):
+                    rebalance.append(prod["idproduct"])
             # If all the products pass, empty the shoppingcarts table of entries with current users id
             empty_shoppingcart(db)
+            # The sales stats are updated later by a background job, so the user
+            # doesn't have to wait for it. The job is saved in the same transaction
+            # as the order, so it can't get lost.
+            items = [{"idproduct": p["idproduct"], "amount": p["amount"], "price": p["price"]} for p in products]
+            job = job_queue.enqueue(db, "sales_rollups", products=items, timestamp=epoch_time)
             db.commit()
         except Exception as err:
             db.close()
             # flash("Error: {}".format(err))
             raise Exception("Error occured while moving from shoppingcart to order.")
+    job_queue.submit(job)
+    if rebalance:
+        job_queue.defer("rebalance_stock", ids=rebalance)
+
+    # And let the recommendations know about the new order
+    # (the order number is packed the same way as in build_recommendations())
+    recommender.add_order([p["idproduct"] for p in products], (param["id"] << 32) | epoch_time)
+    # The stock was changed for all products in the order. The stock of the
+    # sharded products is shown from in_stock, which is updated by the stock sync.
+    sold_out = [p["idproduct"] for p in products if p["stock_shards"] == 0 and p["amount"] >= p["in_stock"]]
+    stock_changed(db, [p["idproduct"] for p in products], sold_out)
     return products, price, stockProblem
 
 
@@ -944,20 +1807,32 @@ def page_checkout():
     if len(products) == 0:
         flash("No items in shopping cart, please add some items before checking out")
         return redirect(url_for("page_products"))
-    return render_template("checkout.html", products=products, genders=GENDERS, stockProblem=stockProblem, price=price)
+    return render_template(
+        "checkout.html",
+        products=products,
+        genders=GENDERS,
+        stockProblem=stockProblem,
+        price=price,
+        token=new_checkout_token(),
+    )
 
 
 @app.route("/checkout", methods=["POST"])
+@rate_limited("checkout")
 def page_checkout_order():
     # Make sure they're logged in before trying to reach checkout page
     if session.get("email") is None:
         flash("Please log in before trying to checkout")
         return redirect(url_for("page_home"))
+    token = get_str_form("token")
+    if len(token) < 16 or len(token) > 64:
+        flash("The checkout has expired, please try again")
+        return redirect(url_for("page_checkout"))
     db = get_db()
     try:
         # Try to place all items from users shoppingcart into an order
         # remove them from shoppingcart and reduce inventory stock.
-        products, price, stockProblem = place_order(db)
+        products, price, stockProblem = place_order(db, token)
         db.close()
     except:
         flash("Error occured while placing order, check amounts")
@@ -969,19 +1844,111 @@ def page_checkout_order():
 ################################################################################
 # ORDER HISTORY PAGES
 
-def get_customer_orders(db, user):
-    param = {"user": user}
+# Returns the timestamp of the newest archived order, or -1 if the archive is empty.
+def newest_archived_order(db):
+    with db.cursor() as cur:
+        # Only reads the end of the timestamp index
+        cur.execute("SELECT MAX(timestamp) FROM OrdersArchive;")
+        newest = cur.fetchone()[0]
+    return -1 if newest is None else newest
+
+
+# Returns the tables holding orders made from "start" (unix time, None for the
+# beginning of time) and onwards. The archive is skipped when it can't have any
+# matching rows, like the partition pruning a partitioned table would do.
+# Orders is always included, since it can still have old orders if the archive
+# job hasn't run yet.
+def order_tables(db, start=None):
+    if start is None or start <= newest_archived_order(db):
+        return ["Orders", "OrdersArchive"]
+    return ["Orders"]
+
+
+# Returns the order items between start and end (unix times, end not included,
+# None for no limit), optionally only the ones for a single user.
+# Newest orders first.
+def get_orders(db, start=None, end=None, user=None):
+    param = {"start": start, "end": end, "user": user}
+    where = []
+    if start is not None:
+        where.append("timestamp >= %(start)s")
+    if end is not None:
+        where.append("timestamp < %(end)s")
+    if user is not None:
+        where.append("iduser = %(user)s")
+    where = (" WHERE " + " AND ".join(where)) if where else ""
+    selects = [
+        "SELECT iduser, idproduct, amount, price, timestamp FROM " + table + where for table in order_tables(db, start)
+    ]
     with db.cursor(dictionary=True) as cur:
-        cur.execute("SELECT * FROM Orders WHERE iduser = %(user)s ORDER BY timestamp DESC;", param)
+        cur.execute(" UNION ALL ".join(selects) + " ORDER BY timestamp DESC;", param)
         rows = cur.fetchall()
     return rows
 
-def get_all_orders(db):
-    #param = {"user": user}
-    with db.cursor(dictionary=True) as cur:
-        cur.execute("SELECT * FROM Orders ORDER BY timestamp DESC;")
-        rows = cur.fetchall()
-    return rows
+
+def get_customer_orders(db, user):
+    return get_orders(db, user=user)
+
+
+def get_all_orders(db, start, end):
+    return get_orders(db, start=start, end=end)
+
+
+# Groups order items by their order (the order's date), with the product's info
+# added to each item.
+def group_orders(db, items):
+    products = get_products_by_ids(db, list({row["idproduct"] for row in items}))
+    products = {p["idproduct"]: p for p in products}
+    # Creates a new dict whose default value (for keys) are lists
+    orders = defaultdict(list)
+    for row in items:
+        if row["idproduct"] not in products:
+            # The product has been removed, only the archive keeps its orders
+            continue
+        product = dict(products[row["idproduct"]])
+        product["iduser"] = row["iduser"]
+        product["price"] = row["price"]
+        product["amount"] = row["amount"]
+        key = datetime.fromtimestamp(row["timestamp"])
+        orders[key].append(product)
+    return orders
+
+
+# Moves all orders made before "before" (unix time) from Orders to OrdersArchive.
+# It's done in small batches, each batch in its own transaction. All items of an
+# order has the same timestamp, so an order is always moved as a whole.
+# Returns the amount of moved items.
+def archive_orders(db, before, batch=ARCHIVE_BATCH_SIZE):
+    moved = 0
+    with db.cursor() as cur:
+        while True:
+            param = {"before": before, "batch": batch}
+            # Find the timestamp that ends this batch, using the timestamp index
+            cur.execute(
+                """
+                SELECT timestamp FROM Orders WHERE timestamp < %(before)s
+                ORDER BY timestamp LIMIT 1 OFFSET %(batch)s;
+            """,
+                param,
+            )
+            row = cur.fetchone()
+            if row is not None:
+                param["before"] = row[0] + 1
+            cur.execute(
+                """
+                INSERT INTO OrdersArchive (iduser, idproduct, amount, price, timestamp)
+                SELECT iduser, idproduct, amount, price, timestamp FROM Orders
+                WHERE timestamp < %(before)s;
+            """,
+                param,
+            )
+            cur.execute("DELETE FROM Orders WHERE timestamp < %(before)s;", param)
+            moved += cur.rowcount
+            db.commit()
+            if row is None:
+                break
+    return moved
+
 
 @app.route("/orders")
 def page_customer_orders():
@@ -993,15 +1960,7 @@ def page_customer_orders():
     db = get_db()
     try:
         items = get_customer_orders(db, user)
-        print(items)
-        # Creates a new dict whose default value (for keys) are lists
-        orders = defaultdict(list)
-        for row in items:
-            product = get_product(db, row["idproduct"])
-            product["price"] = row["price"]
-            product["amount"] = row["amount"]
-            key = datetime.fromtimestamp(row["timestamp"])
-            orders[key].append(product)
+        orders = group_orders(db, items)
         db.close()
     except Exception as err:
         print("Error getting orders/products: " + str(err))
@@ -1019,28 +1978,194 @@ def page_admin_orders():
     if session.get("role") != 1:
         flash("Insufficient permissions")
         return redirect(url_for("page_home"))
-    print(user)
+    # Show the last 30 days by default
+    days = get_int_param("days", 30)
+    if (days < 1) or (days > 3660):
+        days = 30
+    start = int(time.time()) - days * 24 * 3600
     db = get_db()
     try:
-        items = get_all_orders(db)
-        print(items)
-        # Creates a new dict whose default value (for keys) are lists
-        orders = defaultdict(list)
-        for row in items:
-            product = get_product(db, row["idproduct"])
-            product["iduser"] = row["iduser"]
-            product["price"] = row["price"]
-            product["amount"] = row["amount"]
-            key = datetime.fromtimestamp(row["timestamp"])
-            orders[key].append(product)
+        items = get_all_orders(db, start, None)
+        orders = group_orders(db, items)
         db.close()
     except Exception as err:
         print("Error getting orders/products: " + str(err))
         flash("Error occured while getting order history")
         return redirect(url_for("page_home"))
 
-    return render_template("adminorders.html", orders=orders, genders=GENDERS)
+    return render_template("adminorders.html", orders=orders, genders=GENDERS, days=days)
+
+
 ################################################################################
+# COMPATIBILITY PAGES
+
+
+# Finds all cables going directly between two connectors, and the shortest chain
+# of cables if there's no direct match.
+# Returns the list of direct products and the list of products in the chain.
+def find_compatible(db, id1, id2, max_cables):
+    connectors = {c["idconnector"]: (c["type"], c["gender"]) for c in get_connectors(db)}
+    if id1 not in connectors or id2 not in connectors:
+        raise ValueError("Unknown connector")
+    index = get_connector_index(db)
+    direct = index.find_direct(connectors[id1], connectors[id2])
+    chain = []
+    if len(direct) < 1:
+        chain = index.find_chain(connectors[id1], connectors[id2], max_cables=max_cables)
+    return get_products_by_ids(db, direct), get_products_by_ids(db, chain)
+
+
+@app.route("/compatibility")
+def page_compatibility():
+    id1 = get_int_param("from")
+    id2 = get_int_param("to")
+    db = get_db()
+    try:
+        conn = get_connectors(db)
+        direct, chain = [], []
+        if id1 > 0 and id2 > 0:
+            direct, chain = find_compatible(db, id1, id2, max_cables=3)
+        db.close()
+    except ValueError:
+        db.close()
+        flash("Unknown connector.")
+        return redirect(url_for("page_compatibility"))
+    except mysql.connector.Error as err:
+        db.close()
+        print("Error finding compatible products: ", err)
+        flash("Error while finding compatible products")
+        return redirect(url_for("page_home"))
+    return render_template(
+        "compatibility.html", connectors=conn, genders=GENDERS, id1=id1, id2=id2, direct=direct, chain=chain
+    )
+
+
+# Same as above, but returns JSON. Example: /api/compatibility?from=1&to=4
+@app.route("/api/compatibility")
+def api_compatibility():
+    id1 = get_int_param("from")
+    id2 = get_int_param("to")
+    max_cables = get_int_param("max", 3)
+    if (max_cables < 1) or (max_cables > 5):
+        return jsonify(error="max must be between 1 and 5"), 400
+    db = get_db()
+    try:
+        direct, chain = find_compatible(db, id1, id2, max_cables)
+        db.close()
+    except ValueError:
+        db.close()
+        return jsonify(error="Unknown connector"), 400
+    except mysql.connector.Error as err:
+        db.close()
+        print("Error finding compatible products: ", err)
+        return jsonify(error="Internal server error"), 500
+    return jsonify(direct=direct, chain=chain)
+
+
+################################################################################
+# ADMIN PAGES
+
+
+@app.route("/adminanalytics")
+def page_admin_analytics():
+    if session.get("role") != 1:
+        flash("Insufficient permissions")
+        return redirect(url_for("page_home"))
+
+    # Show the last 90 days by default
+    days = get_int_param("days", 90)
+    if (days < 1) or (days > 3660):
+        days = 90
+    end = datetime.now(timezone.utc).date()
+    start = end - timedelta(days=days - 1)
+
+    db = get_db()
+    try:
+        sales = get_sales_days(db, start, end)
+        prods = get_sales_products(db, start, end)
+        connectors = get_product_connectors(db)
+        db.close()
+    except mysql.connector.Error as err:
+        db.close()
+        print("Error getting sales stats: ", err)
+        flash("Error occured while getting sales stats")
+        return redirect(url_for("page_home"))
+
+    stats = {
+        "days": days,
+        "orders": int(analytics.column(sales, "orders").sum()),
+        "units": int(analytics.column(sales, "units").sum()),
+        "revenue": int(analytics.column(sales, "revenue").sum()),
+        "basket_size": analytics.basket_size(sales),
+        "per_day": analytics.per_day(sales, "revenue", start, end),
+        "per_week": analytics.per_week(sales, ["orders", "units", "revenue"], start, end),
+        "top_products": analytics.top_products(prods),
+        "connectors": analytics.units_per_connector(prods, connectors),
+    }
+    return render_template("adminanalytics.html", stats=stats)
+
+
+# Stats for the merged and cached reads (see read_cache), for this process only
+@app.route("/api/admin/readcache")
+def api_admin_read_cache():
+    if session.get("role") != 1:
+        return jsonify(error="Insufficient permissions"), 403
+    return jsonify(read_cache.metrics())
+
+
+# Flask CLI command for rebuilding the sales rollups, run it with:
+# flask --app backend rollups
+# Source: https://flask.palletsprojects.com/en/stable/cli/#custom-commands
+@app.cli.command("rollups")
+def cli_rollups():
+    db = open_db()
+    rebuild_sales_rollups(db)
+    db.commit()
+    db.close()
+
+
+# Flask CLI command for archiving old orders right away, instead of waiting for
+# the daily job. Run it with: flask --app backend archive [days]
+@app.cli.command("archive")
+@click.argument("days", type=int, default=ORDERS_HOT_DAYS)
+def cli_archive(days):
+    db = open_db()
+    moved = archive_orders(db, int(time.time()) - days * 24 * 3600)
+    db.close()
+    print("Archived", moved, "order items older than", days, "days")
+
+
+# Flask CLI command for turning on sharded stock for a popular product (see
+# stock.py), ie. before a big sale. SHARDS=0 turns it off again.
+# Run it with: flask --app backend shard-stock ID [SHARDS]
+@app.cli.command("shard-stock")
+@click.argument("id", type=int)
+@click.argument("shards", type=click.IntRange(0, MAX_STOCK_SHARDS), default=stock.DEFAULT_SHARDS)
+def cli_shard_stock(id, shards):
+    db = open_db()
+    found = stock.set_shards(db, id, shards)
+    db.commit()
+    db.close()
+    if not found:
+        print("No product with ID", id)
+        return
+    refresh_cached_pages(["/product/" + str(id)])
+    print("Product", id, "now has", shards, "stock shards")
+
+
+# Flask CLI command for compiling all templates into the bytecode cache, as a
+# build step. Run it with: flask --app backend precompile
+@app.cli.command("precompile")
+def cli_precompile():
+    print("Compiled", load_templates(), "templates into", TEMPLATE_CACHE_DIR)
+
+
+################################################################################
+
+# Warm up the templates before the worker starts taking any requests, unless
+# it's turned off with TEMPLATE_WARMUP=0
+if os.getenv("TEMPLATE_WARMUP", default="1") == "1":
+    load_templates()
 
 if __name__ == "__main__":
     # Delay the backend startup when it's being run inside docker,
@@ -0,0 +1,46 @@
+import os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+# Benchmark for the password hashing used by the logins (see credentials.py).
+# Measures how many logins per second one cpu core can check, and how it scales
+# with the amount of hashing processes. No db needed.
+#
+# Run it with: python3.11 benchmarks/bench_login.py [cost] [logins]
+
+# Allow importing the modules from the project root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import credentials
+
+
+def run(workers, cost, stored, logins):
+    hasher = credentials.Hasher(workers=workers, cost=cost, max_waiting=logins)
+    # Start the processes before the timing
+    hasher.run(credentials.calibrate, 0)
+    # Lots of request threads logging in at the same time
+    with ThreadPoolExecutor(max_workers=workers * 4) as pool:
+        start = time.perf_counter()
+        results = list(pool.map(lambda _: hasher.verify("hunter2", stored), range(logins)))
+        took = time.perf_counter() - start
+    hasher.executor.shutdown()
+    assert all(results)
+    return logins / took
+
+
+def main():
+    cost = int(sys.argv[1]) if len(sys.argv) > 1 else credentials.calibrate()
+    logins = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    stored = credentials.hash_password("hunter2", cost)
+
+    start = time.perf_counter()
+    credentials.verify_password("hunter2", stored)
+    print("cost: 2^{}, one hash: {:.1f} ms".format(cost, (time.perf_counter() - start) * 1000))
+
+    workers = 1
+    while workers <= os.cpu_count():
+        rate = run(workers, cost, stored, logins)
+        print("{:3} workers: {:7.1f} logins/s, {:6.1f} logins/s per core".format(workers, rate, rate / workers))
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
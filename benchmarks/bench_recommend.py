@@ -0,0 +1,55 @@
+import os, sys, time, random
+
+import numpy as np
+
+# Benchmark for the "frequently bought together" recommendations.
+# Measures the time to build the table from 1M orders, the latency of a single
+# lookup and of adding a new order. No db needed, the orders are made up.
+#
+# Run it with: python3.11 benchmarks/bench_recommend.py [orders] [products]
+
+# Allow importing the modules from the project root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import recommend
+
+
+# Makes up some orders with 1-5 items each. Some products are a lot more popular
+# than others (zipf distributed), like in a real shop.
+def make_orders(count, products, seed=1):
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, 6, size=count)
+    orders = np.repeat(np.arange(count), sizes)
+    items = (rng.zipf(1.3, size=len(orders)) - 1) % products + 1
+    return orders, items
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    products = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+    orders, items = make_orders(count, products)
+    print("orders: {}, order rows: {}, products: {}".format(count, len(orders), products))
+
+    rec = recommend.Recommender(k=5)
+    start = time.perf_counter()
+    rec.build(orders, items)
+    took = time.perf_counter() - start
+    print("build:      {:10.3f} s ({} pairs)".format(took, len(rec.counts)))
+
+    rng = random.Random(1)
+    ids = [rng.randint(1, products) for _ in range(100_000)]
+    start = time.perf_counter()
+    for id in ids:
+        rec.related(id)
+    took = time.perf_counter() - start
+    print("lookup:     {:10.3f} us/op".format(took / len(ids) * 1e6))
+
+    baskets = [[rng.randint(1, products) for _ in range(rng.randint(1, 5))] for _ in range(10_000)]
+    start = time.perf_counter()
+    for basket in baskets:
+        rec.add_order(basket)
+    took = time.perf_counter() - start
+    print("add order:  {:10.3f} us/op".format(took / len(baskets) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import os, sys, time, random
+
+# Benchmark for the core queries in repository.py, on an in-memory sqlite db.
+# Runs in a second or so without any mysql server, so it's quick to check if a
+# change to a query made it a lot slower. The numbers are only comparable with
+# other sqlite runs, mysql adds network round trips etc.
+#
+# Run it with: python3.11 benchmarks/bench_repository.py [products] [runs]
+
+# Allow importing the modules from the project root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import repository
+
+
+# Adds some made up products, on top of the example data
+def add_products(repo, count, seed=1):
+    rng = random.Random(seed)
+    for _ in range(count):
+        repo.add_new_product(
+            {
+                "price": rng.randint(10, 999),
+                "in_stock": rng.randint(1, 100),
+                "standard": rng.choice([1.0, 2.0, 3.0]),
+                "length": rng.choice([0.5, 1.5, 3.5]),
+                "color": rng.choice(["black", "red", "white"]),
+                "idcon1": rng.randint(1, 4),
+                "idcon2": rng.randint(1, 4),
+            }
+        )
+    repo.commit()
+
+
+def timeit(name, fn, runs):
+    start = time.perf_counter()
+    for i in range(runs):
+        fn(i)
+    took = time.perf_counter() - start
+    print("{:24} {:9.1f} us/call".format(name, took / runs * 1e6))
+
+
+def main():
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    repo = repository.connect_sqlite()
+    add_products(repo, products)
+    total = products + 16
+    print("products: {}, runs: {}".format(total, runs))
+
+    timeit("get_products(10)", lambda i: repo.get_products(10), runs)
+    timeit("get_product", lambda i: repo.get_product(i % total + 1), runs)
+    ids = list(range(1, total + 1, total // 20 or 1))[:20]
+    timeit("get_products_by_ids(20)", lambda i: repo.get_products_by_ids(ids), runs)
+    timeit("get_reviews", lambda i: repo.get_reviews(1), runs)
+    timeit("get_user", lambda i: repo.get_user("humle@home"), runs)
+    cart = {"user": 2, "product": 1, "amount": 1}
+    timeit("add_product_to_cart", lambda i: repo.add_product_to_cart(cart), runs)
+    timeit("get_cart", lambda i: repo.get_cart(2), runs)
+    repo.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import os, sys, time, argparse, threading
+
+import mysql.connector
+from dotenv import load_dotenv
+
+# Contention benchmark for the stock updates during checkouts, see stock.py.
+# A number of threads keeps "buying" the same product, each in its own
+# transaction, and the checkouts/s are compared between keeping the stock in a
+# single row (shards=0) and splitting it over a number of shards.
+#
+# Each checkout holds on to its locks for a little while after taking the stock
+# (--hold), like a real checkout does while it adds the order rows, empties the
+# cart etc. That's what lines up the buyers behind the single row.
+#
+# Needs the mysql db from the .env file (the row locks are the whole point, so
+# sqlite won't do). A temporary product is added and removed again.
+#
+# Run it with: python3.11 benchmarks/bench_stock.py [--threads 32] [--shards 0 4 16]
+
+# Allow importing the modules from the project root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import stock
+
+
+def connect():
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        database=os.getenv("DB_DATABASE"),
+    )
+
+
+def add_product(db, amount):
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO Products(price, in_stock, standard, length, color, idconnector1, idconnector2)
+            VALUES (100, %s, 3.0, 1.0, 'bench', 1, 1);
+        """,
+            [amount],
+        )
+        id = cur.lastrowid
+    db.commit()
+    return id
+
+
+def remove_product(db, id):
+    with db.cursor() as cur:
+        cur.execute("DELETE FROM Products WHERE idproduct = %s;", [id])
+    db.commit()
+
+
+def buyer(id, shards, hold, stop, results, lock):
+    db = connect()
+    done, failed, latencies = 0, 0, []
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            stock.take(db, id, 1, shards)
+            time.sleep(hold)
+            db.commit()
+            done += 1
+            latencies.append(time.perf_counter() - start)
+        except (stock.OutOfStock, mysql.connector.Error):
+            # Deadlocks and lock wait timeouts ends up here
+            db.rollback()
+            failed += 1
+    db.close()
+    with lock:
+        results["done"] += done
+        results["failed"] += failed
+        results["latencies"].extend(latencies)
+
+
+def run(id, shards, args):
+    stop = threading.Event()
+    lock = threading.Lock()
+    results = {"done": 0, "failed": 0, "latencies": []}
+    threads = [
+        threading.Thread(target=buyer, args=(id, shards, args.hold / 1000, stop, results, lock))
+        for _ in range(args.threads)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    took = time.perf_counter() - start
+    latencies = sorted(results["latencies"]) or [0]
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return results["done"] / took, p95 * 1000, results["failed"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checkouts/s for single row vs sharded stock.")
+    parser.add_argument("--threads", type=int, default=32, help="amount of buyers at the same time")
+    parser.add_argument("--duration", type=int, default=10, help="seconds per run")
+    parser.add_argument("--hold", type=float, default=5, help="ms to hold the locks after taking the stock")
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 4, 8, 16, 32], help="0 is the single row")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = connect()
+    id = add_product(db, 10_000_000)
+    print("threads: {}, hold: {} ms, {} s per run".format(args.threads, args.hold, args.duration))
+    print("{:>8} {:>13} {:>9} {:>8} {:>9}".format("shards", "checkouts/s", "p95 ms", "failed", "speedup"))
+    base = None
+    try:
+        for shards in args.shards:
+            stock.set_shards(db, id, shards)
+            db.commit()
+            rate, p95, failed = run(id, shards, args)
+            if base is None:
+                base = rate
+            speedup = rate / base if base else 0
+            print("{:>8} {:>13.1f} {:>9.1f} {:>8} {:>8.1f}x".format(shards, rate, p95, failed, speedup))
+    finally:
+        remove_product(db, id)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import os, sys, json, time, shutil, tempfile, subprocess
+
+# Benchmark for the startup time of new workers, with and without the template
+# bytecode cache and warm-up (see TEMPLATE_CACHE_DIR in backend.py).
+#
+# Each run starts a brand new python process (like a new worker after a deploy)
+# and measures how long it takes to import the app, and how long the first load
+# of every template takes (which is what the first visitor of a page has to wait for).
+#
+# Run it with: python3.11 benchmarks/bench_templates.py [runs]
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+# Runs inside the new process, prints the timings as JSON
+def child():
+    start = time.perf_counter()
+    import backend
+
+    startup = time.perf_counter() - start
+    first_hits = []
+    for name in backend.app.jinja_env.list_templates():
+        start = time.perf_counter()
+        backend.app.jinja_env.get_template(name)
+        first_hits.append(time.perf_counter() - start)
+    print(json.dumps({"startup": startup, "first_hits": first_hits}))
+
+
+def run(env, runs):
+    startups, hits = [], []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, __file__, "--child"],
+            env=dict(os.environ, **env),
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        startups.append(result["startup"])
+        hits.extend(result["first_hits"])
+    return startups, hits
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, startups, hits):
+    print(
+        "{:28} startup: {:7.1f} ms   first hit p50: {:7.3f} ms   p99: {:7.3f} ms".format(
+            name,
+            sum(startups) / len(startups) * 1000,
+            percentile(hits, 50) * 1000,
+            percentile(hits, 99) * 1000,
+        )
+    )
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    cache_dir = tempfile.mkdtemp()
+    try:
+        report("no cache, no warm-up", *run({"TEMPLATE_CACHE_DIR": "", "TEMPLATE_WARMUP": "0"}, runs))
+        report("no cache, warm-up", *run({"TEMPLATE_CACHE_DIR": "", "TEMPLATE_WARMUP": "1"}, runs))
+        # Fill the cache first, like the precompile build step
+        run({"TEMPLATE_CACHE_DIR": cache_dir, "TEMPLATE_WARMUP": "1"}, 1)
+        report("bytecode cache, no warm-up", *run({"TEMPLATE_CACHE_DIR": cache_dir, "TEMPLATE_WARMUP": "0"}, runs))
+        report("bytecode cache, warm-up", *run({"TEMPLATE_CACHE_DIR": cache_dir, "TEMPLATE_WARMUP": "1"}, runs))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        sys.path.insert(0, ROOT)
+        child()
+    else:
+        main()
@@ -0,0 +1,239 @@
+import os, sys, json, time, argparse
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Generates a big, made up dataset (users, products, reviews, shopping carts and
+# orders) for load testing, see loadtest.py.
+#
+# The data is deterministic: the same seed and options always gives the same
+# rows. Like in a real shop, a few products and customers stands for most of the
+# sales (zipf distributed), and there are more orders lately than a year ago.
+#
+# The rows are added on top of the example data from the schema, so run it on a
+# freshly created db. Then update the sales rollups (and move the old orders to
+# the archive) before testing:
+#
+#   python3.11 benchmarks/gen_data.py --users 1000000 --orders 2000000
+#   flask --app backend rollups
+#   flask --app backend archive
+#
+# Use --sqlite FILE to fill a sqlite db instead (see repository.py), without the
+# mysql server.
+#
+# The IDs of the generated products (most popular first) and the amount of users
+# are saved in benchmarks/testdata.json, for loadtest.py.
+
+# Allow importing the modules from the project root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# Rows per INSERT
+CHUNK_SIZE = 5000
+
+# What loadtest.py needs to know about the generated data
+TESTDATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata.json")
+
+FIRST_NAMES = ["Alice", "Bob", "Cecilia", "David", "Elsa", "Filip", "Greta", "Hugo", "Ida", "Johan"]
+LAST_NAMES = ["Andersson", "Berg", "Ek", "Holm", "Lind", "Nilsson", "Strom", "Wik"]
+COLORS = ["black", "white", "red", "blue", "green", "grey"]
+COMMENTS = [None, "Works fine", "Too short", "Great cable!", "Broke after a week", "Fast delivery"]
+
+
+# The login for the n:th generated user (starting at 0), used by loadtest.py too
+def user_login(n):
+    return "user{}@example.com".format(n), "pass{}".format(n)
+
+
+# Picks "size" items from 0..count-1, where the first ones are the most popular
+def zipf_pick(rng, count, size, a):
+    return (rng.zipf(a, size=size) - 1) % count
+
+
+# Keeps the first of each (a, b) pair
+def unique_pairs(a, b):
+    _, first = np.unique((a.astype(np.int64) << 32) | b, return_index=True)
+    first.sort()
+    return a[first], b[first]
+
+
+class Target:
+    def __init__(self, db, mark):
+        self.db = db
+        self.mark = mark
+
+    def max_id(self, table, column):
+        cur = self.db.cursor()
+        cur.execute("SELECT MAX(" + column + ") FROM " + table)
+        value = cur.fetchone()[0]
+        cur.close()
+        return value or 0
+
+    # Returns the IDs added after "after", in order. The IDs from a multi-row
+    # INSERT aren't always one after the other (ie. with innodb_autoinc_lock_mode=2
+    # or auto_increment_increment), so they're read back instead of guessed.
+    def ids_after(self, table, column, after):
+        cur = self.db.cursor()
+        cur.execute("SELECT {0} FROM {1} WHERE {0} > {2} ORDER BY {0}".format(column, table, int(after)))
+        ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+        cur.close()
+        return ids
+
+    # Inserts the rows in chunks, a multi-row insert per chunk
+    def insert(self, table, columns, rows):
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(table, ", ".join(columns), ", ".join([self.mark] * len(columns)))
+        cur = self.db.cursor()
+        for i in range(0, len(rows), CHUNK_SIZE):
+            cur.executemany(sql, rows[i : i + CHUNK_SIZE])
+            self.db.commit()
+        cur.close()
+        print("{:14} {:>10} rows".format(table, len(rows)))
+
+
+def connect_mysql():
+    import mysql.connector
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    db = mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        database=os.getenv("DB_DATABASE"),
+    )
+    # Skip the key checks while loading, the generated keys are known to be good
+    cur = db.cursor()
+    cur.execute("SET foreign_key_checks = 0;")
+    cur.execute("SET unique_checks = 0;")
+    cur.close()
+    return Target(db, "%s")
+
+
+def connect_sqlite(path):
+    import repository
+
+    if os.path.exists(path):
+        os.remove(path)
+    db = repository.connect_sqlite(path).db
+    # Plain tuples for the rows, instead of the repository's dicts
+    db.row_factory = None
+    return Target(db, "?")
+
+
+def generate(target, args):
+    rng = np.random.default_rng(args.seed)
+    last_user = target.max_id("Users", "iduser")
+    last_product = target.max_id("Products", "idproduct")
+    connectors = target.max_id("Connectors", "idconnector")
+
+    # Users, the passwords are the same as the login from user_login(). They're
+    # saved as plaintext (hashing millions of them would take hours) and are
+    # hashed on the first login instead, see credentials.py
+    names = rng.integers(0, len(FIRST_NAMES), size=args.users), rng.integers(0, len(LAST_NAMES), size=args.users)
+    rows = []
+    for n in range(args.users):
+        email, pwd = user_login(n)
+        rows.append((0, email, pwd, FIRST_NAMES[names[0][n]], LAST_NAMES[names[1][n]]))
+    target.insert("Users", ["role", "email", "password", "first_name", "last_name"], rows)
+    user_ids = target.ids_after("Users", "iduser", last_user)
+
+    # Products, with plenty in stock so the load tests can keep on buying
+    prices = rng.integers(19, 999, size=args.products)
+    stock = rng.integers(1000, 100000, size=args.products)
+    standards = rng.choice([1.0, 2.0, 3.0, 3.1, 3.2], size=args.products)
+    lengths = rng.choice([0.25, 0.5, 1.0, 1.5, 2.0, 3.5, 5.0], size=args.products)
+    colors = rng.integers(0, len(COLORS), size=args.products)
+    ends = rng.integers(1, connectors + 1, size=(args.products, 2))
+    rows = [
+        (
+            int(prices[i]),
+            int(stock[i]),
+            float(standards[i]),
+            float(lengths[i]),
+            COLORS[colors[i]],
+            int(ends[i, 0]),
+            int(ends[i, 1]),
+        )
+        for i in range(args.products)
+    ]
+    target.insert(
+        "Products", ["price", "in_stock", "standard", "length", "color", "idconnector1", "idconnector2"], rows
+    )
+    product_ids = target.ids_after("Products", "idproduct", last_product)
+
+    # The popularity ranks are shuffled, so the popular products/users aren't
+    # just the ones with the lowest IDs. These are indexes into the rows above,
+    # the most popular first.
+    product_rank = rng.permutation(args.products)
+    user_rank = rng.permutation(args.users)
+
+    # Orders with 1-5 items each. The timestamps are spread over the last "days"
+    # days, with the amount of orders growing linearly over time.
+    sizes = rng.integers(1, 6, size=args.orders)
+    order = np.repeat(np.arange(args.orders), sizes)
+    items = product_rank[zipf_pick(rng, args.products, len(order), 1.2)]
+    order, items = unique_pairs(order, items)
+    users = user_rank[zipf_pick(rng, args.users, args.orders, 1.5)]
+    span = args.days * 24 * 3600
+    stamps = (args.end - span + span * np.sqrt(rng.random(args.orders))).astype(np.int64)
+    amounts = rng.choice([1, 1, 1, 1, 2, 2, 3, 5], size=len(order))
+    rows = [
+        (int(user_ids[users[o]]), int(product_ids[p]), int(a), int(prices[p]), int(stamps[o]))
+        for o, p, a in zip(order, items, amounts)
+    ]
+    target.insert("Orders", ["iduser", "idproduct", "amount", "price", "timestamp"], rows)
+
+    # Reviews, mostly for the popular products and mostly good
+    users = user_rank[zipf_pick(rng, args.users, args.reviews, 1.5)]
+    prods = product_rank[zipf_pick(rng, args.products, args.reviews, 1.2)]
+    users, prods = unique_pairs(users, prods)
+    ratings = rng.choice([1, 2, 3, 4, 4, 5, 5, 5], size=len(users))
+    comments = rng.integers(0, len(COMMENTS), size=len(users))
+    rows = [
+        (int(user_ids[u]), int(product_ids[p]), int(r), COMMENTS[c])
+        for u, p, r, c in zip(users, prods, ratings, comments)
+    ]
+    target.insert("Reviews", ["iduser", "idproduct", "rating", "comment"], rows)
+
+    # Shopping carts that haven't been checked out yet
+    users = user_rank[zipf_pick(rng, args.users, args.carts, 1.5)]
+    prods = product_rank[zipf_pick(rng, args.products, args.carts, 1.2)]
+    users, prods = unique_pairs(users, prods)
+    amounts = rng.integers(1, 4, size=len(users))
+    rows = [(int(user_ids[u]), int(product_ids[p]), int(a)) for u, p, a in zip(users, prods, amounts)]
+    target.insert("ShoppingCarts", ["iduser", "idproduct", "amount"], rows)
+
+    # The product IDs in the same (zipf) popularity order as above, so the load
+    # test visits and buys the same products that sells the most here
+    return {"seed": args.seed, "users": args.users, "products": product_ids[product_rank].tolist()}
+
+
+def main():
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    parser = argparse.ArgumentParser(description="Fills the db with made up data for load testing.")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--products", type=int, default=10_000)
+    parser.add_argument("--orders", type=int, default=500_000)
+    parser.add_argument("--reviews", type=int, default=200_000)
+    parser.add_argument("--carts", type=int, default=50_000)
+    parser.add_argument("--days", type=int, default=730, help="days of order history")
+    parser.add_argument("--end", type=int, default=int(today.timestamp()), help="unix time of the newest order")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--sqlite", metavar="FILE", help="fill a new sqlite db instead of mysql")
+    parser.add_argument("--out", default=TESTDATA_FILE, help="where to save the info for loadtest.py")
+    args = parser.parse_args()
+
+    # The end time decides the timestamps, so print it for repeating the same run
+    print("seed: {}, end: {}".format(args.seed, args.end))
+    target = connect_sqlite(args.sqlite) if args.sqlite else connect_mysql()
+    start = time.perf_counter()
+    testdata = generate(target, args)
+    target.db.close()
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(testdata, f)
+    print("Saved the product IDs for loadtest.py to", args.out)
+    print("Done in {:.1f} s".format(time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
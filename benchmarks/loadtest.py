@@ -0,0 +1,259 @@
+import os, sys, re, json, time, random, argparse, threading, subprocess
+import urllib.request, urllib.parse, urllib.error
+from http.cookiejar import CookieJar
+from bisect import bisect
+from collections import defaultdict
+
+# Load test for the whole app. A number of threads acts like customers (and an
+# admin), each with their own login session, and keeps sending a mix of requests:
+# browsing products, adding to the cart, checking out and looking at the admin pages.
+# Reports the throughput and latency percentiles for each route.
+#
+# Fill the db with gen_data.py first, and start the app without the rate limits
+# (all requests comes from the same IP), ie:
+#
+#   RATE_LIMITING=0 python3.11 backend.py
+#   python3.11 benchmarks/loadtest.py --url http://localhost:5000
+#
+# The product IDs (and how popular they are) and the amount of users are read
+# from the testdata.json file saved by gen_data.py.
+#
+# The results are saved in benchmarks/results/<git commit>.json and compared with
+# the previous run, so it's easy to see if a commit made things slower.
+
+# Allow importing the modules from the project root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from gen_data import user_login, TESTDATA_FILE
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# How often each action is done, relative to the others. The admin pages are
+# only visited by the admin thread.
+ACTIONS = {
+    "home": 10,
+    "products": 15,
+    "product": 35,
+    "buy": 15,
+    "cart": 10,
+    "checkout": 5,
+    "orders": 5,
+}
+ADMIN_ACTIONS = {"adminorders": 3, "adminanalytics": 2, "products": 5}
+
+# The seeded admin account, see schemas/create_database.sql
+ADMIN_LOGIN = ("admin@localhost", "pass")
+
+TOKEN = re.compile(r'name="token" value="([^"]+)"')
+
+
+# Don't follow redirects, so every request is timed by itself
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+# Picks items from a list where the first ones are the most popular (zipf),
+# same as gen_data.py
+class Zipf:
+    def __init__(self, items, a):
+        self.items = items
+        weights = [1 / (n + 1) ** a for n in range(len(items))]
+        self.cum = []
+        total = 0
+        for w in weights:
+            total += w
+            self.cum.append(total)
+
+    def pick(self, rng):
+        return self.items[bisect(self.cum, rng.random() * self.cum[-1])]
+
+
+class Client:
+    def __init__(self, url, results, timeout):
+        self.url = url
+        self.results = results
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), NoRedirect)
+
+    # Sends a request and records the latency under the route's name.
+    # Returns the response body, or None on errors.
+    def request(self, route, path, form=None):
+        data = urllib.parse.urlencode(form).encode() if form is not None else None
+        start = time.perf_counter()
+        try:
+            with self.opener.open(self.url + path, data=data, timeout=self.timeout) as resp:
+                body = resp.read()
+                status = resp.status
+        except urllib.error.HTTPError as err:
+            # Redirects ends up here too, thanks to NoRedirect
+            body = err.read()
+            status = err.code
+        except (urllib.error.URLError, OSError):
+            body = None
+            status = 0
+        took = time.perf_counter() - start
+        self.results.add(route, status, took)
+        if status == 0 or status >= 400:
+            return None
+        return body.decode("utf-8", "replace")
+
+    def login(self, email, pwd):
+        self.request("login", "/login", {"email": email, "pwd": pwd})
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, route, status, took):
+        with self.lock:
+            self.latencies[route].append(took)
+            if status == 0 or status >= 400:
+                self.errors[route] += 1
+
+
+def customer(client, rng, args, products, stop):
+    client.login(*user_login(rng.randrange(args.users)))
+    weights = list(ACTIONS.values())
+    while not stop.is_set():
+        action = rng.choices(list(ACTIONS), weights)[0]
+        if action == "home":
+            client.request("home", "/")
+        elif action == "products":
+            client.request("products", "/products")
+        elif action == "product":
+            client.request("product", "/product/{}".format(products.pick(rng)))
+        elif action == "buy":
+            client.request("buy", "/product/{}/buy".format(products.pick(rng)), {"amount": 1})
+        elif action == "cart":
+            client.request("cart", "/cart")
+        elif action == "checkout":
+            page = client.request("checkout", "/checkout")
+            match = TOKEN.search(page or "")
+            if match:
+                client.request("checkout_post", "/checkout", {"token": match.group(1)})
+        elif action == "orders":
+            client.request("orders", "/orders")
+
+
+def admin(client, rng, args, products, stop):
+    client.login(*ADMIN_LOGIN)
+    weights = list(ADMIN_ACTIONS.values())
+    while not stop.is_set():
+        action = rng.choices(list(ADMIN_ACTIONS), weights)[0]
+        client.request(action, "/" + action)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(results, duration):
+    routes = {}
+    for route, latencies in sorted(results.latencies.items()):
+        latencies = sorted(latencies)
+        routes[route] = {
+            "requests": len(latencies),
+            "errors": results.errors[route],
+            "rps": len(latencies) / duration,
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+        }
+    return routes
+
+
+def report(routes, duration, previous):
+    row = "{:16} {:>8} {:>7} {:>8} {:>9} {:>9} {:>9} {:>11}"
+    print(row.format("route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "p95 change"))
+    for route, r in routes.items():
+        change = ""
+        old = previous.get(route)
+        if old is not None and old["p95"] > 0:
+            change = "{:+.0f}%".format((r["p95"] / old["p95"] - 1) * 100)
+        stats = ["{:.1f}".format(r[k]) for k in ("rps", "p50", "p95", "p99")]
+        print(row.format(route, r["requests"], r["errors"], *stats, change))
+    total = sum(r["requests"] for r in routes.values())
+    print("total: {} requests in {:.0f} s, {:.1f} req/s".format(total, duration, total / duration))
+
+
+def git_commit():
+    root = os.path.dirname(RESULTS_DIR)
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "-uno"], cwd=root, capture_output=True, text=True)
+    except OSError:
+        return "unknown"
+    if out.returncode != 0:
+        return "unknown"
+    return out.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+
+
+# Returns the routes from the newest saved result that isn't for this commit
+def load_previous(commit):
+    if not os.path.isdir(RESULTS_DIR):
+        return {}
+    files = [os.path.join(RESULTS_DIR, f) for f in os.listdir(RESULTS_DIR) if f.endswith(".json")]
+    files = [f for f in files if os.path.basename(f) != commit + ".json"]
+    if not files:
+        return {}
+    with open(max(files, key=os.path.getmtime), encoding="utf-8") as f:
+        return json.load(f)["routes"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sends a mix of traffic to the app and reports the latencies.")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--threads", type=int, default=16, help="amount of customers at the same time")
+    parser.add_argument("--duration", type=int, default=60, help="seconds to run")
+    parser.add_argument("--data", default=TESTDATA_FILE, help="the file saved by gen_data.py")
+    parser.add_argument("--users", type=int, help="log in as the first N users (default: all of them)")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-save", action="store_true", help="don't save the results")
+    args = parser.parse_args()
+
+    try:
+        with open(args.data, encoding="utf-8") as f:
+            testdata = json.load(f)
+    except FileNotFoundError:
+        sys.exit("No test data found at {}, run gen_data.py first".format(args.data))
+    if args.users is None or args.users > testdata["users"]:
+        args.users = testdata["users"]
+
+    results = Results()
+    stop = threading.Event()
+    products = Zipf(testdata["products"], 1.2)
+    threads = []
+    for n in range(args.threads):
+        # One of the threads is the admin
+        fn = admin if n == 0 else customer
+        client = Client(args.url, results, args.timeout)
+        thread = threading.Thread(target=fn, args=(client, random.Random(args.seed + n), args, products, stop))
+        threads.append(thread)
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    commit = git_commit()
+    routes = summarize(results, duration)
+    report(routes, duration, load_previous(commit))
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, commit + ".json")
+        saved = {"commit": commit, "time": int(time.time()), "args": vars(args), "duration": duration, "routes": routes}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(saved, f, indent=2)
+        print("Saved results to", path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+import os, re, ast, sys, json, time, argparse
+from datetime import date, timedelta
+
+# Query plan guard. Finds the SQL statements in the app's source code, asks mysql
+# how it would run them (EXPLAIN FORMAT=JSON) and compares the plans with a saved
+# baseline. Fails if a statement has started doing a full scan of a table, so an
+# index that got lost (or a query that can't use it any more) is noticed before
+# it's deployed.
+# Source: https://dev.mysql.com/doc/refman/8.0/en/explain-output.html
+#
+# The plans depend on the size of the tables, so run it against a big db made by
+# gen_data.py (with fresh index stats from --analyze):
+#
+#   python3.11 benchmarks/gen_data.py
+#   python3.11 benchmarks/plan_guard.py --analyze --update   # saves the baseline
+#   python3.11 benchmarks/plan_guard.py                      # checks against it
+#
+# Use --list to only show the found statements, without any db.
+#
+# The statements are found by reading the source code (with python's ast module)
+# and putting the SQL strings back together, like "... IN (" + marks + ")" where
+# marks are a few %s. Statements built in ways that are too dynamic (like the
+# UNION in get_orders()) gets hand written samples in SAMPLES below instead, or
+# are listed as skipped.
+#
+# --live shows the plans of the slowest statements the db has actually run,
+# from performance_schema, instead of the ones in the source code.
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_baseline.json")
+
+# The files with SQL in them
+SOURCES = ["backend.py", "repository.py", "stock.py", "jobs.py", "async_backend.py"]
+# Classes and functions to leave out. sqlite has its own SQL dialect, and the
+# schema is run as a whole.
+SKIP = {"SQLiteRepository", "connect_sqlite", "init_db"}
+# Methods that runs a statement, with the SQL as the first argument
+RUNNERS = {"execute", "executemany", "query", "query_one"}
+# Only these can be EXPLAIN'ed
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+# Amount of items used for IN lists, multi-row INSERTs etc.
+REPEATS = 3
+
+# Values for the statements' params, by name. Pick ones that exists in the db, so
+# the plans are for real lookups. Anything missing is 1.
+NOW = int(time.time())
+SAMPLE_PARAMS = {
+    "email": "humle@home",
+    "oldEmail": "humle@home",
+    "password": "pass",
+    "token": "plan-guard",
+    "color": "black",
+    "comment": "Good",
+    "name": "sales_rollups",
+    "args": "{}",
+    "limit": 10,
+    "batch": 5000,
+    "user": 2,
+    "id": 1,
+    "start": NOW - 30 * 24 * 3600,
+    "end": NOW,
+    "now": NOW,
+    "before": NOW - 365 * 24 * 3600,
+    "timestamp": NOW - 24 * 3600,
+    "day": date.today(),
+}
+# Params that differs for some statements, by statement ID
+PARAM_OVERRIDES = {
+    "backend.py:get_sales_days": {"start": date.today() - timedelta(days=90), "end": date.today()},
+    "backend.py:get_sales_products": {"start": date.today() - timedelta(days=90), "end": date.today()},
+}
+
+_ORDER_COLUMNS = "SELECT iduser, idproduct, amount, price, timestamp FROM "
+# Hand written statements for the ones that can't be put back together from the
+# source code, by statement ID
+SAMPLES = {
+    # get_customer_orders()
+    "backend.py:get_orders": _ORDER_COLUMNS
+    + "Orders WHERE iduser = %(user)s UNION ALL "
+    + _ORDER_COLUMNS
+    + "OrdersArchive WHERE iduser = %(user)s ORDER BY timestamp DESC",
+    # get_all_orders(), for the last 30 days
+    "backend.py:get_orders#2": _ORDER_COLUMNS
+    + "Orders WHERE timestamp >= %(start)s AND timestamp < %(end)s ORDER BY timestamp DESC",
+    # Updating the price of a few products
+    "backend.py:bulk_update_products#2": "UPDATE Products SET price = CASE idproduct"
+    + " WHEN %s THEN %s" * REPEATS
+    + " ELSE price END WHERE idproduct IN ("
+    + ", ".join(["%s"] * REPEATS)
+    + ")",
+}
+
+# Access types that reads the whole table (or whole index)
+FULL_SCANS = {"ALL", "index"}
+# Warn when a table's estimated rows grows by more than this
+ROWS_GROWTH = 10
+
+PARAM = re.compile(r"%\((\w+)\)s|%s")
+
+
+################################################################################
+# FINDING THE STATEMENTS
+
+
+class Finder(ast.NodeVisitor):
+    def __init__(self, file, constants):
+        self.file = file
+        # Module level strings, and the ones from repository.py (as repository.NAME)
+        self.constants = constants
+        self.scope = []
+        self.env = {}
+        self.params = set()
+        self.counts = {}
+        self.statements = []
+        self.skipped = []
+
+    def visit_ClassDef(self, node):
+        if node.name in SKIP:
+            return
+        self.scope.append(node.name)
+        self.generic_visit(node)
+        self.scope.pop()
+
+    def visit_FunctionDef(self, node):
+        if node.name in SKIP:
+            return
+        old = (self.env, self.params)
+        self.env = {}
+        self.params = {arg.arg for arg in node.args.args + node.args.kwonlyargs}
+        self.scope.append(node.name)
+        self.generic_visit(node)
+        self.scope.pop()
+        self.env, self.params = old
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    # Keeps track of local strings, like: sql = PRODUCT_QUERY.format(...)
+    def visit_Assign(self, node):
+        self.generic_visit(node)
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                value = self.evaluate(node.value)
+                # Only strings, lists could be appended to later on
+                if isinstance(value, str):
+                    self.env[target.id] = value
+                else:
+                    self.env.pop(target.id, None)
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        name = func.attr if isinstance(func, ast.Attribute) else func.id if isinstance(func, ast.Name) else None
+        if name not in RUNNERS or not node.args or not self.scope:
+            return
+        arg = node.args[0]
+        # The helpers that runs any SQL they're given, like Repository.query()
+        if isinstance(arg, ast.Starred) or (isinstance(arg, ast.Name) and arg.id in self.params):
+            return
+        id = self.file + ":" + ".".join(self.scope)
+        self.counts[id] = self.counts.get(id, 0) + 1
+        if self.counts[id] > 1:
+            id += "#" + str(self.counts[id])
+        sql = self.evaluate(arg)
+        if sql is None:
+            sql = SAMPLES.get(id)
+        if sql is None:
+            self.skipped.append((id, node.lineno))
+        else:
+            self.statements.append((id, node.lineno, sql))
+
+    # Returns the value of a string expression, or None if it can't be known
+    # without running the code.
+    def evaluate(self, node):
+        if isinstance(node, ast.Constant):
+            return node.value if isinstance(node.value, str) else None
+        if isinstance(node, ast.Name):
+            return self.env.get(node.id, self.constants.get(node.id))
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            return self.constants.get(node.value.id + "." + node.attr)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            left, right = self.evaluate(node.left), self.evaluate(node.right)
+            return left + right if left is not None and right is not None else None
+        # A list of marks etc. repeated for each item, ie. " WHEN %s THEN %s" * len(items)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+            left = self.evaluate(node.left)
+            return left * REPEATS if left is not None else None
+        if isinstance(node, ast.List):
+            items = [self.evaluate(item) for item in node.elts]
+            return None if None in items else items
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            target = self.evaluate(node.func.value)
+            if not isinstance(target, str):
+                return None
+            # ", ".join(["%s"] * len(ids))
+            if node.func.attr == "join" and len(node.args) == 1:
+                arg = node.args[0]
+                if isinstance(arg, ast.BinOp) and isinstance(arg.op, ast.Mult) and isinstance(arg.left, ast.List):
+                    items = self.evaluate(arg.left)
+                    return target.join(items * REPEATS) if items is not None else None
+                items = self.evaluate(arg)
+                return target.join(items) if isinstance(items, list) else None
+            # PRODUCT_QUERY.format(products="...")
+            if node.func.attr == "format" and not node.args:
+                values = {kw.arg: self.evaluate(kw.value) for kw in node.keywords}
+                if None in values.values() or None in values:
+                    return None
+                return target.format(**values)
+        return None
+
+
+# Returns the module level string constants of a parsed file
+def module_constants(tree, prefix=""):
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    constants[prefix + target.id] = node.value.value
+    return constants
+
+
+# Returns the found statements as (id, line, sql) and the skipped ones as (id, line)
+def find_statements():
+    trees = {}
+    for file in SOURCES:
+        with open(os.path.join(ROOT, file), encoding="utf-8") as f:
+            trees[file] = ast.parse(f.read(), file)
+    shared = module_constants(trees["repository.py"], "repository.")
+    statements, skipped = [], []
+    for file, tree in trees.items():
+        finder = Finder(file, {**shared, **module_constants(tree)})
+        finder.visit(tree)
+        statements.extend(finder.statements)
+        skipped.extend(finder.skipped)
+    # The hand written samples that aren't found by the finder (ie. #2 variants)
+    lines = {id: line for id, line, _ in statements}
+    for id, sql in SAMPLES.items():
+        if id not in lines and id.split("#")[0] in lines:
+            statements.append((id, lines[id.split("#")[0]], sql))
+    skipped = [(id, line) for id, line in skipped if id not in SAMPLES]
+    return statements, skipped
+
+
+def compact(sql):
+    return " ".join(sql.split()).rstrip(";").strip()
+
+
+def explainable(sql):
+    return compact(sql).lstrip("(").upper().startswith(EXPLAINABLE)
+
+
+# Returns the params for a statement, as a dict for %(name)s params or a list for %s
+def sample_params(id, sql):
+    values = {**SAMPLE_PARAMS, **PARAM_OVERRIDES.get(id.split("#")[0], {})}
+    names = [m.group(1) for m in PARAM.finditer(sql)]
+    if not names:
+        return None
+    if None in names:
+        return [values.get("id")] * len(names)
+    return {name: values.get(name, 1) for name in names}
+
+
+################################################################################
+# PLANS
+
+
+# Picks out the interesting parts of an EXPLAIN FORMAT=JSON plan
+def summarize(plan):
+    summary = {"tables": [], "filesort": False, "temporary": False}
+
+    def walk(node):
+        if isinstance(node, dict):
+            if "table_name" in node and "access_type" in node:
+                summary["tables"].append(
+                    {
+                        "table": node["table_name"],
+                        "access_type": node["access_type"],
+                        "key": node.get("key"),
+                        "rows": node.get("rows_examined_per_scan", 0),
+                        # A temporary table made from a subquery, scanning it is fine
+                        "derived": "materialized_from_subquery" in node,
+                    }
+                )
+            if node.get("using_filesort"):
+                summary["filesort"] = True
+            if node.get("using_temporary_table"):
+                summary["temporary"] = True
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(plan)
+    return summary
+
+
+def explain(cur, sql, params=None):
+    cur.execute("EXPLAIN FORMAT=JSON " + compact(sql), params)
+    return summarize(json.loads(cur.fetchone()[0]))
+
+
+def full_scans(summary):
+    return {t["table"] for t in summary["tables"] if t["access_type"] in FULL_SCANS and not t["derived"]}
+
+
+def describe(summary):
+    parts = []
+    for t in summary["tables"]:
+        part = "{}:{}".format(t["table"], t["access_type"])
+        if t["key"]:
+            part += "(" + t["key"] + ")"
+        parts.append(part)
+    if summary["filesort"]:
+        parts.append("filesort")
+    if summary["temporary"]:
+        parts.append("temporary")
+    return " ".join(parts)
+
+
+# Compares a plan with its baseline. Returns a list of errors and a list of warnings.
+def compare(summary, old):
+    errors, warnings = [], []
+    if old is None:
+        for table in sorted(full_scans(summary)):
+            errors.append("new statement does a full scan of " + table)
+        return errors, warnings
+    old_access = {t["table"]: t["access_type"] for t in old["tables"]}
+    for table in sorted(full_scans(summary) - full_scans(old)):
+        errors.append("full scan of {} (was {})".format(table, old_access.get(table, "not used")))
+    old_rows = {t["table"]: t["rows"] for t in old["tables"]}
+    for t in summary["tables"]:
+        before = old_rows.get(t["table"])
+        if before and t["rows"] > before * ROWS_GROWTH:
+            warnings.append("{} rows estimate went from {} to {}".format(t["table"], before, t["rows"]))
+    if summary["filesort"] and not old["filesort"]:
+        warnings.append("started using filesort")
+    if summary["temporary"] and not old["temporary"]:
+        warnings.append("started using a temporary table")
+    return errors, warnings
+
+
+################################################################################
+# RUNNING
+
+
+def connect():
+    import mysql.connector
+    from dotenv import load_dotenv
+
+    load_dotenv(os.path.join(ROOT, ".env"))
+    return mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        database=os.getenv("DB_DATABASE"),
+    )
+
+
+# Updates the index stats, so the plans are for the current data
+def analyze(db):
+    with db.cursor() as cur:
+        cur.execute("SHOW TABLES;")
+        tables = [row[0] for row in cur.fetchall()]
+        for table in tables:
+            cur.execute("ANALYZE TABLE " + table + ";")
+            cur.fetchall()
+
+
+def check(db, statements, baseline, update):
+    import mysql.connector
+
+    plans = {}
+    failed = 0
+    row = "{:46} {:>9}  {}"
+    print(row.format("statement", "rows", "plan"))
+    with db.cursor() as cur:
+        for id, line, sql in statements:
+            if not explainable(sql):
+                continue
+            try:
+                summary = explain(cur, sql, sample_params(id, sql))
+            except mysql.connector.Error as err:
+                print(row.format(id, "", "EXPLAIN failed: " + str(err)))
+                failed += 1
+                continue
+            summary["sql"] = compact(sql)
+            plans[id] = summary
+            print(row.format(id, sum(t["rows"] for t in summary["tables"]), describe(summary)))
+            if update:
+                continue
+            errors, warnings = compare(summary, baseline.get(id))
+            for err in errors:
+                print("    ERROR: " + err + ", see line " + str(line))
+            for warning in warnings:
+                print("    warning: " + warning)
+            failed += len(errors)
+    return plans, failed
+
+
+# Shows the plans of the slowest statements the db has run, from the statement
+# digests in performance_schema (mysql 8.0+). The stats are since the server was
+# started, or since the table was truncated.
+# Source: https://dev.mysql.com/doc/refman/8.0/en/performance-schema-statement-digests.html
+def live(db, min_ms, limit):
+    import mysql.connector
+
+    failed = 0
+    with db.cursor(dictionary=True) as cur:
+        cur.execute(
+            """
+            SELECT QUERY_SAMPLE_TEXT AS sample, COUNT_STAR AS calls,
+                AVG_TIMER_WAIT / 1e9 AS avg_ms, SUM_ROWS_EXAMINED / COUNT_STAR AS rows_examined,
+                SUM_NO_INDEX_USED AS no_index
+            FROM performance_schema.events_statements_summary_by_digest
+            WHERE SCHEMA_NAME = DATABASE() AND AVG_TIMER_WAIT >= %(min)s AND QUERY_SAMPLE_TEXT IS NOT NULL
+            ORDER BY SUM_TIMER_WAIT DESC LIMIT %(limit)s;
+        """,
+            {"min": int(min_ms * 1e9), "limit": limit},
+        )
+        rows = cur.fetchall()
+    print("{} statements slower than {} ms on average".format(len(rows), min_ms))
+    with db.cursor() as cur:
+        for row in rows:
+            sql = compact(row["sample"])
+            stats = "{:.1f} ms avg, {} calls, {:.0f} rows examined".format(
+                row["avg_ms"], row["calls"], row["rows_examined"]
+            )
+            print("\n" + stats + ": " + sql[:200])
+            # The samples are cut off at performance_schema_max_sql_text_length
+            if not explainable(sql) or sql.startswith("EXPLAIN") or sql.endswith("..."):
+                continue
+            try:
+                summary = explain(cur, sql)
+            except mysql.connector.Error as err:
+                print("    EXPLAIN failed: " + str(err))
+                continue
+            print("    plan: " + describe(summary))
+            for table in sorted(full_scans(summary)):
+                print("    ERROR: full scan of " + table)
+                failed += 1
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the query plans of the app's SQL statements.")
+    parser.add_argument("--list", action="store_true", help="only list the found statements")
+    parser.add_argument("--update", action="store_true", help="save the current plans as the baseline")
+    parser.add_argument("--analyze", action="store_true", help="update the index stats first")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--live", action="store_true", help="check the slowest statements run by the db instead")
+    parser.add_argument("--min-ms", type=float, default=10, help="slowest statements for --live, in ms")
+    parser.add_argument("--limit", type=int, default=20, help="max statements for --live")
+    args = parser.parse_args()
+
+    statements, skipped = find_statements()
+    if args.list:
+        for id, line, sql in statements:
+            print("{} (line {}):\n    {}".format(id, line, compact(sql)))
+        for id, line in skipped:
+            print("{} (line {}): skipped, too dynamic".format(id, line))
+        return
+
+    # A missing baseline is an error, saving a new one by accident would let
+    # the current (maybe broken) plans pass from then on
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["plans"]
+    elif not args.update and not args.live:
+        sys.exit("No baseline found at {}, run with --update to save the current plans".format(args.baseline))
+
+    db = connect()
+    if args.analyze:
+        analyze(db)
+    if args.live:
+        failed = live(db, args.min_ms, args.limit)
+        db.close()
+        sys.exit(1 if failed else 0)
+
+    plans, failed = check(db, statements, baseline, args.update)
+    db.close()
+
+    for id, line in skipped:
+        print("skipped (too dynamic, add it to SAMPLES): {} line {}".format(id, line))
+    for id in sorted(set(baseline) - set(plans)):
+        print("gone from the source code: " + id)
+    if args.update:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"time": int(time.time()), "plans": plans}, f, indent=2, sort_keys=True)
+        print("Saved {} plans to {}".format(len(plans), args.baseline))
+    if failed:
+        print("{} problems found".format(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
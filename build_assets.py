@@ -0,0 +1,100 @@
+import os, sys, json, gzip, shutil, hashlib
+
+# Build step for the static files (css, images etc.)
+#
+# Copies every file in static/ to static/dist/, with a hash of the file's content
+# added to the name (ie. style.css -> style.3f2a9c1b04de.css). Since the name
+# changes whenever the content changes, browsers and nginx can cache the files
+# forever without ever showing an old version.
+# The templates look up the new names with asset_url(), using the manifest.json
+# file written at the end.
+#
+# Text files also gets precompressed gzip (and brotli, if installed) copies, so
+# nginx can send them as they are instead of compressing them on every request.
+# See gzip_static in nginx.conf.
+#
+# Run it with: python3.11 build_assets.py
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST = os.path.join(DIST_DIR, "manifest.json")
+
+# These dirs are not part of the build: dist is the output and products holds
+# the uploaded product images (which already have hashed names).
+SKIP_DIRS = ("dist", "products")
+
+# Only text files are worth compressing, images are already compressed
+COMPRESS_TYPES = (".css", ".js", ".svg", ".html", ".txt", ".json")
+
+
+# Returns the new name of a file, with the hash of it's content added.
+def hashed_name(name, data):
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    base, ext = os.path.splitext(name)
+    return base + "." + digest + ext
+
+
+# Writes a file, unless it already exists (the names are unique per content).
+def write_file(path, data):
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build():
+    manifest = {}
+    for root, dirs, files in os.walk(STATIC_DIR):
+        if root == STATIC_DIR:
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+        for name in files:
+            src = os.path.join(root, name)
+            # The manifest uses forward slashes, like the URLs
+            rel = os.path.relpath(src, STATIC_DIR).replace(os.sep, "/")
+            with open(src, "rb") as f:
+                data = f.read()
+
+            out = hashed_name(rel, data)
+            dst = os.path.join(DIST_DIR, out)
+            write_file(dst, data)
+            if rel.endswith(COMPRESS_TYPES):
+                # mtime=0 makes the output the same every time
+                write_file(dst + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    write_file(dst + ".br", brotli.compress(data, quality=11))
+            manifest[rel] = "dist/" + out
+            print(rel, "->", manifest[rel])
+
+    os.makedirs(DIST_DIR, exist_ok=True)
+    with open(MANIFEST + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(MANIFEST + ".tmp", MANIFEST)
+
+
+# Returns the manifest from the last build (original name -> hashed name), or
+# None if the assets hasn't been built yet.
+def load_manifest():
+    try:
+        with open(MANIFEST, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# Removes all old builds
+def clean():
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if "--clean" in sys.argv:
+        clean()
+    build()
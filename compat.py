@@ -0,0 +1,125 @@
+import threading
+from collections import defaultdict
+
+# Index for finding cables (or chains of cables) between two connectors.
+#
+# Each product is a cable with two ends, and each end is a connector described
+# as a (type, gender) tuple, ie. ("Type-A", 0) for a male Type-A connector.
+# Two ends can be plugged together if they have the same type but opposite genders.
+#
+# The products can then be seen as edges in a graph, where the nodes are the
+# connector ends. Direct matches are looked up in a dict and the chains of
+# adapters are found with a breadth-first search, which always finds the chain
+# with the least amount of cables first.
+# Source: https://en.wikipedia.org/wiki/Breadth-first_search
+
+
+# Returns the connector end that can be plugged into "end".
+def mate(end):
+    return (end[0], 1 - end[1])
+
+
+# Returns a key for a pair of ends, which is the same in both directions
+# since a cable can be turned around.
+def pair(a, b):
+    return (a, b) if a <= b else (b, a)
+
+
+class ConnectorIndex:
+    def __init__(self):
+        # idproduct -> (end1, end2, in_stock)
+        self.products = {}
+        # pair(end1, end2) -> set of idproduct
+        self.direct = defaultdict(set)
+        # end -> set of idproduct, with that end on either side
+        self.by_end = defaultdict(set)
+        self.built = False
+        self.lock = threading.Lock()
+
+    # Rebuilds the whole index, from a list of (idproduct, end1, end2, in_stock).
+    def build(self, products):
+        with self.lock:
+            self.products = {}
+            self.direct = defaultdict(set)
+            self.by_end = defaultdict(set)
+            for id, end1, end2, in_stock in products:
+                self._add(id, end1, end2, in_stock)
+            self.built = True
+
+    # Forces a full rebuild on next use, after big changes like bulk imports.
+    def invalidate(self):
+        self.built = False
+
+    # Adds or updates a single product.
+    def set_product(self, id, end1, end2, in_stock):
+        with self.lock:
+            self._remove(id)
+            self._add(id, end1, end2, in_stock)
+
+    def remove_product(self, id):
+        with self.lock:
+            self._remove(id)
+
+    def _add(self, id, end1, end2, in_stock):
+        self.products[id] = (end1, end2, in_stock)
+        self.direct[pair(end1, end2)].add(id)
+        self.by_end[end1].add(id)
+        self.by_end[end2].add(id)
+
+    def _remove(self, id):
+        old = self.products.pop(id, None)
+        if old is None:
+            return
+        end1, end2, _ = old
+        self.direct[pair(end1, end2)].discard(id)
+        self.by_end[end1].discard(id)
+        self.by_end[end2].discard(id)
+
+    # Returns the other end of a product, when "end" is plugged in.
+    def _other_end(self, id, end):
+        end1, end2, _ = self.products[id]
+        return end2 if end1 == end else end1
+
+    # Returns the IDs of all products with the ends "a" and "b".
+    def find_direct(self, a, b, in_stock=True):
+        with self.lock:
+            ids = self.direct.get(pair(a, b), ())
+            return sorted(id for id in ids if not in_stock or self.products[id][2] > 0)
+
+    # Returns the shortest chain of products (as a list of IDs) going from the
+    # end "a" to the end "b", or an empty list if there's none.
+    # Every cable in the chain must be plugged into the free end of the previous one.
+    def find_chain(self, a, b, max_cables=3, in_stock=True):
+        with self.lock:
+            # Start by pretending there's a free end that mates with "a", then
+            # the first cable must have "a" on one side.
+            first = mate(a)
+            parents = {}
+            seen = set([first])
+            frontier = [first]
+            for _ in range(max_cables):
+                next_frontier = []
+                for end in frontier:
+                    plug = mate(end)
+                    for id in sorted(self.by_end.get(plug, ())):
+                        if in_stock and self.products[id][2] < 1:
+                            continue
+                        free = self._other_end(id, plug)
+                        if free == b:
+                            return self._path(parents, end, id)
+                        if free in seen:
+                            continue
+                        seen.add(free)
+                        parents[free] = (end, id)
+                        next_frontier.append(free)
+                frontier = next_frontier
+            return []
+
+    # Walks back through the parents, to find all products in a chain.
+    def _path(self, parents, end, id):
+        path = [id]
+        while end in parents:
+            end, id = parents[end]
+            path.append(id)
+        path.reverse()
+        return path
@@ -0,0 +1,336 @@
+import re, zlib
+
+# WSGI middleware for compressing (and minifying) the responses from flask.
+#
+# A WSGI middleware wraps the flask app and can change the responses before they
+# are sent back to the web server. Flask has an example of this in its docs:
+# https://flask.palletsprojects.com/en/stable/patterns/appdispatch/
+# The WSGI spec: https://peps.python.org/pep-3333/
+#
+# The encoding is picked from the browser's Accept-Encoding header. gzip is always
+# available, brotli and zstd are only used if their python packages are installed.
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Only text based types are worth compressing, images etc. are already compressed
+COMPRESS_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+# Blocks of html where the whitespace matters and mustn't be touched
+PRESERVE_HTML = re.compile(r"<(pre|textarea|script|style)\b.*?</\1\s*>", re.S | re.I)
+HTML_COMMENT = re.compile(r"<!--(?!\[if).*?-->", re.S)
+WHITESPACE = re.compile(r"\s{2,}")
+# A whole tag, with any quoted attribute values (which may contain ">")
+HTML_TAG = re.compile(r"""<(?:"[^"]*"|'[^']*'|[^'">])*>""")
+
+
+# Removes comments and extra whitespace (left over from the templates) from html.
+# Runs of whitespace in the text and between the tags are replaced by a single
+# space or newline, which the browser shows exactly the same. The tags themselves
+# are left alone, since whitespace in attribute values (ie. <input value="a  b">)
+# is kept by the browser.
+def minify_html(html):
+    out = []
+    pos = 0
+    for match in PRESERVE_HTML.finditer(html):
+        start = match.start()
+        out.append(squeeze_html(html[pos:start]))
+        out.append(match.group(0))
+        pos = match.end()
+    out.append(squeeze_html(html[pos:]))
+    return "".join(out)
+
+
+def squeeze_html(html):
+    html = HTML_COMMENT.sub("", html)
+    out = []
+    pos = 0
+    for match in HTML_TAG.finditer(html):
+        start = match.start()
+        out.append(squeeze_text(html[pos:start]))
+        out.append(match.group(0))
+        pos = match.end()
+    out.append(squeeze_text(html[pos:]))
+    return "".join(out)
+
+
+def squeeze_text(text):
+    return WHITESPACE.sub(lambda m: "\n" if "\n" in m.group(0) else " ", text)
+
+
+# Small wrappers around the compressors, so they all have the same methods.
+# flush() returns everything compressed so far (so it can be streamed to the
+# client) and finish() ends the stream.
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        # wbits=31 makes zlib write the gzip header/trailer
+        # Source: https://docs.python.org/3/library/zlib.html#zlib.compressobj
+        self.obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.obj.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, level):
+        # Brotli has levels 0-11, the high levels are way too slow for responses
+        self.obj = brotli.Compressor(quality=min(level, 5))
+
+    def compress(self, data):
+        return self.obj.process(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+    def finish(self):
+        return self.obj.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level):
+        self.obj = zstandard.ZstdCompressor(level=min(level, 9)).compressobj()
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.obj.flush()
+
+
+# The encodings in order of preference, when the browser likes them equally much.
+ENCODINGS = {}
+if zstandard is not None:
+    ENCODINGS["zstd"] = ZstdCompressor
+if brotli is not None:
+    ENCODINGS["br"] = BrotliCompressor
+ENCODINGS["gzip"] = GzipCompressor
+
+
+# Picks the best encoding from an Accept-Encoding header, like "gzip, br;q=0.9".
+# Returns None if none of them are supported.
+# Source: https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Accept-Encoding
+def choose_encoding(header, encodings):
+    accepted = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name] = q
+
+    best = None
+    best_q = 0.0
+    for name in encodings:
+        q = accepted.get(name, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+# Returns a header's value from a list of (name, value) tuples, or None.
+def get_header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+class CompressionMiddleware:
+    # app: the WSGI app to wrap, use app.wsgi_app for flask
+    # compress: set to False to leave the compression to nginx
+    # min_size: responses smaller than this (in bytes) are sent as they are
+    # level: compression level, 1 (fastest) to 9 (smallest)
+    # minify: removes extra whitespace from html responses
+    def __init__(self, app, compress=True, min_size=1024, level=6, minify=True):
+        self.app = app
+        self.encodings = ENCODINGS if compress else {}
+        self.min_size = min_size
+        self.level = level
+        self.minify = minify
+
+    def __call__(self, environ, start_response):
+        # A HEAD response has no body to minify or compress, so its headers
+        # (ie. Content-Length) are passed on as they are
+        if environ.get("REQUEST_METHOD") == "HEAD":
+            return self.app(environ, start_response)
+        encoding = choose_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""), self.encodings)
+        if encoding is None and not self.minify:
+            return self.app(environ, start_response)
+
+        # Hold on to the status and headers until it's known if the response
+        # will be changed or not.
+        captured = []
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            # Old style apps can use the returned write() function for the body
+            return written.append
+
+        body = self.app(environ, capture)
+        return self.respond(body, captured, written, encoding, start_response)
+
+    # Decides what to do with a response. Returns (minify, encoding).
+    def plan(self, status, headers, encoding):
+        code = int(status.split(" ", 1)[0])
+        kind = (get_header(headers, "Content-Type") or "").lower()
+        if code < 200 or code in (204, 206, 304):
+            return False, None
+        if get_header(headers, "Content-Encoding") is not None:
+            return False, None
+        if "no-transform" in (get_header(headers, "Cache-Control") or ""):
+            return False, None
+        minify = self.minify and kind.startswith("text/html")
+        if not kind.startswith(COMPRESS_TYPES):
+            encoding = None
+        return minify, encoding
+
+    def respond(self, body, captured, written, encoding, start_response):
+        chunks = iter(body)
+        try:
+            # Some apps only call start_response() when the body is read
+            buffered = list(written)
+            while not captured:
+                buffered.append(next(chunks))
+        except StopIteration:
+            pass
+        except BaseException:
+            close_body(body)
+            raise
+        status, headers, exc_info = captured
+        minify, encoding = self.plan(status, headers, encoding)
+        length = get_header(headers, "Content-Length")
+
+        if not minify and encoding is None:
+            start_response(status, headers, exc_info)
+            return chain_body(buffered, chunks, body)
+
+        # Html can only be minified when the whole page is known (ie. it's not
+        # streamed), since the whitespace could be split between two chunks.
+        if minify and length is not None:
+            data = b"".join(buffered) + b"".join(chunks)
+            close_body(body)
+            charset = "utf-8"
+            kind = get_header(headers, "Content-Type")
+            if "charset=" in kind:
+                charset = kind.split("charset=", 1)[1].split(";")[0].strip()
+            try:
+                data = minify_html(data.decode(charset)).encode(charset)
+            except (UnicodeError, LookupError):
+                pass
+            buffered, chunks, body, length = [data], iter([]), None, str(len(data))
+
+        # Read enough of the body to know if it's worth compressing. If the
+        # length is known the body isn't streamed, so read all of it and
+        # compress it in one go below.
+        size = sum(len(b) for b in buffered)
+        done = length is not None and size >= int(length)
+        try:
+            while not done and (size < self.min_size or length is not None):
+                chunk = next(chunks)
+                buffered.append(chunk)
+                size += len(chunk)
+                done = length is not None and size >= int(length)
+        except StopIteration:
+            done = True
+        except BaseException:
+            close_body(body)
+            raise
+
+        if encoding is None or (done and size < self.min_size):
+            headers = set_header(headers, "Content-Length", str(size) if done else length)
+            start_response(status, headers, exc_info)
+            return chain_body(buffered, chunks, body)
+
+        compressor = ENCODINGS[encoding](self.level)
+        headers = [(k, v) for k, v in headers if k.lower() != "content-length"]
+        headers.append(("Content-Encoding", encoding))
+        vary = get_header(headers, "Vary")
+        if vary is None:
+            headers.append(("Vary", "Accept-Encoding"))
+        elif "accept-encoding" not in vary.lower():
+            headers = set_header(headers, "Vary", vary + ", Accept-Encoding")
+        # The compressed body isn't byte for byte the same anymore
+        etag = get_header(headers, "ETag")
+        if etag is not None and not etag.startswith("W/"):
+            headers = set_header(headers, "ETag", "W/" + etag)
+
+        if done:
+            # The whole body is known, so compress it in one go
+            data = compressor.compress(b"".join(buffered)) + compressor.finish()
+            close_body(body)
+            headers.append(("Content-Length", str(len(data))))
+            start_response(status, headers, exc_info)
+            return [data]
+
+        start_response(status, headers, exc_info)
+        return stream_compressed(compressor, buffered, chunks, body)
+
+
+# Replaces (or adds) a header, returns a new list of headers.
+def set_header(headers, name, value):
+    headers = [(k, v) for k, v in headers if k.lower() != name.lower()]
+    if value is not None:
+        headers.append((name, value))
+    return headers
+
+
+def close_body(body):
+    # The WSGI spec requires that close() is called on the body, if it has one
+    if hasattr(body, "close"):
+        body.close()
+
+
+def chain_body(buffered, chunks, body):
+    try:
+        for chunk in buffered:
+            yield chunk
+        for chunk in chunks:
+            yield chunk
+    finally:
+        close_body(body)
+
+
+# Compresses a streamed body chunk by chunk. Each chunk is flushed, so the
+# browser can start showing the page before the whole response is done.
+def stream_compressed(compressor, buffered, chunks, body):
+    try:
+        data = compressor.compress(b"".join(buffered))
+        yield data + compressor.flush()
+        for chunk in chunks:
+            if chunk:
+                yield compressor.compress(chunk) + compressor.flush()
+        yield compressor.finish()
+    finally:
+        close_body(body)
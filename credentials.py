@@ -0,0 +1,148 @@
+import os, hmac, time, base64, hashlib, threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Password hashing.
+#
+# The passwords are hashed with scrypt, which is made to be slow and use lots
+# of memory so stolen hashes are expensive to crack. How slow is decided by the
+# cost (N in scrypt), which is calibrated on startup so a hash takes about
+# TARGET_SECONDS on the current server. The cost is saved in the hash, so it can
+# be raised later and old hashes are updated on the next login.
+# Source: https://cheatsheetseries.owasp.org/cheatsheets/Password_Storage_Cheat_Sheet.html
+#
+# Hashing blocks the cpu for a good while, so it's done by a small pool of
+# processes instead of the request threads. The amount of waiting jobs is
+# limited too, so a login storm gets "busy" errors instead of piling up forever.
+#
+# Stored format: scrypt$<log2 N>$<r>$<p>$<salt>$<hash> (base64 salt and hash)
+# Anything else is an old plaintext password, from before the hashing was added.
+
+PREFIX = "scrypt"
+# Block size and parallelism, the recommended values
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+HASH_SIZE = 32
+# Limits for the calibration, log2 of N
+MIN_COST = 14
+MAX_COST = 20
+TARGET_SECONDS = 0.1
+
+
+class Busy(Exception):
+    pass
+
+
+def b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+# Runs scrypt with the cost given as log2 of N
+def scrypt(pwd, salt, cost, r=SCRYPT_R, p=SCRYPT_P):
+    n = 2**cost
+    # OpenSSL refuses to use more than 32 MB by default, which is too little for
+    # the higher costs. Needs 128 * N * r bytes.
+    return hashlib.scrypt(
+        pwd.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=HASH_SIZE
+    )
+
+
+def hash_password(pwd, cost):
+    salt = os.urandom(SALT_SIZE)
+    digest = scrypt(pwd, salt, cost)
+    return "$".join([PREFIX, str(cost), str(SCRYPT_R), str(SCRYPT_P), b64(salt), b64(digest)])
+
+
+# Returns True if the password matches the stored hash (or old plaintext password)
+def verify_password(pwd, stored):
+    parts = stored.split("$")
+    if len(parts) != 6 or parts[0] != PREFIX:
+        # Compare in constant time, so the time taken doesn't leak how much of
+        # the password was right
+        return hmac.compare_digest(pwd.encode("utf-8"), stored.encode("utf-8"))
+    try:
+        cost, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+        salt, digest = base64.b64decode(parts[4]), base64.b64decode(parts[5])
+    except ValueError:
+        return False
+    return hmac.compare_digest(scrypt(pwd, salt, cost, r, p), digest)
+
+
+# Returns the lowest cost (log2 N) where a hash takes at least "target" seconds.
+def calibrate(target=TARGET_SECONDS):
+    salt = os.urandom(SALT_SIZE)
+    for cost in range(MIN_COST, MAX_COST):
+        start = time.perf_counter()
+        scrypt("calibrate", salt, cost)
+        if time.perf_counter() - start >= target:
+            return cost
+    return MAX_COST
+
+
+class Hasher:
+    # workers: amount of hashing processes, ie. the amount of cpu cores to use
+    # cost: log2 of scrypt's N, or None for calibrating on first use
+    # max_waiting: max amount of hashes queued per worker, before raising Busy
+    # timeout: max seconds to wait for a free spot in the queue
+    def __init__(self, workers=2, cost=None, max_waiting=8, timeout=1.0):
+        self.workers = workers
+        self.cost = cost
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(workers * max_waiting)
+        self.executor = None
+        self.lock = threading.Lock()
+        # Used when the user doesn't exist, see verify()
+        self.dummy = None
+
+    def pool(self):
+        with self.lock:
+            if self.executor is None:
+                # "spawn" starts clean processes, forking a process with running
+                # threads (like the flask server) isn't safe.
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+
+    # Runs a function in the pool and waits for the result
+    def run(self, fn, *args):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise Busy("Too many passwords being hashed")
+        try:
+            return self.pool().submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+    def get_cost(self):
+        if self.cost is None:
+            # Calibrate in the pool, since that's where the hashing runs
+            cost = self.run(calibrate, TARGET_SECONDS)
+            with self.lock:
+                if self.cost is None:
+                    self.cost = cost
+                    print("Password hashing cost calibrated to 2^" + str(cost))
+        return self.cost
+
+    def hash(self, pwd):
+        return self.run(hash_password, pwd, self.get_cost())
+
+    # Checks a password against the stored hash. Use None for a missing user,
+    # which still runs a hash so it takes the same time as for a real user (or
+    # else the time would show which emails are registered).
+    def verify(self, pwd, stored):
+        if stored is None:
+            if self.dummy is None:
+                self.dummy = self.hash("dummy password")
+            self.run(verify_password, pwd, self.dummy)
+            return False
+        return self.run(verify_password, pwd, stored)
+
+    # Returns True if the stored password should be hashed again, ie. if it's an
+    # old plaintext password or the cost has been raised.
+    def needs_rehash(self, stored):
+        parts = stored.split("$")
+        if len(parts) != 6 or parts[0] != PREFIX:
+            return True
+        try:
+            return int(parts[1]) < self.get_cost()
+        except ValueError:
+            return True
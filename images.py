@@ -0,0 +1,85 @@
+import os, hashlib, io
+
+from PIL import Image, ImageOps
+
+# Product image pipeline.
+#
+# Uploaded images are resized and recompressed into a few smaller variants once,
+# when they are uploaded, instead of sending the full size image to every visitor.
+# The files are named after a hash of the original image (content-addressed), so
+# the same image is only stored once and a file never changes once it's written.
+# That means browsers (and nginx) can cache them forever.
+#
+# Pillow docs: https://pillow.readthedocs.io/en/stable/handbook/tutorial.html
+
+# Where the image files are saved, must be inside the flask static dir
+IMAGE_DIR = os.path.join(os.path.dirname(__file__), "static", "products")
+IMAGE_URL = "/static/products"
+
+# The variants and their max width/height in pixels
+VARIANTS = {
+    "thumb": 160,
+    "list": 320,
+    "detail": 800,
+}
+
+JPEG_QUALITY = 82
+
+
+# Returns the path (relative to IMAGE_DIR) for a variant of an image.
+# The images are spread out over sub dirs, to not end up with a huge single dir.
+def image_path(key, variant):
+    return os.path.join(key[:2], key + "-" + str(VARIANTS[variant]) + ".jpg")
+
+
+# Returns the URL for a variant of an image.
+def image_url(key, variant="detail"):
+    return IMAGE_URL + "/" + image_path(key, variant).replace(os.sep, "/")
+
+
+# Returns a srcset value, listing all variants of an image with their widths.
+# The browser then picks the smallest one that's big enough for the page.
+# Source: https://developer.mozilla.org/en-US/docs/Web/HTML/Responsive_images
+def image_srcset(key):
+    return ", ".join(image_url(key, v) + " " + str(w) + "w" for v, w in VARIANTS.items())
+
+
+# Resizes and saves all variants of an uploaded image.
+# Returns the key for the image, which should be stored in Products.image_file.
+# Raises a ValueError if the data isn't an image.
+def ingest_image(data):
+    # 40 chars is short enough for the image_file column and still unique enough
+    key = hashlib.sha256(data).hexdigest()[:40]
+    if all(os.path.exists(os.path.join(IMAGE_DIR, image_path(key, v))) for v in VARIANTS):
+        # Same image has been uploaded before
+        return key
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.load()
+    except (OSError, Image.DecompressionBombError) as err:
+        raise ValueError("Bad image: " + str(err))
+
+    # Rotate the image according to it's EXIF data (phone pictures...) and then
+    # drop any transparency, since JPEG doesn't support it.
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    for variant, size in VARIANTS.items():
+        path = os.path.join(IMAGE_DIR, image_path(key, variant))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        copy = img.copy()
+        # thumbnail() keeps the aspect ratio and never makes an image bigger
+        copy.thumbnail((size, size), Image.LANCZOS)
+        # Write to a temp file first and then rename it, so a half written file is
+        # never served to anyone.
+        tmp = path + ".tmp"
+        copy.save(tmp, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+        os.replace(tmp, path)
+    return key
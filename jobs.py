@@ -0,0 +1,282 @@
+import json, time, threading
+from concurrent.futures import ThreadPoolExecutor
+
+# A small background job queue, for work that doesn't have to be done before the
+# response is sent to the user (updating stats, refreshing caches, cleanups etc.)
+#
+# Jobs are saved in the Jobs table before they're run, so they survive a crash or
+# restart of the app. A job can be saved in the same transaction as the data it
+# belongs to (like a new order), so it's impossible to get one without the other.
+# This is known as the "transactional outbox" pattern:
+# https://microservices.io/patterns/data/transactional-outbox.html
+#
+# The jobs are run by a pool of threads, since they mostly wait for the db.
+# Failed jobs are retried a few times, waiting a little longer between each try.
+#
+# The periodic jobs (see every()) are scheduled in the JobSchedule table, which
+# is shared by all processes. Whichever process first sees that a job is due
+# claims the run, so each run happens once, and a job that's overdue (ie. after
+# a restart) is run as soon as a process starts.
+
+# Job status codes, same as in the schema
+PENDING = 0
+RUNNING = 1
+DONE = 2
+FAILED = 3
+
+
+class JobQueue:
+    # connect: function that returns a new db connection
+    # workers: amount of threads running jobs
+    # max_attempts: how many times a job is tried before it's marked as failed
+    # lease: seconds a job can run before another worker may take it over (ie.
+    #        if the first one crashed)
+    # poll: seconds between checking the Jobs table for retries, jobs left behind
+    #       by other workers and periodic jobs
+    def __init__(self, connect, workers=4, max_attempts=5, lease=300, poll=5):
+        self.connect = connect
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.poll = poll
+        self.handlers = {}
+        self.periodic = {}
+        # Set when the periodic jobs have been added to JobSchedule
+        self.scheduled = False
+        self.executor = None
+        self.lock = threading.Lock()
+
+    # Decorator for registering a job function under a name:
+    #
+    #   @queue.handler("send_mail")
+    #   def send_mail(db, to, text): ...
+    #
+    # The function gets an open db connection as the first argument, unless
+    # db=False. Any changes are committed together with marking the job as done.
+    def handler(self, name, db=True):
+        def register(fn):
+            self.handlers[name] = (fn, db)
+            return fn
+
+        return register
+
+    # Runs a job every "seconds", ie. for cleanups.
+    def every(self, seconds, name, **args):
+        self.periodic[name] = (seconds, args)
+
+    # Starts the worker threads, if they're not running already.
+    def start(self):
+        with self.lock:
+            if self.executor is not None:
+                return
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="jobs")
+            threading.Thread(target=self.poller, name="jobs-poller", daemon=True).start()
+
+    # Saves a new job using the caller's db connection, without committing.
+    # Call submit() with the returned ID after the commit, to run it right away
+    # instead of waiting for the poller.
+    def enqueue(self, db, name, **args):
+        if name not in self.handlers:
+            raise ValueError("Unknown job: " + name)
+        param = {"name": name, "args": json.dumps(args), "now": int(time.time())}
+        with db.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO Jobs (name, args, status, attempts, run_after, locked_until)
+                VALUES (%(name)s, %(args)s, 0, 0, %(now)s, 0);
+            """,
+                param,
+            )
+            return cur.lastrowid
+
+    def submit(self, id):
+        self.start()
+        self.executor.submit(self.execute, id)
+
+    # Saves and starts a job, using a new db connection.
+    def run(self, name, **args):
+        db = self.connect()
+        try:
+            id = self.enqueue(db, name, **args)
+            db.commit()
+        finally:
+            db.close()
+        self.submit(id)
+        return id
+
+    # Runs a job in the background without saving it first. Faster, but the job
+    # is lost if the app stops. Only use it for jobs that doesn't matter much.
+    def defer(self, name, **args):
+        if name not in self.handlers:
+            raise ValueError("Unknown job: " + name)
+        self.start()
+        self.executor.submit(self.execute_deferred, name, args, 1)
+
+    def execute_deferred(self, name, args, attempt):
+        fn, needs_db = self.handlers[name]
+        db = None
+        try:
+            if needs_db:
+                db = self.connect()
+                fn(db, **args)
+                db.commit()
+            else:
+                fn(**args)
+        except Exception as err:
+            print("Error running job " + name + ": ", err)
+            if attempt < self.max_attempts:
+                retry = (self.execute_deferred, name, args, attempt + 1)
+                timer = threading.Timer(self.backoff(attempt), self.executor.submit, retry)
+                timer.daemon = True
+                timer.start()
+        finally:
+            if db is not None:
+                db.close()
+
+    # Seconds to wait before retrying, doubles for each failed attempt
+    def backoff(self, attempts):
+        return min(2**attempts, 600)
+
+    # Runs a saved job, if no one else has started it already.
+    def execute(self, id):
+        try:
+            db = self.connect()
+        except Exception as err:
+            # The poller will try again later
+            print("Error connecting to database for job: ", err)
+            return
+        try:
+            job = self.claim(db, id)
+            if job is None:
+                return
+            fn, needs_db = self.handlers.get(job["name"], (None, False))
+            try:
+                if fn is None:
+                    raise ValueError("Unknown job: " + job["name"])
+                args = json.loads(job["args"])
+                if needs_db:
+                    fn(db, **args)
+                else:
+                    fn(**args)
+                self.finish(db, id, DONE, None, 0)
+            except Exception as err:
+                db.rollback()
+                print("Error running job " + job["name"] + ": ", err)
+                if job["attempts"] >= self.max_attempts:
+                    self.finish(db, id, FAILED, err, 0)
+                else:
+                    self.finish(db, id, PENDING, err, self.backoff(job["attempts"]))
+        finally:
+            db.close()
+
+    # Marks a job as running, so no other worker picks it up.
+    # Returns the job row, or None if it's taken (or not ready).
+    def claim(self, db, id):
+        now = int(time.time())
+        param = {"id": id, "now": now, "until": now + self.lease}
+        with db.cursor(dictionary=True) as cur:
+            # Only one worker can change the status, thanks to the WHERE clause
+            cur.execute(
+                """
+                UPDATE Jobs SET status = 1, attempts = attempts + 1, locked_until = %(until)s
+                WHERE idjob = %(id)s AND run_after <= %(now)s
+                    AND (status = 0 OR (status = 1 AND locked_until < %(now)s));
+            """,
+                param,
+            )
+            if cur.rowcount != 1:
+                db.commit()
+                return None
+            cur.execute("SELECT * FROM Jobs WHERE idjob = %(id)s;", param)
+            job = cur.fetchone()
+        db.commit()
+        return job
+
+    # Saves the outcome of a job. Commits any changes made by the job too.
+    def finish(self, db, id, status, err, delay):
+        param = {
+            "id": id,
+            "status": status,
+            "error": str(err)[:255] if err is not None else None,
+            "run_after": int(time.time()) + delay,
+        }
+        with db.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE Jobs SET status = %(status)s, last_error = %(error)s, run_after = %(run_after)s
+                WHERE idjob = %(id)s;
+            """,
+                param,
+            )
+        db.commit()
+
+    # Background thread that picks up jobs ready for a retry, jobs from crashed
+    # workers and starts the periodic jobs.
+    # Checks right away when started, so overdue jobs don't have to wait.
+    def poller(self):
+        while True:
+            try:
+                self.start_periodic()
+                for id in self.ready_jobs():
+                    self.executor.submit(self.execute, id)
+            except Exception as err:
+                print("Error checking for jobs: ", err)
+            time.sleep(self.poll)
+
+    # Starts the periodic jobs that are due, see the JobSchedule table
+    def start_periodic(self):
+        if not self.periodic:
+            return
+        now = int(time.time())
+        db = self.connect()
+        try:
+            with db.cursor() as cur:
+                if not self.scheduled:
+                    # New jobs are due right away
+                    for name in self.periodic:
+                        cur.execute("INSERT IGNORE INTO JobSchedule (name, next_run) VALUES (%s, 0);", [name])
+                    db.commit()
+                    self.scheduled = True
+                cur.execute("SELECT name FROM JobSchedule WHERE next_run <= %s;", [now])
+                due = [row[0] for row in cur.fetchall() if row[0] in self.periodic]
+            ids = [self.claim_periodic(db, name, now) for name in due]
+        finally:
+            db.close()
+        for id in ids:
+            if id is not None:
+                self.submit(id)
+
+    # Moves the job's next run forward and saves the job, in one transaction.
+    # Only one process can move it, thanks to the WHERE clause, so the others
+    # gets None.
+    def claim_periodic(self, db, name, now):
+        seconds, args = self.periodic[name]
+        param = {"name": name, "now": now, "next": now + seconds}
+        with db.cursor() as cur:
+            cur.execute(
+                "UPDATE JobSchedule SET next_run = %(next)s WHERE name = %(name)s AND next_run <= %(now)s;", param
+            )
+            if cur.rowcount != 1:
+                db.commit()
+                return None
+        id = self.enqueue(db, name, **args)
+        db.commit()
+        return id
+
+    def ready_jobs(self):
+        param = {"now": int(time.time())}
+        db = self.connect()
+        try:
+            with db.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT idjob FROM Jobs
+                    WHERE (status = 0 AND run_after <= %(now)s) OR (status = 1 AND locked_until < %(now)s)
+                    LIMIT 100;
+                """,
+                    param,
+                )
+                rows = cur.fetchall()
+        finally:
+            db.close()
+        return [row[0] for row in rows]
@@ -0,0 +1,131 @@
+import math, time, threading
+
+# Rate limiting and load shedding.
+#
+# Rate limits uses the "token bucket" algorithm: each client has a bucket that
+# fills up with "rate" tokens per second, up to "burst" tokens. Every request
+# takes one token, and when the bucket is empty the request is denied until
+# it has filled up again. Source: https://en.wikipedia.org/wiki/Token_bucket
+#
+# The buckets are kept in a store. MemoryStore keeps them in this process only,
+# RedisStore shares them between all processes/servers (needs the redis package).
+
+
+class MemoryStore:
+    # max_keys: the amount of buckets to keep before cleaning out the full ones
+    def __init__(self, max_keys=100000):
+        self.buckets = {}
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    # Takes a token from a bucket. Returns (allowed, seconds to wait before retrying).
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            tokens, last, _, _ = self.buckets.get(key, (burst, now, rate, burst))
+            tokens = min(burst, tokens + (now - last) * rate)
+            # The rate and burst are kept with the bucket, since they're
+            # different for each route, see cleanup()
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now, rate, burst)
+                allowed, wait = True, 0.0
+            else:
+                self.buckets[key] = (tokens, now, rate, burst)
+                allowed, wait = False, (1 - tokens) / rate
+            if len(self.buckets) > self.max_keys:
+                self.cleanup(now)
+        return allowed, wait
+
+    # Drops the buckets that would be full by now anyway, same as a new bucket.
+    # Each bucket is checked with its own rate and burst, so ie. a cleanup during
+    # a (fast) buy request doesn't reset the (slow) register limits.
+    def cleanup(self, now):
+        full = [k for k, (tokens, last, rate, burst) in self.buckets.items() if tokens + (now - last) * rate >= burst]
+        for key in full:
+            del self.buckets[key]
+
+
+# Same as MemoryStore, but the buckets are kept in redis so all processes share
+# them. The bucket is updated by a small Lua script, which redis runs atomically.
+# Source: https://redis.io/docs/latest/develop/interact/programmability/eval-intro/
+class RedisStore:
+    SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local bucket = redis.call("HMGET", KEYS[1], "tokens", "last")
+        local tokens = tonumber(bucket[1]) or burst
+        local last = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + (now - last) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call("HSET", KEYS[1], "tokens", tokens, "last", now)
+        redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+        return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+        # Only needed if this store is used
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        allowed, tokens = self.script(keys=["ratelimit:" + key], args=[rate, burst, time.time()])
+        if allowed == 1:
+            return True, 0.0
+        return False, (1 - float(tokens)) / rate
+
+
+# Returns the Retry-After value (whole seconds, at least 1) for a wait time.
+def retry_after(wait):
+    return str(max(1, math.ceil(wait)))
+
+
+# WSGI middleware that limits how many requests are handled at the same time.
+# Extra requests waits for up to "timeout" seconds and then gets a 503 response,
+# which is better than letting them all pile up and run out of db connections.
+class ConcurrencyLimiter:
+    def __init__(self, app, max_requests, timeout=1.0, exempt=("/static/",)):
+        self.app = app
+        self.slots = threading.BoundedSemaphore(max_requests)
+        self.timeout = timeout
+        self.exempt = exempt
+        # Count of shed requests, for debugging
+        self.rejected = 0
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO", "").startswith(self.exempt):
+            return self.app(environ, start_response)
+        if not self.slots.acquire(timeout=self.timeout):
+            self.rejected += 1
+            body = b"Server is busy, please try again later"
+            start_response(
+                "503 Service Unavailable",
+                [
+                    ("Content-Type", "text/plain; charset=utf-8"),
+                    ("Content-Length", str(len(body))),
+                    ("Retry-After", "1"),
+                ],
+            )
+            return [body]
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            self.slots.release()
+            raise
+        return self.release_after(body)
+
+    # The slot is held until the whole response has been sent
+    def release_after(self, body):
+        try:
+            for chunk in body:
+                yield chunk
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+            self.slots.release()
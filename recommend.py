@@ -0,0 +1,139 @@
+import threading
+
+import numpy as np
+
+# "Frequently bought together" recommendations.
+#
+# The idea is simple: two products that are often bought in the same order are
+# probably related. The counts are kept in an item-item co-occurrence matrix,
+# which is very sparse (most products are never bought together), so only the
+# non-zero cells are stored in a dict.
+# More on the idea: https://en.wikipedia.org/wiki/Collaborative_filtering
+#
+# The top products for each product are precomputed, so a lookup is just a
+# dict access when showing a product page.
+
+
+# Packs two product IDs into a single int, which is a lot cheaper to use as a
+# dict key than a tuple. Product IDs are 32 bit ints in the db.
+def pair_key(a, b):
+    return (a << 32) | b
+
+
+# Max amount of orders kept while a build is running
+MAX_PENDING = 100000
+
+
+class Recommender:
+    def __init__(self, k=5):
+        # Amount of related products to keep for each product
+        self.k = k
+        # The sparse co-occurrence matrix, pair_key(a, b) -> count
+        self.counts = {}
+        # The precomputed lookup table, product ID -> list of (product ID, count)
+        self.top = {}
+        self.built = False
+        self.lock = threading.Lock()
+        # Orders added while a build is running, (order number, products).
+        # The first build counts as running from the start, so no orders are
+        # lost before it's done.
+        self.building = True
+        self.pending = []
+
+    # Call before reading the orders for a rebuild, so the orders that comes in
+    # meanwhile are kept for build().
+    def start_build(self):
+        with self.lock:
+            self.building = True
+
+    # Builds the matrix and lookup table from scratch.
+    # "orders" and "products" are two lists (or arrays) of the same length, where
+    # each item is one row from the Orders table. Items with the same order number
+    # belongs to the same order (ie. checkout).
+    def build(self, orders, products):
+        orders = np.asarray(orders, dtype=np.int64)
+        products = np.asarray(products, dtype=np.int64)
+        sort = np.argsort(orders, kind="stable")
+        orders, products = orders[sort], products[sort]
+
+        # Find all pairs of products in the same order. Since the rows are sorted
+        # by order, the pairs are the rows that are d steps apart and still
+        # belong to the same order. The loop runs once per basket size, not per row.
+        left, right = [], []
+        d = 1
+        while d < len(orders):
+            same = orders[d:] == orders[:-d]
+            if not same.any():
+                break
+            a, b = products[:-d][same], products[d:][same]
+            # Skip if the same product shows up twice in an order
+            diff = a != b
+            left.extend([a[diff], b[diff]])
+            right.extend([b[diff], a[diff]])
+            d += 1
+
+        if len(left) > 0:
+            a = np.concatenate(left)
+            b = np.concatenate(right)
+        else:
+            a = b = np.zeros(0, dtype=np.int64)
+        keys, counts = np.unique((a << 32) | b, return_counts=True)
+        a, b = keys >> 32, keys & 0xFFFFFFFF
+
+        # Sort by product and then by count (highest first) and keep the first k
+        # items for each product.
+        order = np.lexsort((b, -counts, a))
+        a, b, c = a[order], b[order], counts[order]
+        starts = np.flatnonzero(np.r_[True, a[1:] != a[:-1]]) if len(a) > 0 else np.zeros(0, dtype=np.int64)
+        rank = np.arange(len(a)) - np.repeat(starts, np.diff(np.r_[starts, len(a)]))
+        keep = rank < self.k
+
+        top = {}
+        for x, y, n in zip(a[keep].tolist(), b[keep].tolist(), c[keep].tolist()):
+            top.setdefault(x, []).append((y, n))
+
+        with self.lock:
+            self.counts = dict(zip(keys.tolist(), counts.tolist()))
+            self.top = top
+            self.built = True
+            # Add the orders that came in while building, except the ones that
+            # the build has counted already
+            if self.pending:
+                seen = np.isin([order or 0 for order, _ in self.pending], orders)
+                for (order, items), dupe in zip(self.pending, seen.tolist()):
+                    if not dupe:
+                        self.merge(items)
+            self.building = False
+            self.pending = []
+
+    # Adds a single new order to the matrix, and updates the lookup table for the
+    # products in it. "order" is the order number, same as in build().
+    # Orders added while build() runs are kept and added when it's done (if the
+    # build didn't read them from the db already), so they're not lost.
+    def add_order(self, products, order=None):
+        products = sorted(set(products))
+        with self.lock:
+            if self.building and len(self.pending) < MAX_PENDING:
+                self.pending.append((order, products))
+            if self.built:
+                self.merge(products)
+
+    # Only the count between the products in the order can change, so the old top
+    # list stays valid and only has to be merged with the new counts.
+    # The lock must be held by the caller.
+    def merge(self, products):
+        for a in products:
+            top = dict(self.top.get(a, []))
+            for b in products:
+                if a == b:
+                    continue
+                key = pair_key(a, b)
+                self.counts[key] = self.counts.get(key, 0) + 1
+                top[b] = self.counts[key]
+            ranked = sorted(top.items(), key=lambda x: (-x[1], x[0]))
+            # Replacing the whole list keeps it safe for readers without a lock
+            self.top[a] = ranked[: self.k]
+
+    # Returns the IDs of the products most often bought together with "product".
+    def related(self, product, k=None):
+        return [id for id, _ in self.top.get(product, [])[: k or self.k]]
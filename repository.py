@@ -0,0 +1,319 @@
+import os, re, sqlite3
+from contextlib import closing
+
+# Repositories holds the SQL for the core tables (users, connectors, products,
+# reviews and shopping carts), so the rest of the code doesn't have to care about
+# which database it's talking to.
+#
+# MySQLRepository is the one used by the app. SQLiteRepository runs the same
+# queries on sqlite, which can run in memory without any server. Handy for quick
+# tests and benchmarks on a laptop, without having to start the docker containers:
+#
+#   repo = repository.connect_sqlite()
+#   products = repo.get_products(limit=10)
+#
+# The queries are written for mysql (with %(name)s params) and are translated for
+# sqlite, only the statements that can't be written the same way for both are
+# overridden by SQLiteRepository.
+#
+# Nothing is committed by the repositories, call commit() when done.
+
+SQLITE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas", "create_database_sqlite.sql")
+
+# The two joins basically adds extra values, from the connector table, to the
+# product tuples. No need to send extra SQL queries to check a connector's type
+# or gender.
+# This was stolen from: https://dba.stackexchange.com/a/208083
+#
+# Any subqueries (queries inside a parenthesis) must also have an alias!
+# Source: https://stackoverflow.com/a/1888845
+PRODUCT_QUERY = """
+    SELECT
+        p.*,
+        c1.gender as "c1gender", c1.type as "c1type",
+        c2.gender as "c2gender", c2.type as "c2type"
+    FROM
+        ({products}) AS p
+        JOIN Connectors c1 ON p.idconnector1 = c1.idconnector
+        JOIN Connectors c2 ON p.idconnector2 = c2.idconnector
+"""
+
+
+# Both the current and the archived orders (see the schema), for use in a FROM clause
+ALL_ORDERS = """
+    (SELECT iduser, idproduct, amount, price, timestamp FROM Orders
+    UNION ALL
+    SELECT iduser, idproduct, amount, price, timestamp FROM OrdersArchive) AS o"""
+
+# A product's reviews, with the reviewers' names
+REVIEWS_QUERY = """
+    SELECT review.*, user.first_name as first_name, user.last_name as last_name
+    FROM
+        (SELECT * FROM Reviews WHERE idproduct = %(idproduct)s) as review
+        JOIN Users user on review.iduser = user.iduser;
+"""
+
+
+class Repository:
+    def __init__(self, db):
+        self.db = db
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+    # Returns the query and params in the style used by the db driver
+    def prepare(self, sql, params):
+        return sql, params
+
+    # Runs a query and returns all rows, as dicts
+    def query(self, sql, params=None):
+        with self.cursor() as cur:
+            cur.execute(*self.prepare(sql, params))
+            return cur.fetchall()
+
+    # Same as above, but only returns the first row (or None)
+    def query_one(self, sql, params=None):
+        with self.cursor() as cur:
+            cur.execute(*self.prepare(sql, params))
+            return cur.fetchone()
+
+    # Runs a statement that doesn't return any rows. Returns the last inserted ID.
+    def execute(self, sql, params=None):
+        with self.cursor() as cur:
+            cur.execute(*self.prepare(sql, params))
+            return cur.lastrowid
+
+    ############################################################################
+    # USERS
+
+    # Raises an IntegrityError if the email already exists (thanks to email UNIQUE constraint).
+    def register_user(self, email, pwd):
+        params = {"email": email, "password": pwd}
+        self.execute("INSERT INTO Users(role, email, password) VALUES(0, %(email)s, %(password)s);", params)
+
+    # Returns the user's profile, without the password
+    def get_user(self, email):
+        row = self.query_one(
+            "SELECT iduser, role, email, first_name, last_name FROM Users WHERE email=%(email)s LIMIT 1;",
+            {"email": email},
+        )
+        if row is None:
+            raise Exception("bad user")
+        return row
+
+    # Returns only what's needed for logging in (iduser, role and the password
+    # hash), or None if there's no such user.
+    def get_user_auth(self, email):
+        return self.query_one(
+            "SELECT iduser, role, password FROM Users WHERE email=%(email)s LIMIT 1;", {"email": email}
+        )
+
+    # The password is only changed if it's not None
+    def update_user(self, param):
+        self.execute(
+            """
+            UPDATE Users
+            SET email=%(email)s, password=COALESCE(%(password)s, password),
+                first_name=%(first_name)s, last_name=%(last_name)s
+            WHERE email=%(oldEmail)s;
+        """,
+            param,
+        )
+
+    def set_password(self, id, password):
+        self.execute("UPDATE Users SET password=%(password)s WHERE iduser=%(id)s;", {"id": id, "password": password})
+
+    ############################################################################
+    # PRODUCTS
+
+    # Returns a list of products, with connector entries JOIN'ed in.
+    # limit sets the maximum amount of products returned, if possible.
+    def get_products(self, limit=10):
+        sql = PRODUCT_QUERY.format(products="SELECT * FROM Products LIMIT %(limit)s")
+        return self.query(sql + " ORDER BY p.idproduct ASC;", {"limit": limit})
+
+    def get_product(self, id):
+        sql = PRODUCT_QUERY.format(products="SELECT * FROM Products WHERE idproduct = %(idproduct)s LIMIT 1")
+        row = self.query_one(sql + ";", {"idproduct": id})
+        if row is None:
+            raise Exception("missing product")
+        return row
+
+    # Returns the products with the given IDs (in the same order), with connectors
+    # JOIN'ed in like above. Missing products are skipped.
+    def get_products_by_ids(self, ids):
+        if len(ids) < 1:
+            return []
+        marks = ", ".join(["%s"] * len(ids))
+        sql = PRODUCT_QUERY.format(products="SELECT * FROM Products WHERE idproduct IN (" + marks + ")")
+        rows = self.query(sql + ";", list(ids))
+        found = {row["idproduct"]: row for row in rows}
+        return [found[id] for id in ids if id in found]
+
+    def get_connectors(self):
+        rows = self.query("SELECT * FROM Connectors")
+        if rows is None:
+            raise Exception("Connector table empty")
+        return rows
+
+    # Returns the new product's ID
+    def add_new_product(self, param):
+        return self.execute(
+            """
+            INSERT INTO Products(price, in_stock, standard, length, color, idconnector1, idconnector2)
+            VALUES( %(price)s, %(in_stock)s, %(standard)s, %(length)s, %(color)s, %(idcon1)s, %(idcon2)s );
+        """,
+            param,
+        )
+
+    # The stock is only changed if in_stock is not None
+    def update_product(self, param):
+        self.execute(
+            """
+            UPDATE Products SET price=%(price)s, in_stock=COALESCE(%(in_stock)s, in_stock), standard=%(standard)s,
+            length=%(length)s, color=%(color)s, idconnector1=%(idcon1)s, idconnector2=%(idcon2)s
+            WHERE idproduct=%(idproduct)s;
+        """,
+            param,
+        )
+
+    def set_product_image(self, id, key):
+        param = {"idproduct": id, "image_file": key}
+        self.execute("UPDATE Products SET image_file=%(image_file)s WHERE idproduct=%(idproduct)s;", param)
+
+    # A single DELETE with an IN list removes all products in one round trip,
+    # instead of sending one DELETE per product.
+    def remove_products(self, products):
+        if len(products) < 1:
+            raise Exception("No products selected")
+        marks = ", ".join(["%s"] * len(products))
+        self.execute("DELETE FROM Products WHERE idproduct IN (" + marks + ");", list(products))
+
+    ############################################################################
+    # REVIEWS
+
+    def get_reviews(self, id):
+        return self.query(REVIEWS_QUERY, {"idproduct": id})
+
+    # Adds a review, or replaces the user's old review of the product
+    def add_review(self, params):
+        self.execute(
+            """
+            INSERT INTO Reviews (iduser, idproduct, rating, comment)
+            VALUES (%(user)s, %(product)s, %(rating)s, %(comment)s)
+            ON DUPLICATE KEY UPDATE rating = %(rating)s, comment = %(comment)s;
+        """,
+            params,
+        )
+
+    ############################################################################
+    # SHOPPING CARTS
+
+    # Adds the product to the cart using an UPSERT query.
+    # Found example of "ON DUPLICATE KEY" constraint here:
+    # https://stackoverflow.com/a/6108484
+    def add_product_to_cart(self, params):
+        self.execute(
+            """
+            INSERT INTO ShoppingCarts (iduser, idproduct, amount)
+            VALUES (%(user)s, %(product)s, %(amount)s)
+            ON DUPLICATE KEY UPDATE amount = amount + %(amount)s;
+        """,
+            params,
+        )
+
+    # Returns the IDs and amounts of the products in a user's cart
+    def get_cart(self, user):
+        return self.query("SELECT idproduct, amount FROM ShoppingCarts WHERE iduser=%(id)s ;", {"id": user})
+
+    def empty_cart(self, user):
+        self.execute("DELETE FROM ShoppingCarts WHERE iduser=%(id)s;", {"id": user})
+
+    # Removes one of the product from the cart, and the whole row when it's the last one
+    def remove_one_from_cart(self, product, user):
+        param = {"product": product, "user": user}
+        row = self.query_one(
+            "SELECT amount FROM ShoppingCarts WHERE (iduser=%(user)s AND idproduct=%(product)s);", param
+        )
+        if row["amount"] > 1:
+            param["new_amount"] = row["amount"] - 1
+            self.execute(
+                "UPDATE ShoppingCarts SET amount=%(new_amount)s WHERE (idproduct=%(product)s AND iduser=%(user)s);",
+                param,
+            )
+        else:
+            self.execute("DELETE FROM ShoppingCarts WHERE (iduser=%(user)s AND idproduct=%(product)s);", param)
+
+
+class MySQLRepository(Repository):
+    # db: a mysql.connector connection
+    def cursor(self):
+        return self.db.cursor(dictionary=True)
+
+
+# Matches the params in the mysql queries: %(name)s and %s
+SQL_PARAM = re.compile(r"%\((\w+)\)s|%s")
+
+
+# Changes a mysql query to sqlite's param style: %(name)s -> :name and %s -> ?
+def to_sqlite(sql):
+    return SQL_PARAM.sub(lambda m: ":" + m.group(1) if m.group(1) else "?", sql)
+
+
+# Returns sqlite rows as dicts, like mysql's dictionary cursors
+def dict_row(cur, row):
+    return {col[0]: value for col, value in zip(cur.description, row)}
+
+
+class SQLiteRepository(Repository):
+    # db: a sqlite3 connection, see connect_sqlite()
+    def __init__(self, db):
+        super().__init__(db)
+        db.row_factory = dict_row
+
+    def cursor(self):
+        # sqlite's cursors can't be used in a with statement by themselves
+        return closing(self.db.cursor())
+
+    def prepare(self, sql, params):
+        return to_sqlite(sql), params or ()
+
+    # sqlite uses "ON CONFLICT" for the upserts, instead of "ON DUPLICATE KEY".
+    # Source: https://www.sqlite.org/lang_upsert.html
+
+    def add_review(self, params):
+        self.execute(
+            """
+            INSERT INTO Reviews (iduser, idproduct, rating, comment)
+            VALUES (%(user)s, %(product)s, %(rating)s, %(comment)s)
+            ON CONFLICT (iduser, idproduct) DO UPDATE SET rating = %(rating)s, comment = %(comment)s;
+        """,
+            params,
+        )
+
+    def add_product_to_cart(self, params):
+        self.execute(
+            """
+            INSERT INTO ShoppingCarts (iduser, idproduct, amount)
+            VALUES (%(user)s, %(product)s, %(amount)s)
+            ON CONFLICT (iduser, idproduct) DO UPDATE SET amount = amount + %(amount)s;
+        """,
+            params,
+        )
+
+
+# Opens a sqlite db (in memory by default) with the schema and example data.
+# Returns a SQLiteRepository.
+def connect_sqlite(path=":memory:", schema=SQLITE_SCHEMA):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA foreign_keys = ON;")
+    with open(schema, encoding="utf-8") as f:
+        db.executescript(f.read())
+    db.commit()
+    return SQLiteRepository(db)
@@ -3,9 +3,16 @@
 -- backend starts up. This allows us to keep a consistent state while testing!
 -- WARN: These tables MUST be dropped in reverse order of creation (due to relations)!
 
+DROP TABLE IF EXISTS CheckoutTokens;
+DROP TABLE IF EXISTS JobSchedule;
+DROP TABLE IF EXISTS Jobs;
+DROP TABLE IF EXISTS SalesDays;
+DROP TABLE IF EXISTS SalesDaily;
 DROP TABLE IF EXISTS Reviews;
+DROP TABLE IF EXISTS OrdersArchive;
 DROP TABLE IF EXISTS Orders;
 DROP TABLE IF EXISTS ShoppingCarts;
+DROP TABLE IF EXISTS StockShards;
 DROP TABLE IF EXISTS Products;
 DROP TABLE IF EXISTS Connectors;
 DROP TABLE IF EXISTS Users;
@@ -27,7 +34,7 @@ CREATE TABLE Users (
 	iduser INT UNIQUE NOT NULL AUTO_INCREMENT,
 	role INT NOT NULL,
 	email VARCHAR(45) UNIQUE NOT NULL,
-	password VARCHAR(45) NOT NULL,
+	password VARCHAR(255) NOT NULL, -- Hashed, see credentials.py
 	first_name VARCHAR(10),
 	last_name VARCHAR(10),
 
@@ -56,12 +63,26 @@ CREATE TABLE Products (
 	image_file VARCHAR(45),
 	idconnector1 INT NOT NULL,
 	idconnector2 INT NOT NULL,
+	-- Amount of rows in StockShards holding the stock, or 0 if it's kept in
+	-- in_stock. For sharded products in_stock is only the (cached) sum, see stock.py
+	stock_shards INT NOT NULL DEFAULT 0,
 
 	PRIMARY KEY (idproduct),
 	FOREIGN KEY (idconnector1) REFERENCES Connectors(idconnector),
 	FOREIGN KEY (idconnector2) REFERENCES Connectors(idconnector)
 );
 
+-- The stock of the popular products, split over a few rows so the checkouts
+-- don't all have to wait for the same row lock. See stock.py
+CREATE TABLE StockShards (
+	idproduct INT NOT NULL,
+	shard INT NOT NULL, -- 0 .. Products.stock_shards-1
+	amount INT NOT NULL,
+	PRIMARY KEY (idproduct, shard),
+
+	FOREIGN KEY (idproduct) REFERENCES Products(idproduct) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
 -- This table stores all products a logged in user wants to buy, but haven't
 -- placed an order for yet.
 -- Product prices should be referenced using the product ID, thus showing current
@@ -93,11 +114,34 @@ CREATE TABLE Orders (
 	price INT NOT NULL,
 	timestamp INT NOT NULL, -- This column can be used to group multiple items into a single order!
 
+	-- For listing orders by date and a customer's order history, without
+	-- having to sort the whole table.
+	INDEX (timestamp),
+	INDEX (iduser, timestamp),
+
 	-- As above.
 	FOREIGN KEY (iduser) REFERENCES Users(iduser) ON DELETE CASCADE ON UPDATE CASCADE,
 	FOREIGN KEY (idproduct) REFERENCES Products(idproduct) ON DELETE CASCADE ON UPDATE CASCADE
 );
 
+-- Old orders are moved here from Orders by the "archive_orders" job (see
+-- backend.py), so the Orders table stays small no matter how old the shop gets.
+-- MySQL's partitioning would have been nicer, but partitioned InnoDB tables
+-- can't have foreign keys. So it's split in a "hot" and an archive table instead.
+-- The archive is rarely read, so it's stored compressed to save disk space.
+-- No foreign keys, the order history should stay even if a product is removed.
+-- Source: https://dev.mysql.com/doc/refman/8.0/en/innodb-compression-usage.html
+CREATE TABLE OrdersArchive (
+	iduser INT NOT NULL,
+	idproduct INT NOT NULL,
+	amount INT NOT NULL,
+	price INT NOT NULL,
+	timestamp INT NOT NULL,
+
+	INDEX (timestamp),
+	INDEX (iduser, timestamp)
+) ROW_FORMAT=COMPRESSED;
+
 -- Allows customers to rate and comment a product, which should be shown on the
 -- product page.
 CREATE TABLE Reviews (
@@ -112,10 +156,79 @@ CREATE TABLE Reviews (
 	FOREIGN KEY (idproduct) REFERENCES Products(idproduct) ON DELETE CASCADE ON UPDATE CASCADE
 );
 
+-- Rollup tables for the sales analytics. They're updated a little at a time
+-- whenever an order is placed, so the admin pages never have to GROUP BY over
+-- the whole Orders table.
+-- No foreign keys here, the sales history should stay even if a product is removed.
+-- day is the UTC date of the order.
+
+-- Units sold and revenue per product and day.
+CREATE TABLE SalesDaily (
+	day DATE NOT NULL,
+	idproduct INT NOT NULL,
+	units INT NOT NULL,
+	revenue INT NOT NULL,
+	PRIMARY KEY (day, idproduct)
+);
+
+-- Amount of orders (ie. checkouts), units sold and revenue per day.
+CREATE TABLE SalesDays (
+	day DATE NOT NULL,
+	orders INT NOT NULL,
+	units INT NOT NULL,
+	revenue INT NOT NULL,
+	PRIMARY KEY (day)
+);
+
+-- Background jobs, see jobs.py
+-- status(0) == pending, status(1) == running, status(2) == done, status(3) == failed
+-- run_after and locked_until are unix timestamps.
+CREATE TABLE Jobs (
+	idjob INT UNIQUE NOT NULL AUTO_INCREMENT,
+	name VARCHAR(45) NOT NULL,
+	args TEXT NOT NULL, -- The job's arguments, as JSON
+	status INT NOT NULL,
+	attempts INT NOT NULL,
+	run_after INT NOT NULL, -- Don't run the job before this time (used for retries)
+	locked_until INT NOT NULL, -- A running job can be taken over after this time
+	last_error VARCHAR(255),
+
+	PRIMARY KEY (idjob),
+	-- Used when looking for jobs that are ready to run
+	INDEX (status, run_after)
+);
+
+-- When each periodic job (see JobQueue.every() in jobs.py) should run next, as
+-- a unix timestamp. Shared by all app processes, so a periodic job runs once
+-- per interval no matter how many processes there are or how often they restart.
+CREATE TABLE JobSchedule (
+	name VARCHAR(45) NOT NULL,
+	next_run INT NOT NULL,
+	PRIMARY KEY (name)
+);
+
+-- One row per placed order, keyed by the random token in the checkout form.
+-- Makes checkouts idempotent: if the form is sent again (double click, retry
+-- after a timeout etc.) the first order is shown instead of placing a new one.
+-- timestamp is the order's timestamp (see Orders), created is when the row was
+-- added (used for the cleanup).
+CREATE TABLE CheckoutTokens (
+	token VARCHAR(64) NOT NULL,
+	iduser INT NOT NULL,
+	timestamp INT NOT NULL,
+	price INT NOT NULL,
+	created INT NOT NULL,
+	PRIMARY KEY (token),
+	INDEX (created),
+
+	FOREIGN KEY (iduser) REFERENCES Users(iduser) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
 --------------------------------------------------------------------------------
 -- Adds some example tuples to the tables.
 
 -- IDs START AT 1 --
+-- The example users have plaintext passwords, they're hashed on their first login.
 INSERT INTO Users (role, email, password, first_name, last_name) VALUES
 (1, "admin@localhost", "pass", "Adam", "Adminson"),
 (0, "humle@home", "humle", "Humle", "Son"),
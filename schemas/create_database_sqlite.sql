@@ -0,0 +1,120 @@
+-- The core tables from create_database.sql, for sqlite. Used by
+-- repository.connect_sqlite() for tests and benchmarks without a mysql server.
+-- Keep it in sync with the mysql schema!
+--
+-- Differences from mysql:
+-- "INTEGER PRIMARY KEY AUTOINCREMENT" instead of "INT ... AUTO_INCREMENT"
+-- Indexes are created with their own CREATE INDEX statements
+-- Strings must use single quotes
+-- Source: https://www.sqlite.org/lang_createtable.html
+
+DROP TABLE IF EXISTS Reviews;
+DROP TABLE IF EXISTS Orders;
+DROP TABLE IF EXISTS ShoppingCarts;
+DROP TABLE IF EXISTS Products;
+DROP TABLE IF EXISTS Connectors;
+DROP TABLE IF EXISTS Users;
+
+-- role(0) == customer, role(1) == admin
+CREATE TABLE Users (
+	iduser INTEGER PRIMARY KEY AUTOINCREMENT,
+	role INT NOT NULL,
+	email VARCHAR(45) UNIQUE NOT NULL,
+	password VARCHAR(255) NOT NULL, -- Hashed, see credentials.py
+	first_name VARCHAR(10),
+	last_name VARCHAR(10)
+);
+
+-- gender(0) == male, gender(1) == female
+CREATE TABLE Connectors (
+	idconnector INTEGER PRIMARY KEY AUTOINCREMENT,
+	gender INT NOT NULL,
+	type VARCHAR(10) NOT NULL
+);
+
+CREATE TABLE Products (
+	idproduct INTEGER PRIMARY KEY AUTOINCREMENT,
+	price INT NOT NULL,
+	in_stock INT NOT NULL,
+	standard FLOAT NOT NULL,
+	length FLOAT NOT NULL,
+	color VARCHAR(10) NOT NULL,
+	image_file VARCHAR(45),
+	idconnector1 INT NOT NULL REFERENCES Connectors(idconnector),
+	idconnector2 INT NOT NULL REFERENCES Connectors(idconnector),
+	stock_shards INT NOT NULL DEFAULT 0 -- The StockShards table is mysql only, see stock.py
+);
+
+CREATE TABLE ShoppingCarts (
+	iduser INT NOT NULL REFERENCES Users(iduser) ON DELETE CASCADE ON UPDATE CASCADE,
+	idproduct INT NOT NULL REFERENCES Products(idproduct) ON DELETE CASCADE ON UPDATE CASCADE,
+	amount INT NOT NULL,
+	PRIMARY KEY (iduser, idproduct)
+);
+
+CREATE TABLE Orders (
+	iduser INT NOT NULL REFERENCES Users(iduser) ON DELETE CASCADE ON UPDATE CASCADE,
+	idproduct INT NOT NULL REFERENCES Products(idproduct) ON DELETE CASCADE ON UPDATE CASCADE,
+	amount INT NOT NULL,
+	price INT NOT NULL,
+	timestamp INT NOT NULL
+);
+CREATE INDEX orders_timestamp ON Orders (timestamp);
+CREATE INDEX orders_user_timestamp ON Orders (iduser, timestamp);
+
+CREATE TABLE Reviews (
+	iduser INT NOT NULL REFERENCES Users(iduser) ON DELETE CASCADE ON UPDATE CASCADE,
+	idproduct INT NOT NULL REFERENCES Products(idproduct) ON DELETE CASCADE ON UPDATE CASCADE,
+	rating INT NOT NULL,
+	comment VARCHAR(255),
+	PRIMARY KEY (iduser, idproduct)
+);
+
+--------------------------------------------------------------------------------
+-- Same example tuples as in create_database.sql
+
+INSERT INTO Users (role, email, password, first_name, last_name) VALUES
+(1, 'admin@localhost', 'pass', 'Adam', 'Adminson'),
+(0, 'humle@home', 'humle', 'Humle', 'Son'),
+(0, 'dumle@work', 'dumle', 'Dumle', 'Dottir');
+
+INSERT INTO Connectors (idconnector, gender, type) VALUES
+(1, 0, 'Type-A'), (2, 0, 'Type-B'), (3, 1, 'Type-A'), (4, 1, 'Type-B');
+
+INSERT INTO Products (price, in_stock, standard, length, color, idconnector1, idconnector2) VALUES
+(199, 10, 3.0, 1.5, 'black', 1, 3),
+(199, 1, 3.0, 1.5, 'red', 1, 3),
+(99, 5, 2.0, 1.5, 'black', 1, 3),
+(99, 5, 2.0, 1.5, 'red', 1, 3),
+(99, 5, 2.0, 3.5, 'black', 2, 4),
+(99, 5, 2.0, 3.5, 'red', 2, 4),
+(59, 10, 1.0, 0.5, 'black', 2, 4),
+(59, 10, 1.0, 0.5, 'red', 2, 4),
+
+(199, 10, 3.0, 1.5, 'black', 1, 3),
+(199, 1, 3.0, 1.5, 'red', 1, 3),
+(99, 5, 2.0, 1.5, 'black', 1, 3),
+(99, 5, 2.0, 1.5, 'red', 1, 3),
+(99, 5, 2.0, 3.5, 'black', 2, 4),
+(99, 5, 2.0, 3.5, 'red', 2, 4),
+(59, 10, 1.0, 0.5, 'black', 2, 4),
+(59, 10, 1.0, 0.5, 'red', 2, 4);
+
+INSERT INTO ShoppingCarts (iduser, idproduct, amount) VALUES
+(2, 1, 1),
+(2, 4, 2),
+(2, 2, 1);
+
+INSERT INTO Orders (iduser, idproduct, amount, price, timestamp) VALUES
+(2, 1, 5, 159, 1741688175),
+(2, 2, 1, 199, 1741688175),
+(2, 5, 1, 59,  1706782642),
+(2, 6, 2, 59,  1706782642),
+(2, 1, 1, 200, 1738405042),
+(3, 1, 1, 200, 1738405043);
+
+INSERT INTO Reviews (iduser, idproduct, rating, comment) VALUES
+(1, 1, 4, 'Love this black cable! But it was expensive...'),
+(2, 1, 3, 'lost 2 stars for expensive price'),
+(3, 1, 1, 'too expensive'),
+(2, 2, 5, 'Red is the new black');
@@ -0,0 +1,169 @@
+import time, threading
+from collections import OrderedDict
+
+# Request coalescing ("single-flight") and a short lived cache, for the hot reads.
+#
+# When a product goes viral, hundreds of requests asks the db for the very same
+# product and reviews at the same time. Here the first request for a key runs the
+# query, and any other requests for the same key that comes in while it's running
+# waits for it and gets the same result. So one query serves them all.
+# Source: https://pkg.go.dev/golang.org/x/sync/singleflight
+#
+# The results are then kept for "ttl" seconds. After that they're still served
+# for another "stale" seconds while a single background refresh gets a new value
+# (stale-while-revalidate), so an expiring key doesn't make everyone wait for the
+# db at the same time. Source: https://www.rfc-editor.org/rfc/rfc5861#section-3
+#
+# Everything is kept in this process only. Other processes finds out about
+# changes when their copy expires, so keep the ttl short.
+
+
+# A query that's running, the waiters gets its result or error
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        # Set if the key was invalidated while the query ran
+        self.invalid = False
+
+
+# Returns a copy of a row or list of rows, so the callers can change them
+# without messing up the cached ones
+def copy_rows(value):
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, list):
+        return [dict(row) if isinstance(row, dict) else row for row in value]
+    return value
+
+
+class SingleFlight:
+    # connect: function that returns a new db connection, for the background
+    #          refreshes (the request's own connection may be closed by then)
+    # ttl: seconds a result is fresh, 0 turns off the caching (but the calls
+    #      running at the same time are still merged)
+    # stale: seconds a result may be served after the ttl, while it's refreshed
+    # max_keys: max amount of cached results, the oldest are dropped first
+    def __init__(self, connect, ttl=2.0, stale=10.0, max_keys=10000):
+        self.connect = connect
+        self.ttl = ttl
+        self.stale = stale
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        # key -> (value, time it was loaded)
+        self.cache = OrderedDict()
+        self.calls = {}
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "refreshes": 0, "errors": 0}
+
+    # Returns the value for a key, loaded with load(db) if it's not cached.
+    # The key must include everything that changes the result, ie. ("product", id).
+    def get(self, key, load, db):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                value, loaded = cached
+                if now < loaded + self.ttl:
+                    self.stats["hits"] += 1
+                    return copy_rows(value)
+                if now < loaded + self.ttl + self.stale:
+                    self.stats["stale_hits"] += 1
+                    if key not in self.calls:
+                        call = self.calls[key] = Call()
+                        self.stats["refreshes"] += 1
+                        threading.Thread(target=self.refresh, args=(key, call, load), daemon=True).start()
+                    return copy_rows(value)
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.stats["misses"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if leader:
+            self.run(key, call, load, db)
+        else:
+            # Someone else is running the query already, wait for their result
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return copy_rows(call.value)
+
+    # Runs the query for a call and saves the result
+    def run(self, key, call, load, db):
+        try:
+            call.value = load(db)
+        except Exception as err:
+            # Errors aren't cached, the next call tries again
+            call.error = err
+        with self.lock:
+            if call.error is not None:
+                self.stats["errors"] += 1
+            elif not call.invalid:
+                self.store(key, call.value)
+            if self.calls.get(key) is call:
+                del self.calls[key]
+        call.done.set()
+
+    # Background refresh of a stale key, with its own db connection
+    def refresh(self, key, call, load):
+        db = None
+        try:
+            db = self.connect()
+        except Exception as err:
+            call.error = err
+        if db is None:
+            with self.lock:
+                self.stats["errors"] += 1
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+            call.done.set()
+            print("Error refreshing " + str(key) + ": ", call.error)
+            return
+        try:
+            self.run(key, call, load, db)
+        finally:
+            db.close()
+        if call.error is not None:
+            print("Error refreshing " + str(key) + ": ", call.error)
+
+    def store(self, key, value):
+        if self.ttl + self.stale <= 0:
+            return
+        self.cache[key] = (value, time.monotonic())
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_keys:
+            self.cache.popitem(last=False)
+
+    # Drops the cached results for the keys. A query for the key that's running
+    # right now may have read the old data, so its result isn't saved and the
+    # next call runs a new query.
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.drop(key)
+
+    # Same as above, for all keys starting with "kind", ie. "products"
+    def invalidate_kind(self, kind):
+        with self.lock:
+            for key in [key for key in list(self.cache) + list(self.calls) if key[0] == kind]:
+                self.drop(key)
+
+    def drop(self, key):
+        self.cache.pop(key, None)
+        call = self.calls.pop(key, None)
+        if call is not None:
+            call.invalid = True
+
+    def metrics(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["keys"] = len(self.cache)
+            stats["running"] = len(self.calls)
+        # How many of the requests didn't have to wait for a query of their own
+        total = sum(stats[name] for name in ("hits", "stale_hits", "misses", "coalesced"))
+        saved = total - stats["misses"]
+        stats["saved_ratio"] = saved / total if total > 0 else 0.0
+        return stats
@@ -0,0 +1,221 @@
+import random
+
+# Sharded stock counters, for the best-sellers.
+#
+# Normally a product's stock is the in_stock column in Products, and every
+# checkout of the product updates that same row. InnoDB locks the row until the
+# checkout's transaction is done, so during a big sale all buyers of a popular
+# product are lined up behind each other, one transaction at a time.
+#
+# A sharded product instead keeps its stock split over a few rows in the
+# StockShards table (Products.stock_shards tells how many). A checkout takes the
+# items from a random shard, so buyers only have to wait for each other when
+# they happen to pick the same shard. This is the same trick as "sharded
+# counters" in Google's datastore:
+# Source: https://cloud.google.com/firestore/docs/solutions/counters
+# (The new Orders rows still lock the product row while checking the foreign key,
+# but those are shared locks which doesn't block each other.)
+#
+# Products.in_stock is still used for showing the stock (and the "too few left"
+# checks when adding to the cart). For sharded products it's the sum of the
+# shards, updated now and then by sync() instead of by every checkout.
+#
+# The shards drift apart as items are taken from them. When the picked shard
+# has too few items left, all shards are locked and the items are taken from
+# wherever they are (so no sale is lost). rebalance() evens them out again.
+# Two checkouts doing that at the same time can deadlock (each is holding the
+# shard it tried first), mysql then fails one of them and the customer has to
+# send the checkout again. Rare enough while there's plenty left in stock.
+#
+# Nothing is committed here, same as in repository.py.
+
+# Default amount of shards when turning on sharding for a product
+DEFAULT_SHARDS = 8
+# A shard is rebalanced when it has less than this part of its fair share left
+REBALANCE_BELOW = 0.5
+
+
+class OutOfStock(Exception):
+    pass
+
+
+# Splits the total into even parts, ie. spread(10, 4) -> [3, 3, 2, 2]
+def spread(total, shards):
+    part, rest = divmod(total, shards)
+    return [part + 1 if n < rest else part for n in range(shards)]
+
+
+# Takes "amount" items of a product, in the caller's transaction.
+# shards: the product's stock_shards value (0 when not sharded), from a product row.
+# Raises OutOfStock if there's too few items left. Returns True if the shards
+# should be rebalanced.
+def take(db, id, amount, shards):
+    param = {"id": id, "amount": amount}
+    with db.cursor() as cur:
+        if shards > 0:
+            param["shard"] = random.randrange(shards)
+            cur.execute(
+                """
+                UPDATE StockShards SET amount = amount - %(amount)s
+                WHERE idproduct = %(id)s AND shard = %(shard)s AND amount >= %(amount)s;
+            """,
+                param,
+            )
+            if cur.rowcount == 1:
+                return False
+        else:
+            # Checks and updates the stock in one statement, so two checkouts
+            # can't both read the same old value and sell the same items twice.
+            cur.execute(
+                """
+                UPDATE Products SET in_stock = in_stock - %(amount)s
+                WHERE idproduct = %(id)s AND in_stock >= %(amount)s AND stock_shards = 0;
+            """,
+                param,
+            )
+            if cur.rowcount == 1:
+                return False
+    # Too few items in the shard, or the product was (un)sharded right now
+    return take_locked(db, id, amount)
+
+
+# Same as above, but locks all of the product's shards first. Slower, but always
+# finds the items if there's enough of them in total.
+def take_locked(db, id, amount):
+    param = {"id": id, "amount": amount}
+    with db.cursor(dictionary=True) as cur:
+        # Always lock the shards in the same order, to not deadlock with others
+        cur.execute("SELECT shard, amount FROM StockShards WHERE idproduct = %(id)s ORDER BY shard FOR UPDATE;", param)
+        rows = cur.fetchall()
+        if not rows:
+            # Not sharded after all
+            cur.execute(
+                """
+                UPDATE Products SET in_stock = in_stock - %(amount)s
+                WHERE idproduct = %(id)s AND in_stock >= %(amount)s AND stock_shards = 0;
+            """,
+                param,
+            )
+            if cur.rowcount != 1:
+                raise OutOfStock("Too few items in stock")
+            return False
+
+        if sum(row["amount"] for row in rows) < amount:
+            raise OutOfStock("Too few items in stock")
+        # Take from the fullest shards first, so as few shards as possible runs dry
+        left = amount
+        for row in sorted(rows, key=lambda row: row["amount"], reverse=True):
+            part = min(left, row["amount"])
+            if part < 1:
+                break
+            param["shard"] = row["shard"]
+            param["part"] = part
+            cur.execute(
+                "UPDATE StockShards SET amount = amount - %(part)s WHERE idproduct = %(id)s AND shard = %(shard)s;",
+                param,
+            )
+            left -= part
+    return True
+
+
+# Replaces the product's shards with "total" items spread over "shards" rows.
+# The product row must be locked by the caller.
+def write_shards(cur, id, total, shards):
+    cur.execute("DELETE FROM StockShards WHERE idproduct = %s;", [id])
+    if shards > 0:
+        values = []
+        for n, part in enumerate(spread(total, shards)):
+            values.extend([id, n, part])
+        marks = ", ".join(["(%s, %s, %s)"] * shards)
+        cur.execute("INSERT INTO StockShards (idproduct, shard, amount) VALUES " + marks + ";", values)
+    param = {"id": id, "total": total, "shards": shards}
+    cur.execute("UPDATE Products SET in_stock = %(total)s, stock_shards = %(shards)s WHERE idproduct = %(id)s;", param)
+
+
+# Turns sharding on or off for a product (shards=0 turns it off), or changes the
+# amount of shards. The stock is set to "total", or kept as it is if None (and
+# then nothing is changed if the amount of shards is the same as before).
+# Returns False if there's no such product.
+def set_shards(db, id, shards, total=None):
+    with db.cursor(dictionary=True) as cur:
+        cur.execute("SELECT in_stock, stock_shards FROM Products WHERE idproduct = %s FOR UPDATE;", [id])
+        prod = cur.fetchone()
+        if prod is None:
+            return False
+        if total is None:
+            if shards == prod["stock_shards"]:
+                return True
+            total = prod["in_stock"]
+            if prod["stock_shards"] > 0:
+                cur.execute("SELECT SUM(amount) AS total FROM StockShards WHERE idproduct = %s FOR UPDATE;", [id])
+                total = int(cur.fetchone()["total"] or 0)
+        write_shards(cur, id, total, shards)
+    return True
+
+
+# Spreads in_stock over the shards again, for the sharded products among "ids".
+# Used after in_stock has been set directly, ie. by the bulk updates.
+def reset_shards(db, ids):
+    if len(ids) < 1:
+        return
+    marks = ", ".join(["%s"] * len(ids))
+    with db.cursor(dictionary=True) as cur:
+        cur.execute(
+            "SELECT idproduct, in_stock, stock_shards FROM Products "
+            "WHERE idproduct IN (" + marks + ") AND stock_shards > 0 FOR UPDATE;",
+            list(ids),
+        )
+        for prod in cur.fetchall():
+            write_shards(cur, prod["idproduct"], prod["in_stock"], prod["stock_shards"])
+
+
+# Evens out the product's shards, and updates in_stock while at it.
+def rebalance(db, id):
+    with db.cursor(dictionary=True) as cur:
+        cur.execute("SELECT shard, amount FROM StockShards WHERE idproduct = %s ORDER BY shard FOR UPDATE;", [id])
+        rows = cur.fetchall()
+        if not rows:
+            return
+        total = sum(row["amount"] for row in rows)
+        for row, part in zip(rows, spread(total, len(rows))):
+            if row["amount"] != part:
+                cur.execute(
+                    "UPDATE StockShards SET amount = %s WHERE idproduct = %s AND shard = %s;", [part, id, row["shard"]]
+                )
+        cur.execute("UPDATE Products SET in_stock = %s WHERE idproduct = %s;", [total, id])
+
+
+# Copies the sums of the shards to Products.in_stock, for showing them.
+# Returns the IDs of the products whose stock changed, the IDs of the products
+# whose shards have drifted too far apart and should be rebalanced, and the IDs
+# of the products that sold out since the last sync.
+def sync(db):
+    with db.cursor(dictionary=True) as cur:
+        # A plain SELECT doesn't lock the shards, so the checkouts can go on
+        cur.execute(
+            """
+            SELECT s.idproduct, p.in_stock, SUM(s.amount) AS total, MIN(s.amount) AS low, COUNT(*) AS shards
+            FROM StockShards s JOIN Products p ON s.idproduct = p.idproduct
+            GROUP BY s.idproduct, p.in_stock;
+        """
+        )
+        rows = cur.fetchall()
+        for row in rows:
+            # mysql returns the SUM() as a Decimal
+            row["total"] = int(row["total"])
+        changed = [row for row in rows if row["total"] != row["in_stock"]]
+        if changed:
+            values = []
+            for row in changed:
+                values.extend([row["idproduct"], row["total"]])
+            values.extend(row["idproduct"] for row in changed)
+            whens = " WHEN %s THEN %s" * len(changed)
+            marks = ", ".join(["%s"] * len(changed))
+            cur.execute(
+                "UPDATE Products SET in_stock = CASE idproduct" + whens + " ELSE in_stock END "
+                "WHERE idproduct IN (" + marks + ");",
+                values,
+            )
+    skewed = [row["idproduct"] for row in rows if row["low"] < row["total"] // row["shards"] * REBALANCE_BELOW]
+    sold_out = [row["idproduct"] for row in changed if row["total"] == 0]
+    return [row["idproduct"] for row in changed], skewed, sold_out
@@ -0,0 +1,125 @@
+import os, re, sys
+
+import pytest
+
+# Checks that the cache refreshes sent by flask (see send_cache_refreshes() in
+# backend.py) ends up in the same nginx cache entries as the visitors' requests.
+# nginx isn't needed, the cache key and the maps are read from nginx.conf and
+# evaluated here the same way nginx does.
+
+# Allow importing the modules from the project root
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+import backend
+
+SECRET = "test-secret"
+
+# The nginx image fills in the environment variables, see docker-compose.yml
+with open(os.path.join(ROOT, "nginx.conf"), encoding="utf-8") as f:
+    NGINX_CONF = f.read().replace("${CACHE_REFRESH_SECRET}", SECRET)
+
+# Accept-Encoding headers sent by real browsers and tools
+CLIENT_ENCODINGS = [
+    "gzip, deflate, br, zstd",  # chrome, firefox
+    "gzip, deflate, br",  # safari
+    "gzip, deflate",
+    "gzip",
+    None,  # curl, bots
+]
+
+
+# Returns the (pattern, value) lines and the default value of a map block
+def read_map(variable):
+    block = re.search(r"map \S+ \$" + variable + r" \{(.*?)\n\}", NGINX_CONF, re.S).group(1)
+    default, entries = "", []
+    for line in block.strip().splitlines():
+        pattern, value = line.strip().rstrip(";").split(None, 1)
+        value = value.strip('"')
+        if pattern == "default":
+            default = value
+        else:
+            entries.append((pattern, value))
+    return entries, default
+
+
+# Same as nginx: exact matches first, then the regexes in order
+# Source: https://nginx.org/en/docs/http/ngx_http_map_module.html
+def eval_map(variable, source):
+    entries, default = read_map(variable)
+    for pattern, value in entries:
+        if not pattern.startswith("~") and pattern.strip('"') == source:
+            return value
+    for pattern, value in entries:
+        if pattern.startswith("~*") and re.search(pattern[2:], source, re.I):
+            return value
+        if pattern.startswith("~") and not pattern.startswith("~*") and re.search(pattern[1:], source):
+            return value
+    return default
+
+
+# The cache key of a request, given the path and its headers
+def cache_key(path, headers):
+    key = re.search(r"proxy_cache_key (.*?);", NGINX_CONF).group(1)
+    values = {
+        "request_uri": path,
+        "cache_encoding": eval_map("cache_encoding", headers.get("Accept-Encoding") or ""),
+    }
+    for name in re.findall(r"\$(\w+)", key):
+        # Anything else (like $host) may differ between flask and the visitors
+        assert name in values, "cache key depends on $" + name
+    return re.sub(r"\$(\w+)", lambda m: values[m.group(1)], key)
+
+
+@pytest.fixture
+def refreshes(monkeypatch):
+    sent = []
+
+    class Response:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def read(self):
+            return b""
+
+    def urlopen(req, timeout=None):
+        sent.append(req)
+        return Response()
+
+    monkeypatch.setattr(backend, "CACHE_PURGE_URL", "http://nginx")
+    monkeypatch.setattr(backend, "CACHE_REFRESH_SECRET", SECRET)
+    monkeypatch.setattr(backend.urllib.request, "urlopen", urlopen)
+    return sent
+
+
+def test_refresh_hits_the_visitors_entries(refreshes):
+    paths = ["/products", "/product/1"]
+    backend.send_cache_refreshes(paths)
+    refreshed = set()
+    for req in refreshes:
+        path = req.full_url[len("http://nginx") :]
+        # urllib keeps the header names capitalized like "X-cache-refresh"
+        refreshed.add(cache_key(path, {"Accept-Encoding": req.get_header("Accept-encoding")}))
+        assert eval_map("cache_refresh", req.get_header("X-cache-refresh")) == "1"
+
+    for path in paths:
+        for encoding in CLIENT_ENCODINGS:
+            assert cache_key(path, {"Accept-Encoding": encoding}) in refreshed
+
+
+def test_every_refresh_is_a_cached_variant():
+    # A refresh for a variant nginx doesn't keep would only make flask render
+    # the page for nothing
+    entries, default = read_map("cache_encoding")
+    variants = set(value for _, value in entries) | {default}
+    assert set(backend.CACHE_ENCODINGS) == variants
+    for encoding in backend.CACHE_ENCODINGS:
+        assert eval_map("cache_encoding", encoding) == encoding
+
+
+def test_refresh_needs_the_secret():
+    assert eval_map("cache_refresh", "1") == "0"
+    assert eval_map("cache_refresh", "") == "0"
+    assert eval_map("cache_refresh", SECRET) == "1"
@@ -0,0 +1,255 @@
+import os, sys, uuid
+
+import pytest
+
+# Contract tests for the repositories (see repository.py). Every test runs
+# against sqlite in memory, and against mysql too when the DB_* variables are
+# set (ie. DB_HOST=127.0.0.1 DB_PORT=7070 ... pytest tests/).
+#
+# The mysql tests runs in a transaction that's rolled back afterwards, so they
+# can be run against a db with real data in it. Nothing is committed, and the
+# tests only looks at the rows they added themselves.
+
+# Allow importing the modules from the project root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import repository
+
+HAS_MYSQL = bool(os.getenv("DB_HOST"))
+
+
+def connect_mysql():
+    import mysql.connector
+
+    db = mysql.connector.connect(
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        database=os.getenv("DB_DATABASE"),
+    )
+    return repository.MySQLRepository(db)
+
+
+@pytest.fixture(params=["sqlite", pytest.param("mysql", marks=pytest.mark.skipif(not HAS_MYSQL, reason="no DB_HOST"))])
+def repo(request):
+    if request.param == "sqlite":
+        repo = repository.connect_sqlite()
+    else:
+        repo = connect_mysql()
+    yield repo
+    repo.rollback()
+    repo.close()
+
+
+# Emails must be unique, and the mysql db may have users already
+def new_email():
+    return "test-" + uuid.uuid4().hex[:12] + "@example.com"
+
+
+def new_user(repo):
+    email = new_email()
+    repo.register_user(email, "hash")
+    return repo.get_user(email)
+
+
+def new_product(repo, **changes):
+    connectors = repo.get_connectors()
+    param = {
+        "price": 123,
+        "in_stock": 7,
+        "standard": 3.0,
+        "length": 2.0,
+        "color": "green",
+        "idcon1": connectors[0]["idconnector"],
+        "idcon2": connectors[-1]["idconnector"],
+    }
+    param.update(changes)
+    return repo.add_new_product(param)
+
+
+################################################################################
+# USERS
+
+
+def test_register_and_get_user(repo):
+    email = new_email()
+    repo.register_user(email, "hash")
+    user = repo.get_user(email)
+    assert user["email"] == email
+    assert user["role"] == 0
+    assert "password" not in user
+
+
+def test_register_user_twice(repo):
+    email = new_email()
+    repo.register_user(email, "hash")
+    with pytest.raises(Exception):
+        repo.register_user(email, "other")
+
+
+def test_get_missing_user(repo):
+    with pytest.raises(Exception):
+        repo.get_user(new_email())
+
+
+def test_get_user_auth(repo):
+    user = new_user(repo)
+    auth = repo.get_user_auth(user["email"])
+    assert auth == {"iduser": user["iduser"], "role": 0, "password": "hash"}
+    assert repo.get_user_auth(new_email()) is None
+
+
+def test_update_user(repo):
+    user = new_user(repo)
+    email = new_email()
+    param = {"email": email, "password": None, "first_name": "Test", "last_name": "Testson"}
+    param["oldEmail"] = user["email"]
+    repo.update_user(param)
+    changed = repo.get_user(email)
+    assert changed["iduser"] == user["iduser"]
+    assert (changed["first_name"], changed["last_name"]) == ("Test", "Testson")
+    # No password keeps the old one
+    assert repo.get_user_auth(email)["password"] == "hash"
+
+    param = dict(param, password="new", oldEmail=email)
+    repo.update_user(param)
+    assert repo.get_user_auth(email)["password"] == "new"
+
+
+def test_set_password(repo):
+    user = new_user(repo)
+    repo.set_password(user["iduser"], "rehashed")
+    assert repo.get_user_auth(user["email"])["password"] == "rehashed"
+
+
+################################################################################
+# PRODUCTS
+
+
+def test_get_connectors(repo):
+    connectors = repo.get_connectors()
+    assert len(connectors) > 0
+    assert {"idconnector", "gender", "type"} <= set(connectors[0])
+
+
+def test_add_and_get_product(repo):
+    id = new_product(repo)
+    prod = repo.get_product(id)
+    assert prod["idproduct"] == id
+    assert (prod["price"], prod["in_stock"], prod["color"]) == (123, 7, "green")
+    # The connectors are joined in
+    connectors = {c["idconnector"]: c for c in repo.get_connectors()}
+    assert prod["c1type"] == connectors[prod["idconnector1"]]["type"]
+    assert prod["c2gender"] == connectors[prod["idconnector2"]]["gender"]
+
+
+def test_get_missing_product(repo):
+    id = new_product(repo)
+    repo.remove_products([id])
+    with pytest.raises(Exception):
+        repo.get_product(id)
+
+
+def test_get_products(repo):
+    new_product(repo)
+    new_product(repo)
+    rows = repo.get_products(limit=2)
+    assert len(rows) == 2
+    assert rows[0]["idproduct"] < rows[1]["idproduct"]
+    assert "c1type" in rows[0]
+
+
+def test_get_products_by_ids(repo):
+    a, b, missing = new_product(repo), new_product(repo), new_product(repo)
+    repo.remove_products([missing])
+    rows = repo.get_products_by_ids([b, missing, a])
+    assert [row["idproduct"] for row in rows] == [b, a]
+    assert repo.get_products_by_ids([]) == []
+
+
+def test_update_product(repo):
+    id = new_product(repo)
+    prod = repo.get_product(id)
+    param = {
+        "idproduct": id,
+        "price": 456,
+        "in_stock": 0,
+        "standard": 2.0,
+        "length": 0.5,
+        "color": "blue",
+        "idcon1": prod["idconnector2"],
+        "idcon2": prod["idconnector1"],
+    }
+    repo.update_product(param)
+    changed = repo.get_product(id)
+    assert (changed["price"], changed["in_stock"], changed["color"]) == (456, 0, "blue")
+    assert (changed["idconnector1"], changed["idconnector2"]) == (prod["idconnector2"], prod["idconnector1"])
+
+    # No stock keeps the current one
+    repo.update_product(dict(param, in_stock=None, price=789))
+    changed = repo.get_product(id)
+    assert (changed["price"], changed["in_stock"]) == (789, 0)
+
+
+def test_set_product_image(repo):
+    id = new_product(repo)
+    assert repo.get_product(id)["image_file"] is None
+    repo.set_product_image(id, "abc123")
+    assert repo.get_product(id)["image_file"] == "abc123"
+
+
+def test_remove_products(repo):
+    a, b, keep = new_product(repo), new_product(repo), new_product(repo)
+    repo.remove_products([a, b])
+    assert [row["idproduct"] for row in repo.get_products_by_ids([a, b, keep])] == [keep]
+    with pytest.raises(Exception):
+        repo.remove_products([])
+
+
+################################################################################
+# REVIEWS
+
+
+def test_add_review(repo):
+    user, id = new_user(repo), new_product(repo)
+    assert repo.get_reviews(id) == []
+    repo.add_review({"user": user["iduser"], "product": id, "rating": 2, "comment": "meh"})
+    repo.add_review({"user": user["iduser"], "product": id, "rating": 5, "comment": "grew on me"})
+    reviews = repo.get_reviews(id)
+    assert len(reviews) == 1
+    assert (reviews[0]["rating"], reviews[0]["comment"]) == (5, "grew on me")
+    assert reviews[0]["iduser"] == user["iduser"]
+    assert "first_name" in reviews[0] and "last_name" in reviews[0]
+
+
+################################################################################
+# SHOPPING CARTS
+
+
+def test_cart(repo):
+    user, a, b = new_user(repo), new_product(repo), new_product(repo)
+    id = user["iduser"]
+    assert repo.get_cart(id) == []
+    repo.add_product_to_cart({"user": id, "product": a, "amount": 1})
+    repo.add_product_to_cart({"user": id, "product": a, "amount": 2})
+    repo.add_product_to_cart({"user": id, "product": b, "amount": 1})
+    cart = {row["idproduct"]: row["amount"] for row in repo.get_cart(id)}
+    assert cart == {a: 3, b: 1}
+
+    repo.remove_one_from_cart(a, id)
+    repo.remove_one_from_cart(b, id)
+    assert repo.get_cart(id) == [{"idproduct": a, "amount": 2}]
+
+    repo.empty_cart(id)
+    assert repo.get_cart(id) == []
+
+
+################################################################################
+# TRANSACTIONS
+
+
+def test_rollback(repo):
+    email = new_email()
+    repo.register_user(email, "hash")
+    repo.rollback()
+    assert repo.get_user_auth(email) is None